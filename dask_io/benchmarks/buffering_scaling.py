@@ -0,0 +1,53 @@
+""" Scaling benchmark of the buffering engines on synthetic sets of used blocks.
+
+Usage:
+------
+    python -m dask_io.benchmarks.buffering_scaling [max_nb_blocks] [max_nb_blocks_reference]
+"""
+import sys
+import time
+
+import numpy as np
+
+from dask_io.optimizer.clustering import run_length_buffering, reference_buffering
+
+
+def create_blocks_used(nb_blocks, ratio=0.9, seed=0):
+    """ Create a cubic-like array of about nb_blocks blocks and draw the blocks used at random.
+
+    Returns:
+    --------
+        blocks: sorted list of blocks used
+        blocks_shape: number of blocks per axis
+    """
+    side = max(int(round(nb_blocks ** (1 / 3))), 1)
+    blocks_shape = (max(nb_blocks // (side * side), 1), side, side)
+    rng = np.random.RandomState(seed)
+    blocks = np.flatnonzero(rng.rand(int(np.prod(blocks_shape))) < ratio).tolist()
+    return blocks, blocks_shape
+
+
+def time_engine(engine, blocks, blocks_shape, max_nb_blocks_per_buffer):
+    t = time.time()
+    buffers = engine(list(blocks), "blocks", blocks_shape, max_nb_blocks_per_buffer)
+    return time.time() - t, buffers
+
+
+def run(max_nb_blocks=10**6, max_nb_blocks_reference=10**4):
+    nb_blocks = 10**3
+    print(f'{"nb blocks":>10} {"run-length (s)":>15} {"reference (s)":>15}')
+    while nb_blocks <= max_nb_blocks:
+        blocks, blocks_shape = create_blocks_used(nb_blocks)
+        max_nb_blocks_per_buffer = blocks_shape[1] * blocks_shape[2] * 2
+        t, buffers = time_engine(run_length_buffering, blocks, blocks_shape, max_nb_blocks_per_buffer)
+        t_ref = float('nan')
+        if nb_blocks <= max_nb_blocks_reference:
+            t_ref, expected = time_engine(reference_buffering, blocks, blocks_shape, max_nb_blocks_per_buffer)
+            assert buffers == expected
+        print(f'{len(blocks):>10} {t:>15.3f} {t_ref:>15.3f}')
+        nb_blocks *= 10
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    run(*args)
@@ -0,0 +1,64 @@
+""" Scaling benchmark of the proxies discovery on synthetic dask graphs.
+
+Usage:
+------
+    python -m dask_io.benchmarks.find_proxies_scaling [max_nb_blocks]
+"""
+import sys
+import time
+import operator
+
+from dask_io.optimizer.find_proxies import get_used_proxies
+
+
+class FakeDataset:
+    """ Stand-in for a h5py dataset: the proxies discovery only needs a shape.
+    """
+    def __init__(self, shape):
+        self.shape = shape
+
+
+def create_synthetic_graph(nb_blocks, chunk_shape=(10, 10, 10)):
+    """ Create a graph having the layout of a dask graph (array.dask.dicts) 
+    with one original array of nb_blocks blocks and one getitem task per block.
+
+    Returns:
+    --------
+        graph: dict of layers
+        keys: output keys of the graph
+        nb_tasks: number of tasks in the graph
+    """
+    token = 'e77315c472aa44ced1dc2219e0bae0fe'
+    origarr_name = 'array-original-' + token
+    array_name = 'array-' + token
+    getitem_name = 'getitem-' + token
+
+    shape = (nb_blocks * chunk_shape[0], chunk_shape[1], chunk_shape[2])
+    array_layer = {origarr_name: FakeDataset(shape)}
+    getitem_layer = dict()
+    for i in range(nb_blocks):
+        slices = (slice(i * chunk_shape[0], (i + 1) * chunk_shape[0], None),
+                  slice(0, chunk_shape[1], None),
+                  slice(0, chunk_shape[2], None))
+        array_layer[(array_name, i, 0, 0)] = (operator.getitem, origarr_name, slices)
+        getitem_layer[(getitem_name, i, 0, 0)] = (operator.getitem, (array_name, i, 0, 0), (slice(None, None, None),) * 3)
+
+    graph = {array_name: array_layer, getitem_name: getitem_layer}
+    return graph, list(getitem_layer.keys()), 2 * nb_blocks
+
+
+def run(max_nb_blocks=10**5):
+    nb_blocks = 10**3
+    print(f'{"nb tasks":>10} {"time (s)":>10} {"us/task":>10}')
+    while nb_blocks <= max_nb_blocks:
+        graph, keys, nb_tasks = create_synthetic_graph(nb_blocks)
+        t = time.time()
+        _, dicts = get_used_proxies(graph, keys)
+        t = time.time() - t
+        assert len(dicts['proxy_to_slices']) == nb_blocks
+        print(f'{nb_tasks:>10} {t:>10.3f} {t / nb_tasks * 10**6:>10.2f}')
+        nb_blocks *= 10
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10**5)
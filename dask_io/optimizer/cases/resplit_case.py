@@ -153,15 +153,13 @@ def get_arrays_dict(buff_to_vols, buffers, outfiles_volumes):
     """ IV - Assigner les volumes à tous les output files, en gardant référence du type de volume que c'est
     """
     array_dict = dict()
+    outfiles_shape, outfiles_partition = get_grid(outfiles_volumes)
 
     for buffer_index, buffer_volumes in buff_to_vols.items():
-        crossed_outfiles = get_crossed_outfiles(buffer_index, buffers, outfiles_volumes) # refine search
-
         for volume in buffer_volumes:
-            for outfile in crossed_outfiles:
-                if included_in(volume, outfile):
-                    add_to_array_dict(array_dict, outfile, volume)
-                    break # a volume can belong to only one output file
+            crossed_outfiles = get_crossed_indices(volume, outfiles_shape, outfiles_partition)
+            if crossed_outfiles:  # a volume can belong to only one output file
+                add_to_array_dict(array_dict, outfiles_volumes[crossed_outfiles[0]], volume)
 
     return array_dict
 
@@ -251,6 +249,18 @@ def get_regions_dict(array_dict, outfiles_volumes):
     return regions_dict
 
 
+def get_theta(_3d_index, B, O):
+    """ Get the Theta shape of the buffer at _3d_index (see paper).
+    """
+    T = list()
+    for dim in range(len(B)):
+        C = ((_3d_index[dim]+1) * B[dim]) % O[dim]
+        if C == 0 and B[dim] != O[dim]:  # particular case
+            C = O[dim]
+        T.append(B[dim] - C)
+    return T
+
+
 def get_buff_to_vols(R, B, O, buffers_volumes, buffers_partition):
     """ Outputs a dictionary associating buffer_index to list of Volumes indexed as in paper.
     """
@@ -260,12 +270,7 @@ def get_buff_to_vols(R, B, O, buffers_volumes, buffers_partition):
     for buffer_index in buffers_volumes.keys():
         _3d_index = numeric_to_3d_pos(buffer_index, buffers_partition, order='F')
         
-        T = list()
-        for dim in range(len(buffers_volumes[buffer_index].p1)):
-            C = ((_3d_index[dim]+1) * B[dim]) % O[dim]
-            if C == 0 and B[dim] != O[dim]:  # particular case
-                C = O[dim]
-            T.append(B[dim] - C)
+        T = get_theta(_3d_index, B, O)
         volumes_list = get_main_volumes(B, T)  # get coords in basis of buffer
         volumes_list = volumes_list + compute_hidden_volumes(T, O)  # still in basis of buffer
         add_offsets(volumes_list, _3d_index, B)  # convert coords in basis of R
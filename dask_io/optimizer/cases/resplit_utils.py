@@ -1,10 +1,10 @@
 from enum import Enum
 import operator
+import itertools
 
 from dask_io.optimizer.utils.utils import _3d_to_numeric_pos
 
 import logging 
-logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 class Axes(Enum):
@@ -82,6 +82,30 @@ def get_blocks_shape(big_array, small_array):
     return tuple([int(b/s) for b, s in zip(big_array, small_array)])
 
 
+def get_grid(volumes):
+    """ Get the shape and the partition of volumes forming a regular grid from the origin, 
+    indexed in storage order (see get_named_volumes).
+    """
+    first, last = volumes[0], volumes[len(volumes) - 1]
+    shape = tuple(b - a for a, b in zip(first.p1, first.p2))
+    partition = tuple(p // s for p, s in zip(last.p2, shape))
+    return shape, partition
+
+
+def get_crossed_indices(volume, grid_shape, grid_partition):
+    """ Returns the indices in storage order of the volumes of a regular grid crossing volume (see hypercubes_overlap),
+    computed from the positions of its corners in the grid.
+
+    Arguments: 
+    ----------
+        volume: Volume
+        grid_shape, grid_partition: shape of the volumes of the grid and number of volumes per axis (see get_grid)
+    """
+    ranges = [range(max(p1 // s, 0), min(-(-p2 // s), n)) 
+              for p1, p2, s, n in zip(volume.p1, volume.p2, grid_shape, grid_partition)]
+    return [_3d_to_numeric_pos(pos, grid_partition, order='F') for pos in itertools.product(*ranges)]
+
+
 def get_crossed_outfiles(buffer_index, buffers, outfiles):
     """ Returns list of output files that are crossing buffer at buffer_index.
 
@@ -89,14 +113,10 @@ def get_crossed_outfiles(buffer_index, buffers, outfiles):
     ----------
         buffer_index: Integer indexing the buffer of interest in storage order.
         buffers: dict of volumes representing the buffers, indexed in storage order.
-        outfiles: dict of volumes representing the output files, indexed in storage order.
+        outfiles: dict of volumes representing the output files, indexed in storage order (see get_named_volumes).
     """
-    crossing = list()
-    buffer_of_interest = buffers[buffer_index]
-    for outfile in outfiles.values():
-        if hypercubes_overlap(buffer_of_interest, outfile):
-            crossing.append(outfile)
-    return crossing
+    outfiles_shape, outfiles_partition = get_grid(outfiles)
+    return [outfiles[i] for i in get_crossed_indices(buffers[buffer_index], outfiles_shape, outfiles_partition)]
 
 
 def merge_volumes(volume1, volume2):
@@ -0,0 +1,220 @@
+import math
+import logging
+
+import numpy as np
+import dask
+from dask.array.core import store_chunk
+
+from dask_io.optimizer.clustering import get_memory_budget, get_buffer_slices_from_original_array
+from dask_io.optimizer.io_tasks import write_buffer
+from dask_io.optimizer.planner import plan_buffers
+from dask_io.optimizer.sources import get_source_adapter, get_layout
+from dask_io.optimizer.stats import timer, incr
+
+logger = logging.getLogger(__name__)
+
+
+"""
+    Clustered writes: write-side counterpart of the clustered reads (see clustering).
+
+    The store tasks created by dask.array.store which write into the same target on disk are grouped
+    into write buffers: boxes of adjacent regions of the target planned like the read buffers (see planner),
+    limited by the memory budget. Each write buffer is a task assembling its regions into one array
+    and writing it with a single write. The store tasks become aliases of the write buffer task writing their region,
+    so that the output of the graph is unchanged.
+
+    Only targets recognized by a source adapter (files) are clustered, and only if their store regions
+    form a grid without overlaps. Store tasks returning the data stored (return_stored=True) are not clustered.
+
+    Configuration:
+    --------------
+        io-optimizer.clustered_writes: True to cluster the writes, False by default
+"""
+
+
+def is_store_task(task):
+    """ Check if a task is a store task created by dask.array.store without return_stored.
+    """
+    return (isinstance(task, tuple)
+            and len(task) == 6
+            and task[0] is store_chunk
+            and task[5] is False
+            and isinstance(task[3], tuple)
+            and all(isinstance(s, slice) and s.step in [None, 1] for s in task[3]))
+
+
+def get_stores(graph):
+    """ Find the store tasks of a graph of layers, grouped by target and layer.
+
+    Returns:
+    --------
+        dictionary mapping (id of the target, layer name) to the list of the store tasks as (layer_name, key, task)
+    """
+    target_to_stores = dict()
+    for layer_name, layer in graph.items():
+        if not isinstance(layer, dict):
+            continue
+        for key, task in layer.items():
+            if is_store_task(task) and get_source_adapter(task[2]) is not None:
+                target_to_stores.setdefault((id(task[2]), layer_name), list()).append((layer_name, key, task))
+    return target_to_stores
+
+
+def get_regions_grid(regions):
+    """ Get the grid formed by the regions of the stores of a target.
+
+    Arguments:
+    ----------
+        regions: list of tuples of slices
+
+    Returns:
+    --------
+        blocks_shape: number of cells per axis
+        boundaries: cells boundaries along each axis
+        blocks: list of the cell of each region, numbered in C order
+        None if a region is not exactly one cell or if two regions are the same cell
+    """
+    ndim = len(regions[0])
+    boundaries = tuple(sorted(set([r[i].start for r in regions] + [r[i].stop for r in regions])) for i in range(ndim))
+    blocks_shape = tuple(len(b) - 1 for b in boundaries)
+    index = [{b: i for i, b in enumerate(axis)} for axis in boundaries]
+
+    blocks = list()
+    for region in regions:
+        positions = [index[i][s.start] for i, s in enumerate(region)]
+        if any(index[i][s.stop] != p + 1 for i, (s, p) in enumerate(zip(region, positions))):
+            return None
+        blocks.append(int(np.ravel_multi_index(positions, blocks_shape)))
+    if len(set(blocks)) != len(blocks):
+        return None
+    return blocks_shape, boundaries, blocks
+
+
+def is_full_box(buffer, blocks_shape):
+    """ Check if the blocks of a buffer fill their bounding box.
+    """
+    positions = np.unravel_index(np.asarray(buffer, dtype=np.int64), blocks_shape)
+    return len(buffer) == math.prod(int(p.max() - p.min() + 1) for p in positions)
+
+
+def get_write_buffers(blocks, blocks_shape, boundaries, itemsize, layout=None, budget=None):
+    """ Group the regions of a grid into write buffers, as full boxes of regions fitting into the memory budget.
+
+    Arguments:
+    ----------
+        blocks: cells of the regions written (see get_regions_grid)
+        blocks_shape, boundaries: grid of the regions
+        itemsize: number of bytes of an element
+        layout: physical layout of the target (see sources.get_layout)
+        budget: memory budget in bytes, see clustering.get_memory_budget if None
+
+    Returns:
+    --------
+        list of write buffers, as lists of blocks, None if no two regions fit into the budget
+    """
+    if budget is None:
+        budget = get_memory_budget()
+    max_block_nbytes = math.prod(int(np.diff(b).max()) for b in boundaries) * itemsize
+    max_blocks = budget // max_block_nbytes
+    if max_blocks < 2:
+        return None
+
+    _, buffers, _ = plan_buffers(
+        sorted(blocks),
+        blocks_shape,
+        boundaries,
+        max_blocks,
+        lambda blocks, shape, max_blocks: [[b] for b in blocks],  # no merge of blocks outside boxes
+        itemsize=itemsize,
+        layout=layout)
+
+    write_buffers = list()
+    for buffer in buffers:
+        if len(buffer) > 1 and not is_full_box(buffer, blocks_shape):  # would overwrite the data between its regions
+            write_buffers.extend([[b] for b in buffer])
+        else:
+            write_buffers.append(buffer)
+    return write_buffers
+
+
+def plan_writes(target, stores):
+    """ Group the stores of a target into write buffers.
+
+    Arguments:
+    ----------
+        target: array written
+        stores: list of (layer_name, key, task) of the store tasks writing into target
+
+    Returns:
+    --------
+        None if the stores cannot be clustered, else:
+        write_buffers: list of write buffers, as lists of stores
+        blocks_shape, boundaries: grid of the regions of the stores (see get_regions_grid)
+        store_to_block: dictionary mapping the key of each store task to its cell in the grid
+    """
+    grid = get_regions_grid([task[3] for _, _, task in stores])
+    if grid is None:
+        logger.debug('Regions of the stores do not form a grid, writes not clustered.')
+        return None
+    blocks_shape, boundaries, blocks = grid
+
+    buffers = get_write_buffers(blocks, blocks_shape, boundaries, np.dtype(target.dtype).itemsize, get_layout(target))
+    if buffers is None:
+        return None
+    block_to_store = dict(zip(blocks, stores))
+    write_buffers = [[block_to_store[b] for b in buffer] for buffer in buffers]
+    return write_buffers, blocks_shape, boundaries, dict(zip([key for _, key, _ in stores], blocks))
+
+
+def create_write_node(graph, write_buffer_stores, blocks_shape, boundaries, store_to_block):
+    """ Replace the store tasks of a write buffer by one write_buffer task in their layer.
+    The store tasks become aliases of the new task.
+    """
+    layer_name, first_key, first_task = write_buffer_stores[0]
+    blocks = [store_to_block[key] for _, key, _ in write_buffer_stores]
+    buffer_slices = get_buffer_slices_from_original_array(blocks, blocks_shape, boundaries)
+    blocks_slices = [tuple(slice(s.start - b.start, s.stop - b.start) for s, b in zip(task[3], buffer_slices))
+                     for _, _, task in write_buffer_stores]
+    sources = [task[1] for _, _, task in write_buffer_stores]
+    target, lock = first_task[2], first_task[4]
+
+    write_key = (first_key[0] + '-merged', min(blocks), max(blocks))
+    graph[layer_name][write_key] = (write_buffer, target, buffer_slices, blocks_slices, sources, lock)
+    for _, key, _ in write_buffer_stores:
+        graph[layer_name][key] = write_key
+    return write_key
+
+
+def apply_clustered_writes(graph):
+    """ Cluster the writes of the store tasks of a graph of layers.
+    The layers modified are replaced by copies, so that the input layers are not modified.
+
+    Arguments:
+    ----------
+        graph: dictionary of layers
+    """
+    if not dask.config.get("io-optimizer.clustered_writes", False):
+        return graph
+
+    with timer('clustered_writes'):
+        for (_, layer_name), stores in get_stores(graph).items():
+            if len(stores) < 2:
+                continue
+            target = stores[0][2][2]
+            try:
+                planned = plan_writes(target, stores)
+            except Exception:  # the stores are left as they are
+                logger.exception('Failed to plan the writes of %s, writes not clustered.', layer_name)
+                continue
+            if planned is None:
+                continue
+            write_buffers, blocks_shape, boundaries, store_to_block = planned
+
+            graph[layer_name] = dict(graph[layer_name])
+            for write_buffer_stores in write_buffers:
+                if len(write_buffer_stores) < 2:
+                    continue
+                create_write_node(graph, write_buffer_stores, blocks_shape, boundaries, store_to_block)
+                incr('write_buffers')
+                incr('stores_merged', len(write_buffer_stores))
+    return graph
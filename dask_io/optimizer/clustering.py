@@ -1,7 +1,10 @@
+import os
 import math
 import sys
 import logging
+import bisect
 
+import numpy as np
 import dask
 from dask.base import tokenize
 
@@ -9,41 +12,158 @@ import operator
 from operator import getitem
 
 from dask_io.optimizer.utils.array_utils import get_arr_shapes
-from dask_io.optimizer.utils.utils import neat_print_graph, ONE_GIG, numeric_to_3d_pos, _3d_to_numeric_pos
+from dask_io.optimizer.utils.utils import neat_print_graph, ONE_GIG, numeric_to_nd_pos, get_available_memory
 from dask_io.optimizer.find_proxies import add_to_dict_of_lists
+from concurrent.futures import ThreadPoolExecutor
+
+from dask_io.optimizer.stats import timer, incr, add_buffer, current_stats, use_stats, set_strategy
+from dask_io.optimizer.planner import plan_buffers
+from dask_io.optimizer.io_tasks import load_buffer, use_load_buffer
 
 logger = logging.getLogger(__name__)
 
 
 def apply_clustered_strategy(graph, dicts, chunk_shape):
     """ Main function applying clustered strategy on a dask graph.
-    """
-    for origarr_name in dicts['origarr_to_obj'].keys():
-        if not origarr_name in dicts['origarr_to_used_proxies']:
-            continue
 
-        print("Creating buffers...")
-        buffers = create_buffers(origarr_name, dicts, chunk_shape)
+    Returns:
+    --------
+        plan: the rewrite applied to the graph, to be replayed using apply_plan. Dictionary with:
+            'buffers': buffers_key -> {buffer key: buffer node}
+            'proxies': proxy key -> new proxy task
+    """
+    plan = {'buffers': dict(), 'proxies': dict()}
+    origarr_names = [origarr_name for origarr_name in dicts['origarr_to_obj'].keys() 
+                     if origarr_name in dicts['origarr_to_used_proxies']]
+
+    print("Creating buffers...")
+    origarr_to_buffers = create_all_buffers(origarr_names, dicts, chunk_shape)
+    for origarr_name in origarr_names:
+        buffers = origarr_to_buffers[origarr_name]
+        block_to_proxies = dicts['origarr_to_block_to_proxies'][origarr_name]
         print(f'Buffers scheduled: {buffers}')
         for buffer in buffers:            
-            key = create_buffer_node(graph, origarr_name, dicts, buffer, chunk_shape)
-            update_io_tasks(graph, dicts, buffer, key, chunk_shape)
+            add_buffer(buffer)
+            with timer('create_buffer_node'):
+                key = create_buffer_node(graph, origarr_name, dicts, buffer, chunk_shape)
+            with timer('update_io_tasks'):
+                update_io_tasks(graph, dicts, buffer, key, chunk_shape, origarr_name)
+
+            buffers_key = key[0]
+            plan['buffers'].setdefault(buffers_key, dict())[key] = graph[buffers_key][key]
+            for block_id in buffer:
+                for proxy in block_to_proxies[block_id]:
+                    plan['proxies'][proxy] = dicts['proxy_to_dict'][proxy][proxy]
+    return plan
+
+
+def create_all_buffers(origarr_names, dicts, chunk_shape):
+    """ Create the buffers of each original array. 
+    The original arrays are planned independently, in a thread pool if there are several of them.
+
+    Returns:
+    --------
+        origarr_to_buffers: original array name -> list of buffers
+    """
+    dicts.setdefault('origarr_to_block_to_proxies', dict())
+    if len(origarr_names) < 2:
+        return {origarr_name: create_buffers(origarr_name, dicts, chunk_shape) for origarr_name in origarr_names}
+
+    stats = current_stats()
+    def plan_origarr(origarr_name):
+        with use_stats(stats):
+            return create_buffers(origarr_name, dicts, chunk_shape)
+
+    max_workers = min(len(origarr_names), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(origarr_names, executor.map(plan_origarr, origarr_names)))
+
+
+def apply_plan(graph, dicts, plan):
+    """ Apply a plan returned by apply_clustered_strategy on a dask graph having the same proxies.
+    """
+    for buffers_key, buffer_nodes in plan['buffers'].items():
+        if buffers_key in graph.keys():
+            graph[buffers_key].update(buffer_nodes)
+        else:
+            graph[buffers_key] = dict(buffer_nodes)
+
+    for proxy, task in plan['proxies'].items():
+        dicts['proxy_to_dict'][proxy][proxy] = task
+
+
+AUTO_MEMORY_FRACTION = 0.5
+AUTO_MEMORY_ROUNDING = 64 * 2**20
+
+
+def get_concurrent_buffers():
+    """ Return the number of buffers expected to be in memory at the same time, 
+    read from the ``io-optimizer.concurrent_buffers" configuration:
+        an integer,
+        "auto": number of threads of the scheduler (``num_workers" configuration or number of CPUs),
+        None (default): 1 if the memory available is set, "auto" otherwise.
+    """
+    concurrent_buffers = dask.config.get("io-optimizer.concurrent_buffers", None)
+    if concurrent_buffers is None:
+        memory = dask.config.get("io-optimizer.memory_available", None)
+        concurrent_buffers = 'auto' if memory in [None, 'auto'] else 1
+    if concurrent_buffers == 'auto':
+        concurrent_buffers = dask.config.get("num_workers", None) or os.cpu_count() or 1
+    return max(int(concurrent_buffers), 1)
+
+
+def get_prefetch_depth():
+    """ Return the number of buffers read in advance, while the buffers being processed are in memory,
+    read from the ``io-optimizer.prefetch_depth" configuration (0 by default).
+    """
+    return int(dask.config.get("io-optimizer.prefetch_depth", None) or 0)
+
+
+def get_memory_available(default_memory=ONE_GIG):
+    """ Get the memory available for the io optimization, in bytes, 
+    read from the ``io-optimizer.memory_available" configuration.
+    If set to "auto", a fraction of the memory available on the machine is used, 
+    rounded down so that plans computed with slightly different available memory can be cached.
+    """
+    try:
+        dask.config.get("io-optimizer")
+        memory = dask.config.get("io-optimizer.memory_available", None)
+    except (KeyError, TypeError):
+        return default_memory
+
+    if memory in [None, 'auto']:
+        available = get_available_memory()
+        if available is None:
+            return default_memory
+        memory = int(available * AUTO_MEMORY_FRACTION)
+        memory = max(memory - memory % AUTO_MEMORY_ROUNDING, AUTO_MEMORY_ROUNDING)
+    return memory
+
+
+def get_memory_budget(default_memory=ONE_GIG):
+    """ Get the memory available for one buffer, in bytes: the memory available (see get_memory_available)
+    divided by the number of buffers in memory at the same time, 
+    i.e. the buffers being processed (see get_concurrent_buffers) and the buffers read in advance (see get_prefetch_depth).
+    """
+    return get_memory_available(default_memory) // (get_concurrent_buffers() + get_prefetch_depth())
 
 
 def get_load_strategy(
         buffer_mem_size,
         cs,
         original_array_blocks_shape,
-        nb=2): # TODO: fix this problem
+        itemsize=2):
     """ Get clustered writes best load strategy given the memory available for io optimization.
 
-    block_row_size = block_mem_size * original_array_blocks_shape[2]
-    block_slice_size = block_row_size * original_array_blocks_shape[1]
+    block_row_size = block_mem_size * original_array_blocks_shape[-1]
+    block_slice_size = block_row_size * original_array_blocks_shape[-2]
 
     Arguments: 
     ---------
-        cs = chunk_shape
-        nb = nb_bytes_per_val
+        buffer_mem_size: memory budget of a buffer, in bytes (see get_memory_budget)
+        cs: chunk_shape
+        original_array_blocks_shape: number of blocks per axis of the original array
+        itemsize: number of bytes per voxel of the original array, 2 (uint16) by default
 
     Returns:
     ---------
@@ -51,7 +171,7 @@ def get_load_strategy(
         max_blocks_per_load
     """
     
-    block_mem_size = cs[0] * cs[1] * cs[2] * nb
+    block_mem_size = math.prod(cs) * itemsize
     strategy = "blocks" # for the moment, let the strategy be blocks only
     
     if (buffer_mem_size < block_mem_size):
@@ -60,7 +180,7 @@ def get_load_strategy(
         print(f'[debug] Buffer size: {buffer_mem_size}')
         print(f'[debug] Chunk size: {block_mem_size}')
         print(f'[debug] Chunk shape: {cs}')
-        print(f'[debug] Nb bytes/voxel: {nb}')
+        print(f'[debug] Nb bytes/voxel: {itemsize}')
         raise ValueError(msg)
     max_blocks_per_load = math.floor(buffer_mem_size / block_mem_size)
 
@@ -105,13 +225,16 @@ def overlap_slice(curr_buff, buff, blocks_shape):
     curr_buff: current buffer containing 1+ entire rows
     buff: buffer containing a entire row
     """
-    end_of_buffer = curr_buff[-1]
-    start_of_row = buff[0]
-    i_1 = numeric_to_3d_pos(end_of_buffer, blocks_shape, order='F')[0]
-    i_2 = numeric_to_3d_pos(start_of_row, blocks_shape, order='F')[0]
-    if i_1 != i_2:
-        return True
-    return False
+    return not same_hyperplane(curr_buff[-1], buff[0], blocks_shape, 2)
+
+
+def same_hyperplane(block_1, block_2, blocks_shape, nb_fast_axes):
+    """ Utility function for buffering: check if two blocks have the same position on all axes 
+    except the nb_fast_axes fastest-varying ones (i.e. are in the same row for 1, the same slice for 2, etc.).
+    """
+    pos_1 = numeric_to_nd_pos(block_1, blocks_shape, order='F')
+    pos_2 = numeric_to_nd_pos(block_2, blocks_shape, order='F')
+    return pos_1[:-nb_fast_axes] == pos_2[:-nb_fast_axes]
 
 
 def merge_rows(buffers, blocks_shape, nb_blocks_per_row, max_blocks_per_load):
@@ -165,7 +288,16 @@ def merge_rows(buffers, blocks_shape, nb_blocks_per_row, max_blocks_per_load):
     return merged_buffers
 
 
-def merge_slices(merged_buffers, nb_blocks_per_slice, max_blocks_per_load):
+def merge_slices(merged_buffers, nb_blocks_per_slice, max_blocks_per_load, blocks_shape=None):
+    """ Utility function for buffering: pack contiguous slices in a same buffer.
+    If blocks_shape is given, slices are not merged across the hyperplanes of rank 3 (arrays with 4+ dimensions), 
+    so that each buffer stays a hyperrectangle of blocks.
+    """
+    def same_volume(prev_buff, buff):
+        if blocks_shape is None or len(blocks_shape) <= 3:
+            return True
+        return same_hyperplane(prev_buff[-1], buff[0], blocks_shape, 3)
+
     prev_slice = (None, None) # index, list of blocks
     merged_buffers_2 = list()
     curr_buff = list() # buffer to do the merge
@@ -191,7 +323,7 @@ def merge_slices(merged_buffers, nb_blocks_per_slice, max_blocks_per_load):
         else:
             prev_slice_index = prev_slice[0]
             if not prev_slice_index == None:
-                if slice_index == (prev_slice_index + 1):
+                if slice_index == (prev_slice_index + 1) and same_volume(prev_slice[1], buff):
                     if len(curr_buff) + len(buff) <= max_blocks_per_load:
                         logger.debug(f'len(curr_buff) + len(buff): {len(curr_buff) + len(buff)}')
                         logger.debug(f'VS max_blocks_per_load: {max_blocks_per_load}')
@@ -216,40 +348,184 @@ def merge_slices(merged_buffers, nb_blocks_per_slice, max_blocks_per_load):
 
 def create_buffers(origarr_name, dicts, chunk_shape):
     """ Merge used blocks into buffers following the 'clustered reads' strategy.
+    The chunk shape of the original array is used if known, chunk_shape otherwise.
+    The mapping from blocks to proxies is stored in dicts['origarr_to_block_to_proxies'][origarr_name].
     """
 
-    def get_buffer_size(default_memory=ONE_GIG):
-        try:
-            optimization = dask.config.get("io-optimizer")
-            return dask.config.get("io-optimizer.memory_available")
-        except BaseException:
-            return default_memory
-
     def new_list(list_of_lists):
         list_of_lists.append(list())
         return list_of_lists, None
 
     # get strategy to apply
+    chunk_shape = dicts.get('origarr_to_chunk_shape', dict()).get(origarr_name, chunk_shape)
     blocks_shape = dicts['origarr_to_blocks_shape'][origarr_name] # WARNING: TODO change var name -> blocks_shape is origarr_blocks_shape
-    strategy, max_nb_blocks_per_buffer = get_load_strategy(get_buffer_size(), 
+    arr_obj = dicts['origarr_to_obj'][origarr_name]
+    itemsize = np.dtype(arr_obj.dtype).itemsize
+    strategy, max_nb_blocks_per_buffer = get_load_strategy(get_memory_budget(), 
                                                       chunk_shape, 
-                                                      blocks_shape)
+                                                      blocks_shape,
+                                                      itemsize)
                                                       
     # get the blocks used list to be bufferized
-    arr_obj = dicts['origarr_to_obj'][origarr_name]
-    blocks_used, block_to_proxies = get_blocks_used(dicts, origarr_name, arr_obj, chunk_shape)
-    dicts['block_to_proxies'] = block_to_proxies
+    with timer('get_blocks_used'):
+        blocks_used, block_to_proxies = get_blocks_used(dicts, origarr_name, arr_obj, chunk_shape)
+    dicts.setdefault('origarr_to_block_to_proxies', dict())[origarr_name] = block_to_proxies
     blocks_used = sorted(blocks_used)
+    incr('blocks_used', len(blocks_used))
 
     # buffering part
     logger.debug(f'\nBefore creating buffers; blocks used are:{blocks_used}')
-    buffers = buffering(blocks_used, strategy, blocks_shape, max_nb_blocks_per_buffer, True, True)
+    with timer('buffering'):
+        strategy, buffers, cost = plan_buffers(
+            blocks_used, 
+            blocks_shape, 
+            dicts['origarr_to_boundaries'][origarr_name], 
+            max_nb_blocks_per_buffer,
+            lambda blocks, shape, max_blocks: buffering(blocks, strategy, shape, max_blocks, True, True),
+            itemsize=itemsize,
+            layout=dicts.get('origarr_to_layout', dict()).get(origarr_name))
+    set_strategy(origarr_name, strategy)
+    for counter in ['read_calls', 'seeks', 'bytes_read', 'bytes_wasted']:
+        incr(counter, cost[counter])
     return buffers
 
 
 def buffering(blocks, strategy, blocks_shape, max_nb_blocks_per_buffer, row_concat=True, slices_concat=True):
-    nb_blocks_per_row = blocks_shape[2]
-    nb_blocks_per_slice = blocks_shape[2] * blocks_shape[1]
+    """ Merge the used blocks into buffers.
+
+    Arguments:
+    ----------
+        blocks: sorted list of the numeric positions of the blocks used
+        strategy: load strategy (see get_load_strategy)
+        blocks_shape: number of blocks per axis of the original array
+        max_nb_blocks_per_buffer: maximum number of blocks in a buffer
+        row_concat: merge complete rows together
+        slices_concat: merge complete slices together
+
+    Returns:
+    --------
+        buffers: list of buffers, each buffer being a list of blocks
+    """
+    buffers = run_length_buffering(blocks, strategy, blocks_shape, max_nb_blocks_per_buffer, row_concat, slices_concat)
+    logger.debug(f'Final buffers scheduled:: {buffers}')
+    return buffers
+
+
+def run_length_buffering(blocks, strategy, blocks_shape, max_nb_blocks_per_buffer, row_concat=True, slices_concat=True):
+    """ Buffering engine working on the sorted array of the blocks used, in linear time.
+    Gives the same buffers as reference_buffering.
+
+    Buffers are represented by segments [start, end[ of the blocks array:
+        1) the blocks are split in runs of contiguous blocks at row ends (start_new_buffer), 
+            then the runs are cut every max_nb_blocks_per_buffer blocks
+        2) consecutive complete rows of a same slice are packed together (merge_rows)
+        3) consecutive complete slices are packed together (merge_slices)
+    """
+    blocks = np.asarray(blocks, dtype=np.int64)
+    if not len(blocks):
+        return list()
+    nb_blocks_per_row = blocks_shape[-1]
+    nb_blocks_per_slice = math.prod(blocks_shape[-2:])
+    max_blocks = max_nb_blocks_per_buffer
+
+    # 1) runs of contiguous blocks. Note that block 0 is never considered non contiguous with the next block (see start_new_buffer)
+    prev_blocks = blocks[:-1]
+    breaks = (np.diff(blocks) != 1) & (prev_blocks != 0)
+    if strategy == "blocks":
+        breaks |= (prev_blocks + 1) % nb_blocks_per_row == 0
+    run_starts = np.flatnonzero(np.concatenate(([True], breaks)))
+    run_ends = np.append(run_starts[1:], len(blocks))
+    nb_pieces = -(-(run_ends - run_starts) // max_blocks)
+    piece_to_run = np.repeat(np.arange(len(run_starts)), nb_pieces)
+    starts = run_starts[piece_to_run] + get_ranks(nb_pieces) * max_blocks
+    ends = np.minimum(starts + max_blocks, run_ends[piece_to_run])
+
+    # 2) pack complete rows of a same slice
+    if row_concat:
+        with timer('merge_rows'):
+            is_row = (ends - starts) == nb_blocks_per_row
+            first, last = blocks[starts], blocks[ends - 1]
+            new_group = np.ones(len(starts), dtype=bool)
+            new_group[1:] = ~is_row[1:] | ~is_row[:-1] | (last[:-1] // nb_blocks_per_slice != first[1:] // nb_blocks_per_slice)
+            rows_per_buffer = max(max_blocks // nb_blocks_per_row, 1)
+            new_buffer = new_group | (get_group_ranks(new_group) % rows_per_buffer == 0)
+            starts, ends = merge_segments(starts, ends, new_buffer)
+
+    # 3) pack consecutive complete slices. Other buffers are output when met, packs of slices when complete
+    order = None
+    members = None
+    if slices_concat:
+        with timer('merge_slices'):
+            slices_pos = np.flatnonzero((ends - starts) == nb_blocks_per_slice)
+            if len(slices_pos):
+                first, last = blocks[starts[slices_pos]], blocks[ends[slices_pos] - 1]
+                slice_indexes = last // nb_blocks_per_slice
+                new_group = np.ones(len(slices_pos), dtype=bool)
+                new_group[1:] = slice_indexes[1:] != slice_indexes[:-1] + 1
+                if len(blocks_shape) > 3:
+                    nb_blocks_per_volume = nb_blocks_per_slice * blocks_shape[-3]
+                    new_group[1:] |= last[:-1] // nb_blocks_per_volume != first[1:] // nb_blocks_per_volume
+                slices_per_buffer = max(max_blocks // nb_blocks_per_slice, 1)
+                new_buffer = new_group | (get_group_ranks(new_group) % slices_per_buffer == 0)
+
+                # emission position of each buffer: its own position for the non-slice buffers, 
+                # position of the first slice of the next pack for a pack of slices
+                pack_first = np.flatnonzero(new_buffer)
+                pack_emission = np.append(slices_pos[pack_first[1:]], len(starts))
+                is_other = np.ones(len(starts), dtype=bool)
+                is_other[slices_pos] = False
+                others = np.flatnonzero(is_other)
+                emission = np.concatenate((others, pack_emission))
+                order = np.argsort(emission, kind='stable')
+
+                pack_last = np.append(pack_first[1:], len(slices_pos)) - 1
+                members = [[o] for o in others.tolist()] + [slices_pos[a:b + 1].tolist() for a, b in zip(pack_first.tolist(), pack_last.tolist())]
+
+    # materialize the buffers
+    blocks = blocks.tolist()
+    starts, ends = starts.tolist(), ends.tolist()
+    if members is None:
+        return [blocks[a:b] for a, b in zip(starts, ends)]
+    buffers = list()
+    for i in order.tolist():
+        segments = members[i]
+        if len(segments) == 1 or all(ends[a] == starts[b] for a, b in zip(segments[:-1], segments[1:])):
+            buffers.append(blocks[starts[segments[0]]:ends[segments[-1]]])
+        else:
+            buffers.append([b for segment in segments for b in blocks[starts[segment]:ends[segment]]])
+    return buffers
+
+
+def get_ranks(counts):
+    """ Utility function for run_length_buffering: concatenation of range(c) for c in counts.
+    """
+    return np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+def get_group_ranks(new_group):
+    """ Utility function for run_length_buffering: rank of each element in its group, 
+    new_group being True for the first element of each group.
+    """
+    indexes = np.arange(len(new_group))
+    group_first = np.maximum.accumulate(np.where(new_group, indexes, 0))
+    return indexes - group_first
+
+
+def merge_segments(starts, ends, new_segment):
+    """ Utility function for run_length_buffering: merge consecutive segments, 
+    new_segment being True for the first segment of each merged segment.
+    """
+    firsts = np.flatnonzero(new_segment)
+    lasts = np.append(firsts[1:], len(starts)) - 1
+    return starts[firsts], ends[lasts]
+
+
+def reference_buffering(blocks, strategy, blocks_shape, max_nb_blocks_per_buffer, row_concat=True, slices_concat=True):
+    """ Block by block buffering engine, quadratic in the number of blocks. 
+    Kept as the reference of the behavior of run_length_buffering. Empties the blocks list.
+    """
+    nb_blocks_per_row = blocks_shape[-1]
+    nb_blocks_per_slice = math.prod(blocks_shape[-2:])
     
     buffers = list()
     curr_buff = list()
@@ -272,46 +548,102 @@ def buffering(blocks, strategy, blocks_shape, max_nb_blocks_per_buffer, row_conc
 
     # concatenation part (to be removed): Concat if complete rows/slices 
     if row_concat:
-        buffers = merge_rows(buffers, blocks_shape, nb_blocks_per_row, max_nb_blocks_per_buffer) # 1) merge complete rows together
+        with timer('merge_rows'):
+            buffers = merge_rows(buffers, blocks_shape, nb_blocks_per_row, max_nb_blocks_per_buffer) # 1) merge complete rows together
     if slices_concat:
-        buffers = merge_slices(buffers, nb_blocks_per_slice, max_nb_blocks_per_buffer) # 2) merge complete slices together
+        with timer('merge_slices'):
+            buffers = merge_slices(buffers, nb_blocks_per_slice, max_nb_blocks_per_buffer, blocks_shape) # 2) merge complete slices together
     
     logger.debug(f'Final buffers scheduled:: {buffers}')
     return buffers
 
 
 def get_blocks_used(dicts, origarr_name, arr_obj, chunk_shape):
-    # extrapolate blocks to load (here talking of logical blocks)
-    blocks_seen = list()
-    blocks_used = list()
-    block_to_proxies =  dict()
+    """ Find the blocks of the original array covered by its used proxies (here talking of logical blocks).
+    The blocks covered by all the proxies are computed at once using numpy.
+
+    Returns:
+    --------
+        blocks_used: sorted list of the numeric positions of the blocks used
+        block_to_proxies: block numeric position -> list of the proxies covering it
+    """
     used_proxies = dicts['origarr_to_used_proxies'][origarr_name]
     blocks_shape = dicts['origarr_to_blocks_shape'][origarr_name]
-    for proxy_key in used_proxies:
-        slice_tuple = dicts['proxy_to_slices'][proxy_key]
-        logger.debug(f'slice_tuple found {slice_tuple}')        
-        x_range, y_range, z_range = get_covered_blocks(slice_tuple, chunk_shape) 
-        for x in x_range:
-            for y in y_range:
-                for z in z_range:
-                    if (x, y, z) not in blocks_seen:
-                        blocks_seen.append((x, y, z))
-                        num_pos = _3d_to_numeric_pos((x, y, z), blocks_shape, 'F')
-                        logger.debug(f'Associated {num_pos} to {(x, y, z)} using block shape: {blocks_shape}')
-                        blocks_used.append(num_pos)
-                        block_to_proxies = add_to_dict_of_lists(block_to_proxies, num_pos, proxy_key, unique=True)
-    return blocks_used, block_to_proxies
-
-
-def get_covered_blocks(slice_tuple, chunk_shape):
-    """ From list of slices of type (slice, slice, slice) find 
+    boundaries = dicts['origarr_to_boundaries'][origarr_name]
+    if not len(used_proxies):
+        return list(), dict()
+
+    # per-axis ranges of blocks covered by each proxy
+    slices = [dicts['proxy_to_slices'][p] for p in used_proxies]
+    starts = np.array([s.start for slice_tuple in slices for s in slice_tuple], dtype=np.int64).reshape((len(slices), -1))
+    stops = np.array([s.stop for slice_tuple in slices for s in slice_tuple], dtype=np.int64).reshape((len(slices), -1))
+    first_blocks, nb_blocks = list(), list()
+    for i in range(len(blocks_shape)):
+        a, b = get_covered_blocks_arrays(starts[:, i], stops[:, i], 
+                                         chunk_shape[i] if chunk_shape else None, 
+                                         boundaries[i] if boundaries else None)
+        first_blocks.append(a)
+        nb_blocks.append(b - a + 1)
+
+    # enumerate the blocks covered by each proxy (one block per proxy in most cases)
+    nb_blocks_per_proxy = np.prod(nb_blocks, axis=0)
+    proxy_indexes = np.repeat(np.arange(len(used_proxies)), nb_blocks_per_proxy)
+    local_indexes = np.arange(len(proxy_indexes)) - np.repeat(np.cumsum(nb_blocks_per_proxy) - nb_blocks_per_proxy, nb_blocks_per_proxy)
+    positions = [None] * len(blocks_shape)
+    for i in reversed(range(len(blocks_shape))):
+        n = nb_blocks[i][proxy_indexes]
+        positions[i] = first_blocks[i][proxy_indexes] + local_indexes % n
+        local_indexes = local_indexes // n
+    block_ids = np.ravel_multi_index(positions, blocks_shape)  # last axis varies fastest, as in _nd_to_numeric_pos
+
+    # group the proxies by block
+    order = np.argsort(block_ids, kind='stable')
+    sorted_ids = block_ids[order]
+    blocks_used, group_starts = np.unique(sorted_ids, return_index=True)
+    group_ends = np.append(group_starts[1:], len(sorted_ids))
+    proxy_indexes = proxy_indexes[order].tolist()
+    if len(blocks_used) == len(sorted_ids):  # one proxy per block
+        block_to_proxies = dict(zip(blocks_used.tolist(), [[used_proxies[j]] for j in proxy_indexes]))
+    else:
+        block_to_proxies = {block: [used_proxies[j] for j in proxy_indexes[a:b]] 
+                            for block, a, b in zip(blocks_used.tolist(), group_starts.tolist(), group_ends.tolist())}
+    return blocks_used.tolist(), block_to_proxies
+
+
+def get_covered_blocks_arrays(starts, stops, chunk_size=None, boundaries=None):
+    """ Vectorized version of get_covered_blocks for one axis.
+
+    Arguments:
+    ----------
+        starts, stops: arrays of the starts and stops of the slices along the axis
+        chunk_size: size of the blocks along the axis, used if boundaries is None
+        boundaries: blocks boundaries along the axis
+
+    Returns:
+    --------
+        first and last blocks covered by each slice
+    """
+    if boundaries is None:
+        return starts // chunk_size, (stops - 1) // chunk_size
+    boundaries = np.asarray(boundaries)
+    return (np.searchsorted(boundaries, starts, side='right') - 1, 
+            np.searchsorted(boundaries, stops - 1, side='right') - 1)
+
+
+def get_covered_blocks(slice_tuple, chunk_shape, boundaries=None):
+    """ From list of slices of type (slice, ..., slice) find 
     which blocks of original array are used by this slicing.
-    we are speaking of logical block here, hence the 'chunk_shape' parameter
+    we are speaking of logical block here, hence the 'chunk_shape' parameter.
+    If the blocks boundaries along each axis are given, they are used instead of the chunk shape (irregular chunks).
     """
     ranges = list()
-    for i, s in zip(range(3), slice_tuple):
-        a = math.floor(s.start / chunk_shape[i])
-        b = math.floor((s.stop - 1) / chunk_shape[i])  # (s.stop - 1) because begins at 0 not 1
+    for i, s in enumerate(slice_tuple):
+        if boundaries is None:
+            a = math.floor(s.start / chunk_shape[i])
+            b = math.floor((s.stop - 1) / chunk_shape[i])  # (s.stop - 1) because begins at 0 not 1
+        else:
+            a = bisect.bisect_right(boundaries[i], s.start) - 1
+            b = bisect.bisect_right(boundaries[i], s.stop - 1) - 1
         ranges.append(range(a, b + 1))  # b + 1 because we want all from a to b included
 
     return ranges
@@ -325,15 +657,16 @@ def create_buffer_node(
         chunk_shape):
 
     # get new key
-    # create name in the form : '53c92348ec58571124ec14b40bc42677-merged'
-    buffers_key = origarr_name.split('-')[-1] + '-merged'
+    buffers_key = get_buffers_key(origarr_name)
     key = (buffers_key, buffer[0], buffer[-1])
 
     # get new value
     arr_obj = dicts['origarr_to_obj'][origarr_name]
     blocks_shape = dicts['origarr_to_blocks_shape'][origarr_name]
-    buffer_slices = get_buffer_slices_from_original_array(buffer, blocks_shape, chunk_shape) 
-    value = (getitem, origarr_name, buffer_slices)
+    boundaries = dicts['origarr_to_boundaries'][origarr_name]
+    buffer_slices = get_buffer_slices_from_original_array(buffer, blocks_shape, boundaries) 
+    loader = load_buffer if use_load_buffer() else getitem
+    value = (loader, origarr_name, buffer_slices)
     logger.debug(f'Buffer_slices found: {buffer_slices}')
 
     # add new key/val pair to the dask graph
@@ -344,21 +677,34 @@ def create_buffer_node(
     return key
 
 
-def update_io_tasks(graph, dicts, buffer, buffer_key, chunk_shape):
+def get_buffers_key(origarr_name):
+    """ Name of the buffers of an original array in the dask graph.
+    In the form '53c92348ec58571124ec14b40bc42677-merged' for default names given by dask.array.from_array, 
+    '<name>-merged' for custom names.
+    """
+    prefix = 'array-original-'
+    if origarr_name.startswith(prefix):
+        return origarr_name[len(prefix):] + '-merged'
+    return origarr_name + '-merged'
+
+
+def update_io_tasks(graph, dicts, buffer, buffer_key, chunk_shape, origarr_name):
+    block_to_proxies = dicts['origarr_to_block_to_proxies'][origarr_name]
+    buffer_slices = graph[buffer_key[0]][buffer_key][2]
     for block_id in buffer:
-        proxies = dicts['block_to_proxies'][block_id]
+        proxies = block_to_proxies[block_id]
         for proxy in proxies:
             source_dict = dicts['proxy_to_dict'][proxy]
             val = source_dict[proxy]
 
             if len(val) == 2:
                 _, slices = source_dict[proxy]
-                slices = origarr_to_buffer_slices(dicts, proxy, buffer_key, slices, chunk_shape)
+                slices = origarr_to_buffer_slices(dicts, origarr_name, buffer_key, slices, buffer_slices)
                 source_dict[proxy] = (getitem, buffer_key, slices)
 
-            elif len(val) == 3:
-                _, _, slices = source_dict[proxy]
-                slices = origarr_to_buffer_slices(dicts, proxy, buffer_key, slices, chunk_shape)
+            elif len(val) >= 3:  # (getter, original array, slices[, asarray, lock])
+                slices = source_dict[proxy][2]
+                slices = origarr_to_buffer_slices(dicts, origarr_name, buffer_key, slices, buffer_slices)
                 source_dict[proxy] = (getitem, buffer_key, slices)
 
             else:
@@ -366,51 +712,56 @@ def update_io_tasks(graph, dicts, buffer, buffer_key, chunk_shape):
                 pass
 
 
-def get_buffer_slices_from_original_array(load, shape, original_array_chunk):
-    start = min(load)
-    end = max(load)
+def get_buffer_slices_from_original_array(load, shape, boundaries):
+    """ Get the slices of the original array covered by a buffer, i.e. the bounding box of its blocks.
 
-    all_block_num_indexes = range(start, end + 1)
-    all_block_3d_indexes = [
-        numeric_to_3d_pos(
+    Arguments:
+    ----------
+        load: list of the blocks in the buffer
+        shape: number of blocks per axis of the original array
+        boundaries: blocks boundaries along each axis of the original array
+    """
+    all_block_nd_indexes = [
+        numeric_to_nd_pos(
             num_pos,
             shape,
-            order='F') for num_pos in all_block_num_indexes]
-
-    mini = [None, None, None]
-    maxi = [None, None, None]
-    for _3d_index in all_block_3d_indexes:
-        for i in range(3):
-            if (mini[i] is None) or (_3d_index[i] < mini[i]):
-                mini[i] = _3d_index[i]
-            if maxi[i] is None or (_3d_index[i] + 1 > maxi[i]):
-                maxi[i] = _3d_index[i] + 1
+            order='F') for num_pos in load]
 
-    mini = [e * d for e, d in zip(mini, original_array_chunk)]
-    maxi = [e * d for e, d in zip(maxi, original_array_chunk)]
+    mini = [None] * len(shape)
+    maxi = [None] * len(shape)
+    for _nd_index in all_block_nd_indexes:
+        for i in range(len(shape)):
+            if (mini[i] is None) or (_nd_index[i] < mini[i]):
+                mini[i] = _nd_index[i]
+            if maxi[i] is None or (_nd_index[i] + 1 > maxi[i]):
+                maxi[i] = _nd_index[i] + 1
 
-    return (slice(mini[0], maxi[0], None),
-            slice(mini[1], maxi[1], None),
-            slice(mini[2], maxi[2], None))
+    mini = [b[e] for e, b in zip(mini, boundaries)]
+    maxi = [b[e] for e, b in zip(maxi, boundaries)]
 
+    return tuple([slice(a, b, None) for a, b in zip(mini, maxi)])
 
-def origarr_to_buffer_slices(dicts, proxy, buffer_key, slices, chunk_shape):
-    buffer_id, _ = buffer_key[0].split('-')
-    origarr_name = 'array-original' + '-' + buffer_id
-    origarr_obj = dicts['origarr_to_obj'][origarr_name]
-    img_nb_blocks_per_dim = dicts['origarr_to_blocks_shape'][origarr_name]
 
-    block_id, start_block, end_block = buffer_key
-    start_pos = numeric_to_3d_pos(start_block, img_nb_blocks_per_dim, 'F')
-    offset = [x * i for x, i in zip(start_pos, chunk_shape)]
+def origarr_to_buffer_slices(dicts, origarr_name, buffer_key, slices, buffer_slices=None):
+    """ Convert the slices of a proxy in the original array into slices in the buffer it has been assigned to.
+    The offset of the buffer is the start of its slices in the original array if given, 
+    the position of its first block otherwise.
+    """
+    if buffer_slices is not None:
+        offset = [s.start for s in buffer_slices]
+    else:
+        img_nb_blocks_per_dim = dicts['origarr_to_blocks_shape'][origarr_name]
+        block_id, start_block, end_block = buffer_key
+        start_pos = numeric_to_nd_pos(start_block, img_nb_blocks_per_dim, 'F')
+        boundaries = dicts['origarr_to_boundaries'][origarr_name]
+        offset = [b[x] for x, b in zip(start_pos, boundaries)]
 
     new_slices = list()
     for i, s in enumerate(slices):
         start = s.start - offset[i]
         stop = s.stop - offset[i]
         new_slices.append(slice(start, stop, s.step))
-    slices = (new_slices[0], new_slices[1], new_slices[2])
-    return slices
+    return tuple(new_slices)
 
 
 
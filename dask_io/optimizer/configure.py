@@ -1,23 +1,55 @@
 from dask_io.optimizer.optimizer import optimize_func, keep_algorithm
+from dask_io.optimizer import scheduler, io_tasks
 import dask 
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-def enable_keep():
+def enable_keep(buffer_size='auto', mem_limit=True, concurrent_buffers=None, io_threads='auto', prefetch_depth=0, set_scheduler=False, clustered_writes=True):
+    """ Activate keep algorithm: each output file of a resplit is written in as few operations as possible, 
+    keeping the parts of the output files crossing several buffers in memory (see keep).
+
+    Arguments:
+    ----------
+        buffer_size: memory available for the buffers and the kept volumes, in bytes, 
+            "auto" (default) to use half of the memory available on the machine (see enable_clustering).
+        mem_limit, concurrent_buffers, io_threads, prefetch_depth, set_scheduler: see enable_clustering
+        clustered_writes: cluster the stores not rewritten by the keep algorithm (see enable_clustering)
+    """
+    enable_clustering(buffer_size, 
+                      mem_limit=mem_limit, 
+                      concurrent_buffers=concurrent_buffers, 
+                      io_threads=io_threads, 
+                      prefetch_depth=prefetch_depth,
+                      clustered_writes=clustered_writes,
+                      set_scheduler=set_scheduler)
     dask.config.set({
         'optimizations': [keep_algorithm]
     })
 
 
-def enable_clustering(buffer_size, mem_limit=True):
+def enable_clustering(buffer_size, mem_limit=True, layer_aware=False, strategy='auto', concurrent_buffers=None, io_threads='auto', prefetch_depth=0, clustered_writes=False, set_scheduler=False):
     """ Activate cluster strategy.
 
     Arguments:
     ----------
-        buffer_size: size of buffer for clustered reads/writes.
-        sched_opti: enable memory constraint on scheduler.
+        buffer_size: size of buffer for clustered reads/writes, in bytes. 
+            "auto" to use half of the memory available on the machine.
+        mem_limit: enable memory constraint on scheduler: the buffers in memory are limited to buffer_size
+            by the computations run with scheduler.get, e.g. arr.compute(scheduler=scheduler.get) (see scheduler).
+        layer_aware: only materialize and rewrite the layers consuming original arrays. 
+            In this mode all proxies of those layers are buffered, even if not used by the output keys.
+        strategy: buffering strategy ("blocks", "rows", "slices" or "bricks"), "auto" to choose the cheapest one (see planner).
+        concurrent_buffers: number of buffers in memory at the same time, buffer_size being shared between them.
+            "auto" for the number of threads, None for 1 if buffer_size is set and "auto" otherwise.
+        io_threads: number of threads loading the buffers by scheduler.get (see set_io_threads).
+        prefetch_depth: number of buffers read in advance while the current buffers are processed, 
+            by scheduler.get (see scheduler). buffer_size is shared between all these buffers.
+        clustered_writes: opt-in, group the stores into the same file into write buffers (see clustered_writes).
+        set_scheduler: opt-in, with mem_limit: replace the default scheduler of dask by scheduler.get 
+            for all the computations of the process until disable_clustering. 
+            A scheduler configured explicitly (e.g. "processes", distributed client) is left alone.
     """
     if not mem_limit: 
         print("Warning: using clustered strategy without memory constraint on scheduler can lead to buffer overflows.")
@@ -26,9 +58,106 @@ def enable_clustering(buffer_size, mem_limit=True):
         'optimizations': [optimize_func],
         'io-optimizer': {
             'memory_available': buffer_size,
-            'scheduler_opti': mem_limit
+            'scheduler_opti': mem_limit,
+            'layer_aware': layer_aware,
+            'strategy': strategy,
+            'concurrent_buffers': concurrent_buffers,
+            'io_threads': io_threads,
+            'prefetch_depth': prefetch_depth,
+            'clustered_writes': clustered_writes
         }
     })
+    current_scheduler = dask.config.get('scheduler', None)
+    if mem_limit and set_scheduler and current_scheduler in [None, scheduler.get]:
+        dask.config.set({'scheduler': scheduler.get})
+    elif mem_limit and set_scheduler:
+        logger.warning(f'Scheduler {current_scheduler} configured, the buffers in memory are not limited.')
+    elif current_scheduler is scheduler.get:  # set by a previous call
+        dask.config.set({'scheduler': None})
+
+
+def enable_graph_dump(directory='/tmp', fmt='jsonl', every=1, max_tasks=None):
+    """ Dump the input and output graphs of the optimization function for debugging.
+    To be called after enable_clustering.
+
+    Arguments:
+    ----------
+        directory: directory where to write the dump files
+        fmt: "jsonl" or "text"
+        every: dump one task every k tasks
+        max_tasks: maximum number of tasks to dump per graph, None for no limit
+    """
+    config = dict(dask.config.get('io-optimizer', None) or dict())
+    config['graph_dump'] = {
+        'directory': directory,
+        'format': fmt,
+        'every': every,
+        'max_tasks': max_tasks
+    }
+    dask.config.set({'io-optimizer': config})
+
+
+def disable_graph_dump():
+    config = dask.config.get('io-optimizer', None)
+    if config:
+        config = dict(config)
+        config['graph_dump'] = None
+        dask.config.set({'io-optimizer': config})
+
+
+def set_stats_callback(callback):
+    """ Set a function to be called with the OptimizationStats object of each optimization. 
+    To be called after enable_clustering.
+    """
+    config = dict(dask.config.get('io-optimizer', None) or dict())
+    config['stats_callback'] = callback
+    dask.config.set({'io-optimizer': config})
+
+
+def enable_buffer_cache(cache_size):
+    """ Keep the buffers loaded in memory between computations, in a LRU cache (see io_tasks).
+    To be called after enable_clustering.
+
+    Arguments:
+    ----------
+        cache_size: maximum number of bytes of the cache
+    """
+    config = dict(dask.config.get('io-optimizer', None) or dict())
+    config['buffer_cache_size'] = cache_size
+    dask.config.set({'io-optimizer': config})
+
+
+def disable_buffer_cache():
+    """ Stop caching the buffers and empty the cache.
+    """
+    config = dask.config.get('io-optimizer', None)
+    if config:
+        config = dict(config)
+        config['buffer_cache_size'] = 0
+        dask.config.set({'io-optimizer': config})
+    io_tasks.clear_buffer_cache()
+
+
+def enable_buffer_pool(pool_size):
+    """ Read the buffers into a pool of reusable preallocated arrays (see io_tasks).
+    To be called after enable_clustering.
+
+    Arguments:
+    ----------
+        pool_size: maximum number of bytes of the pool
+    """
+    config = dict(dask.config.get('io-optimizer', None) or dict())
+    config['buffer_pool_size'] = pool_size
+    dask.config.set({'io-optimizer': config})
+
+
+def disable_buffer_pool():
+    config = dask.config.get('io-optimizer', None)
+    if config:
+        config = dict(config)
+        config['buffer_pool_size'] = 0
+        dask.config.set({'io-optimizer': config})
+    io_tasks.get_buffer_pool().clear()
 
 
 def disable_clustering():
@@ -36,6 +165,9 @@ def disable_clustering():
         'optimizations': list(),
         'io-optimizer': None
     })
+    if dask.config.get('scheduler', None) is scheduler.get:
+        dask.config.set({'scheduler': None})
+    scheduler.shutdown_executors()
 
 
 def configure_dask(config):
@@ -50,6 +182,20 @@ def configure_dask(config):
     enable_clustering(config.buffer_size, sched_opti=config.scheduler_opti)
 
 
+def set_io_threads(io_threads='auto'):
+    """ Load the buffers on a dedicated pool of I/O threads (see scheduler). 
+    To be called after enable_clustering, with mem_limit=True.
+
+    Arguments:
+    ----------
+        io_threads: number of I/O threads, "auto" to use one thread only if on hdd, 
+            None to load the buffers in the compute pool
+    """
+    config = dict(dask.config.get('io-optimizer', None) or dict())
+    config['io_threads'] = io_threads
+    dask.config.set({'io-optimizer': config})
+
+
 def split():
     # use one thread only if on hdd
-    pass
\ No newline at end of file
+    set_io_threads('auto')
\ No newline at end of file
@@ -0,0 +1,241 @@
+import math
+import logging
+import itertools
+import collections
+
+import numpy as np
+import dask
+
+from dask_io.optimizer.clustering import buffering, get_buffer_slices_from_original_array
+from dask_io.optimizer.clustered_writes import get_write_buffers
+from dask_io.optimizer.keep import plan_keep, get_buffer_box
+from dask_io.optimizer.planner import plan_buffers, get_buffers_cost, get_cost_model
+
+logger = logging.getLogger(__name__)
+
+
+"""
+    Dry run of a resplit: estimation of the I/O of each strategy from the shapes only, without any read or write.
+
+    The original array of shape R, split into input blocks of shape I (the chunks of the dask array)
+    and physically stored in chunks (HDF5, zarr) or contiguously, is written into output files of shape O.
+    For each strategy and buffer size, the buffers are planned as by the optimizer and the I/O
+    estimated with the cost model of the planner (see planner.get_buffers_cost), writes being counted as reads:
+        none: one read per input block, one write per part of an output file in an input block (one store task),
+        clustered: reads clustered into buffers (see clustering.buffering and planner.plan_buffers),
+            writes clustered into write buffers per output file (see clustered_writes),
+        keep: writes of the regions of compute_zones for the plan of keep.plan_keep,
+            reads in the buffers of the plan within the memory left by the kept volumes (see optimizer.keep_algorithm).
+    The output files are assumed stored contiguously in C order.
+
+    The recommended configuration is the one of lowest estimated cost fitting into its buffer size,
+    to be applied with configure.enable_clustering(buffer_size, strategy=plan['strategy'], clustered_writes=True) for "clustered"
+    and configure.enable_keep(buffer_size) for "keep".
+"""
+
+DRY_RUN_STRATEGIES = ['none', 'clustered', 'keep']
+COST_KEYS = ['read_calls', 'seeks', 'bytes_read', 'bytes_wasted', 'cost']
+
+
+def get_boundaries(shape, chunks):
+    return tuple(list(range(0, n, c)) + [n] for n, c in zip(shape, chunks))
+
+
+def add_costs(cost1, cost2, count=1):
+    return {k: cost1[k] + count * cost2[k] for k in COST_KEYS}
+
+
+def get_max_buffer_nbytes(buffers, blocks_shape, boundaries, itemsize):
+    """ Get the number of bytes of the biggest bounding box of the buffers.
+    """
+    return max((math.prod(s.stop - s.start for s in get_buffer_slices_from_original_array(buffer, blocks_shape, boundaries))
+                for buffer in buffers), default=0) * itemsize
+
+
+def get_boxes_cost(boxes, shape, itemsize, layout=None, cost_model=None):
+    """ Estimate the cost of reading boxes (tuples of slices) of an array of the given shape (see planner.get_buffers_cost).
+    The boxes are converted into buffers of the grid formed by their edges.
+    """
+    boundaries = tuple(sorted(set([0, n] + [box[axis].start for box in boxes] + [box[axis].stop for box in boxes]))
+                       for axis, n in enumerate(shape))
+    blocks_shape = tuple(len(b) - 1 for b in boundaries)
+    index = [{e: i for i, e in enumerate(b)} for b in boundaries]
+
+    buffers = list()
+    for box in boxes:
+        ranges = [np.arange(index[axis][s.start], index[axis][s.stop]) for axis, s in enumerate(box)]
+        cells = np.ravel_multi_index(np.meshgrid(*ranges, indexing='ij'), blocks_shape).ravel()
+        buffers.append(sorted(cells.tolist()))
+    return get_buffers_cost(buffers, blocks_shape, boundaries, itemsize, layout, cost_model)
+
+
+def get_outfiles_patterns(R, I, O):
+    """ Group the output files by grid of their parts in the input blocks, i.e. by grid of their store tasks.
+
+    Returns:
+    --------
+        list of (boundaries of the parts relative to the output file, number of output files)
+    """
+    axes_patterns = list()
+    for r, i, o in zip(R, I, O):
+        patterns = collections.Counter()
+        for start in range(0, r, o):
+            stop = min(start + o, r)
+            edges = [start] + list(range((start // i + 1) * i, stop, i)) + [stop]
+            patterns[tuple(e - start for e in edges)] += 1
+        axes_patterns.append(patterns.items())
+    return [(tuple(p for p, _ in combination), math.prod(c for _, c in combination))
+            for combination in itertools.product(*axes_patterns)]
+
+
+def estimate_writes(R, I, O, itemsize, budget=None, cost_model=None):
+    """ Estimate the cost of the writes of the store tasks, clustered into write buffers if budget is not None.
+
+    Returns:
+    --------
+        cost (see planner.get_buffers_cost, read_calls being the write calls),
+        number of bytes of the biggest write buffer
+    """
+    cost, max_nbytes = {k: 0 for k in COST_KEYS}, 0
+    for boundaries, count in get_outfiles_patterns(R, I, O):
+        blocks_shape = tuple(len(b) - 1 for b in boundaries)
+        blocks = list(range(math.prod(blocks_shape)))
+        buffers = get_write_buffers(blocks, blocks_shape, boundaries, itemsize, budget=budget) if budget else None
+        if buffers is None:
+            buffers = [[b] for b in blocks]
+        cost = add_costs(cost, get_buffers_cost(buffers, blocks_shape, boundaries, itemsize, cost_model=cost_model), count)
+        max_nbytes = max(max_nbytes, get_max_buffer_nbytes(buffers, blocks_shape, boundaries, itemsize))
+    return cost, max_nbytes
+
+
+def get_estimate(strategy, buffer_size, read_cost, write_cost, peak_memory, plan):
+    return {
+        'strategy': strategy,
+        'buffer_size': buffer_size,
+        'read_calls': read_cost['read_calls'],
+        'write_calls': write_cost['read_calls'],
+        'bytes_read': read_cost['bytes_read'],
+        'bytes_written': write_cost['bytes_read'],
+        'seeks': read_cost['seeks'] + write_cost['seeks'],
+        'peak_memory': peak_memory,
+        'cost': read_cost['cost'] + write_cost['cost'],
+        'plan': plan
+    }
+
+
+def estimate_none(R, I, O, itemsize, layout, nb_buffers, cost_model):
+    blocks_shape = tuple(-(-r // i) for r, i in zip(R, I))
+    boundaries = get_boundaries(R, I)
+    buffers = [[b] for b in range(math.prod(blocks_shape))]
+    read_cost = get_buffers_cost(buffers, blocks_shape, boundaries, itemsize, layout, cost_model)
+    write_cost, write_nbytes = estimate_writes(R, I, O, itemsize, cost_model=cost_model)
+    peak_memory = nb_buffers * math.prod(I) * itemsize + write_nbytes
+    return get_estimate('none', None, read_cost, write_cost, peak_memory, dict())
+
+
+def estimate_reads(R, I, itemsize, layout, budget, cost_model):
+    """ Estimate the cost of the reads clustered into buffers fitting into budget.
+
+    Returns:
+    --------
+        None if an input block does not fit into budget, else:
+        strategy of the planner, number of buffers, cost, number of bytes of the biggest buffer
+    """
+    max_blocks = budget // (math.prod(I) * itemsize)
+    if max_blocks < 1:
+        return None
+    blocks_shape = tuple(-(-r // i) for r, i in zip(R, I))
+    boundaries = get_boundaries(R, I)
+    name, buffers, _ = plan_buffers(
+        list(range(math.prod(blocks_shape))),
+        blocks_shape,
+        boundaries,
+        max_blocks,
+        lambda blocks, shape, max_blocks: buffering(blocks, 'blocks', shape, max_blocks, True, True),
+        itemsize=itemsize,
+        layout=layout)
+    cost = get_buffers_cost(buffers, blocks_shape, boundaries, itemsize, layout, cost_model)
+    return name, len(buffers), cost, get_max_buffer_nbytes(buffers, blocks_shape, boundaries, itemsize)
+
+
+def estimate_clustered(R, I, O, itemsize, layout, buffer_size, nb_buffers, cost_model):
+    budget = buffer_size // nb_buffers
+    reads = estimate_reads(R, I, itemsize, layout, budget, cost_model)
+    if reads is None:
+        return None
+    name, nb_read_buffers, read_cost, read_nbytes = reads
+    write_cost, write_nbytes = estimate_writes(R, I, O, itemsize, budget, cost_model)
+    peak_memory = nb_buffers * read_nbytes + write_nbytes
+    return get_estimate('clustered', buffer_size, read_cost, write_cost, peak_memory, {'strategy': name, 'buffers': nb_read_buffers})
+
+
+def estimate_keep(R, I, O, dtype, layout, buffer_size, nb_buffers, cost_model):
+    """ Estimate the keep algorithm as applied by optimizer.keep_algorithm: 
+    the reads are in the buffers of the plan, within the memory left by the kept volumes and the output file written.
+    None if the keep algorithm does not apply (see keep.plan_keep).
+    """
+    if len(R) != 3 or any(r % o for r, o in zip(R, O)):
+        return None
+    itemsize = np.dtype(dtype).itemsize
+    plan = plan_keep(R, I, O, dtype, buffer_size, nb_buffers)
+    if plan is None:
+        return None
+    B, volumestokeep, kept_nbytes, regions_dict = plan
+    reserved = kept_nbytes + math.prod(O) * itemsize
+
+    with dask.config.set({'io-optimizer.box_shape': get_buffer_box(B, I)}):
+        reads = estimate_reads(R, I, itemsize, layout, (buffer_size - reserved) // nb_buffers, cost_model)
+    if reads is None:
+        return None
+    name, nb_read_buffers, read_cost, read_nbytes = reads
+    write_cost = {k: 0 for k in COST_KEYS}
+    for regions in regions_dict.values():
+        write_cost = add_costs(write_cost, get_boxes_cost(regions, O, itemsize, cost_model=cost_model))
+    peak_memory = nb_buffers * read_nbytes + reserved
+    return get_estimate('keep', buffer_size, read_cost, write_cost, peak_memory, 
+                        {'B': B, 'volumestokeep': volumestokeep, 'strategy': name, 'buffers': nb_read_buffers})
+
+
+def dry_run(R, I, O, dtype, buffer_sizes, chunks=None, nb_buffers=1, strategies=None, cost_model=None):
+    """ Estimate the I/O of the resplit of an array of shape R, in input blocks of shape I, into output files of shape O,
+    for each strategy and buffer size, without any read or write.
+
+    Arguments:
+    ----------
+        R: shape of the original array
+        I: shape of the input blocks (chunks of the dask array)
+        O: shape of the output files
+        dtype: data type of the arrays
+        buffer_sizes: list of memory sizes to evaluate, in bytes (see configure.enable_clustering)
+        chunks: physical chunks of the original array, None if stored contiguously in C order
+        nb_buffers: number of buffers in memory at the same time (concurrent and prefetched buffers)
+        strategies: strategies to evaluate, all of DRY_RUN_STRATEGIES if None
+        cost_model: (seek_time, bandwidth), read from the configuration if None
+
+    Returns:
+    --------
+        estimates: list of dictionaries with the strategy, buffer size, numbers of read and write calls,
+            bytes read and written, seeks, peak memory of the buffers and kept data, cost in seconds and plan
+        recommended: the estimate of lowest cost whose peak memory fits into its buffer size
+    """
+    strategies = strategies if strategies is not None else DRY_RUN_STRATEGIES
+    cost_model = cost_model if cost_model else get_cost_model()
+    itemsize = np.dtype(dtype).itemsize
+    layout = {'chunks': tuple(chunks) if chunks else None, 'order': 'C', 'contiguous': chunks is None}
+
+    estimates = list()
+    if 'none' in strategies:
+        estimates.append(estimate_none(R, I, O, itemsize, layout, nb_buffers, cost_model))
+    for buffer_size in buffer_sizes:
+        if 'clustered' in strategies:
+            estimates.append(estimate_clustered(R, I, O, itemsize, layout, buffer_size, nb_buffers, cost_model))
+        if 'keep' in strategies:
+            estimates.append(estimate_keep(R, I, O, dtype, layout, buffer_size, nb_buffers, cost_model))
+    estimates = [e for e in estimates if e is not None]
+
+    fitting = [e for e in estimates if e['buffer_size'] is None or e['peak_memory'] <= e['buffer_size']]
+    recommended = min(fitting, key=lambda e: (e['cost'], e['read_calls'] + e['write_calls'], e['peak_memory']), default=None)
+    for e in estimates:
+        logger.info("%s, buffer size %s: %s read calls, %s write calls, %s seeks, peak memory %s, cost %.3fs",
+                    e['strategy'], e['buffer_size'], e['read_calls'], e['write_calls'], e['seeks'], e['peak_memory'], e['cost'])
+    return estimates, recommended
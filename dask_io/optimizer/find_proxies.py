@@ -5,10 +5,13 @@ import numpy as np
 import datetime
 import logging
 
-from collections import Hashable
+from collections.abc import Hashable, Mapping
 
 from dask_io.optimizer.utils.utils import add_to_dict_of_lists, flatten_iterable
 from dask_io.optimizer.utils.array_utils import get_array_block_dims
+from dask_io.optimizer.graph_dump import dump_graph
+from dask_io.optimizer.stats import timer, incr
+from dask_io.optimizer.sources import is_source, get_layout
 
 logger = logging.getLogger(__name__)
 
@@ -21,13 +24,20 @@ logger = logging.getLogger(__name__)
     standard BFS: 
         A standard breadth first search algorithm to find the different trees in the graph.
 
+    get_reachable_nodes:
+        A breadth first search from all the root nodes at once, to find the nodes used by the graph.
+
     get_graph_from_dask: 
         Convert a dask graph (output of array.dask.dicts) 
         into a graph in mathematical format i.e. a dictionary mapping 
         each node with its dependencies.
 
     search_dask_graph:
-        Search proxies in the remade graph and fill in dictionaries to store information.
+        Search original arrays and proxies in the dask graph in one traversal, 
+        collecting the tasks dependencies on the way to find the used proxies.
+
+    standard_BFS, get_root_nodes and get_graph_from_dask are not used by get_used_proxies anymore, 
+    they are kept as graph utilities.
 """
 
 def standard_BFS(root, graph):
@@ -38,33 +48,67 @@ def standard_BFS(root, graph):
         visited: list of graph nodes reachable from root
         max_depth: the maximum depth reached during the process i.e. the depth of the tree.
     """
-    nodes = list(graph.keys())
-    queue = [(root, 0)]
+    queue = collections.deque([(root, 0)])
     visited = [root]
+    seen = {root}
 
     max_depth = 0
-    while len(queue) > 0:
-        node, depth = queue.pop(0)
+    while queue:
+        node, depth = queue.popleft()
 
         if depth > max_depth:
             max_depth = depth
 
         try:  # we want to stop digging when node is a value i.e. a leaf
-            hash(node)
             if not node in graph:  
                 continue
-        except:
+        except TypeError:
             continue
 
-        neighbors = graph[node]
-        for n in neighbors:
-            if not n in visited:
-                queue.append((n, depth + 1))
-                visited.append(n)
+        for n in graph[node]:
+            try:
+                if n in seen:
+                    continue
+                seen.add(n)
+            except TypeError:  # unhashable values are leaves
+                if n in visited:
+                    continue
+            queue.append((n, depth + 1))
+            visited.append(n)
     
     return visited, max_depth
 
 
+def get_reachable_nodes(roots, graph):
+    """ Find all the nodes reachable from a list of roots in one sweep.
+    Equivalent to the union of the standard_BFS outputs of all roots, computed in linear time.
+
+    return: 
+    -------
+        reachable: set of graph nodes reachable from at least one root
+    """
+    reachable = set(roots)
+    queue = collections.deque(roots)
+    while queue:
+        node = queue.popleft()
+        try:  # leaves are not keys of the graph
+            neighbors = graph.get(node)
+        except TypeError:
+            continue
+        if not neighbors:
+            continue
+
+        for n in neighbors:
+            try:
+                if n in reachable:
+                    continue
+                reachable.add(n)
+            except TypeError:  # unhashable values are leaves
+                continue
+            queue.append(n)
+    return reachable
+
+
 def is_task(v):
     if isinstance(v, tuple) and callable(v[0]):
         return True 
@@ -79,6 +123,18 @@ def get_graph_from_dask(graph, undirected=False):
     each key is mapped to a list of values (other keys used by this key as input)
     """
 
+    def add_edge(d, key, value):
+        """ Add value to the list of key in O(1) using the edges index to ensure unicity.
+        """
+        try:
+            if (key, value) in edges:
+                return
+            edges.add((key, value))
+        except TypeError:  # unhashable value, fallback on list scan
+            add_to_dict_of_lists(d, key, value, unique=True)
+            return
+        add_to_dict_of_lists(d, key, value)
+
     def add_to_remade_graph(d, key, value, undir):
         """
         arg: 
@@ -90,10 +146,11 @@ def get_graph_from_dask(graph, undirected=False):
         except:
             pass
 
-        d = add_to_dict_of_lists(d, key, value, unique=True)
+        add_edge(d, key, value)
         if undir:
-            d = add_to_dict_of_lists(d, value, key, unique=True)
+            add_edge(d, value, key)
 
+    edges = set()  # index of the (key, value) pairs already in remade_graph
     remade_graph = dict()
     for key, v in graph.items():  
         # if it is a subgraph, recurse
@@ -115,11 +172,11 @@ def get_graph_from_dask(graph, undirected=False):
                     for e in l:
                         if isinstance(e, tuple):
                             pass 
-                        if isinstance(key, collections.Hashable) and isinstance(e, collections.Hashable):                 
+                        if isinstance(key, Hashable) and isinstance(e, Hashable):                 
                             add_to_remade_graph(remade_graph, key, e, undirected)
                     continue
 
-                if isinstance(key, collections.Hashable) and isinstance(arg, collections.Hashable):   
+                if isinstance(key, Hashable) and isinstance(arg, Hashable):   
                     add_to_remade_graph(remade_graph, key, arg, undirected)
 
         # if it is an argument, add it
@@ -134,155 +191,285 @@ def get_graph_from_dask(graph, undirected=False):
     return remade_graph
 
 
-#TODO : refactor
+def get_dependencies(value, dependencies=None):
+    """ Find the keys a value of the dask graph may depend on, i.e. the hashable 
+    arguments of the task, of its nested tasks and of the lists it contains.
+    Values that are not keys are kept: they are leaves of the graph.
+    """
+    if dependencies is None:
+        dependencies = list()
+
+    if is_task(value):
+        for arg in value[1:]:
+            get_dependencies(arg, dependencies)
+    elif isinstance(value, list):
+        for e in value:
+            get_dependencies(e, dependencies)
+    elif isinstance(value, tuple) and value and all([isinstance(s, slice) for s in value]):
+        return dependencies  # do not treat slices
+    else:
+        try:  # keys are hashable
+            hash(value)
+        except TypeError:
+            return dependencies
+        dependencies.append(value)
+    return dependencies
+
+
+def is_proxy(v):
+    """ A proxy is a task of the form (getter, original array name, tuple of slices[, asarray, lock]).
+    The target of the task still has to be checked to be an original array.
+    """
+    if not is_task(v) or len(v) < 3:
+        return False
+    target, slices = v[1], v[2]
+    return (isinstance(target, str) 
+            and isinstance(slices, tuple) 
+            and all([isinstance(s, slice) for s in slices]))
+
+
 def search_dask_graph(graph, 
-    main_components,
     proxy_to_slices,
-    origarr_to_used_proxies,
+    proxy_to_origarr,
     origarr_to_obj,
-    origarr_to_blocks_shape,
     proxy_to_dict,
-    unused_keys):
-    """ Search proxies in the remade graph and fill in dictionaries to store information.
-    """
+    dependencies=None):
+    """ Search original arrays and proxies in the dask graph in one traversal and fill in dictionaries to store information.
 
+    Arguments:
+    ----------
+        dependencies: if not None, dictionary filled with the keys each task (but proxies) may depend on. 
+            Used to find the proxies that are reachable from the output keys.
+
+    Returns:
+    --------
+        nb_tasks: number of tasks scanned
+    """
+    nb_tasks = 0
     for key, v in graph.items():  
 
         # if it is a subgraph, recurse
-        if isinstance(v, dict):
-            search_dask_graph(v, main_components,
-            proxy_to_slices,
-            origarr_to_used_proxies,
-            origarr_to_obj,
-            origarr_to_blocks_shape,
-            proxy_to_dict,
-            unused_keys)
+        if isinstance(v, Mapping):
+            nb_tasks += search_dask_graph(v, 
+                              proxy_to_slices,
+                              proxy_to_origarr,
+                              origarr_to_obj,
+                              proxy_to_dict,
+                              dependencies)
+            continue
+
+        nb_tasks += 1
 
         # if it is an original array, store it
-        elif isinstance(key, str) and "array-original" in key: # TODO: support other formats
-            obj = v
-            origarr_to_obj[key] = obj
-            if not obj.shape:
+        if isinstance(key, str) and is_source(key, v):
+            origarr_to_obj[key] = v
+            if not v.shape:
                 raise ValueError("Empty dataset!")
-            continue
 
-        # if it is a task, add its arguments
-        elif is_task(v) and (key not in unused_keys): 
-            if main_components:
-                used_key = False
-                for main_comp in main_components:
-                    if key in main_comp:
-                        used_key = True 
-            else:
-                used_key = True
-
-            if used_key:
-                try:
-                    f, target, slices = v
-                    # search for values that are array-original, meaning that key is proxy 
-                    if "array-original" in target and all([isinstance(s, slice) for s in slices]):
-                        add_to_dict_of_lists(origarr_to_used_proxies, target, key, unique=True)
-                        proxy_to_slices[key] = slices
-                        proxy_to_dict[key] = graph
-                        continue
-                except:
-                    pass
-        else:
-            pass
+        # if it may be a proxy, store it (see remove_false_proxies)
+        elif is_proxy(v):
+            target, slices = v[1], v[2]
+            proxy_to_slices[key] = slices
+            proxy_to_origarr[key] = target
+            proxy_to_dict[key] = graph
+            if dependencies is not None:
+                dependencies[key] = [target]
 
-    return 
+        elif dependencies is not None:
+            dependencies[key] = get_dependencies(v)
+
+    return nb_tasks
+
+
+def remove_false_proxies(proxy_to_slices, proxy_to_origarr, proxy_to_dict, origarr_to_obj):
+    """ Remove the proxies found by search_dask_graph that do not read from an original array.
+    """
+    for proxy in [k for k, target in proxy_to_origarr.items() if target not in origarr_to_obj]:
+        del proxy_to_slices[proxy]
+        del proxy_to_origarr[proxy]
+        del proxy_to_dict[proxy]
 
 
 def get_root_nodes(remade_graph):
     """ Find keys in the graph that are not used as values by another(other) key(s).
     Some of those keys are root nodes of the graph. 
     """
-    keys = list(remade_graph.keys())
-    vals = list(remade_graph.values())
-    flatten = list()
-
-    # flatten the values which is a list of lists 
-    # because get_graph_from_dask which is using add_to_dict_of_lists
-    for l in vals:
+    used_as_value = set()
+    for l in remade_graph.values():
         for e in l:
-            flatten.append(e)
-
-    # do the actual job
-    root_nodes = list()
-    for key in keys:
-        if key not in flatten:
-            root_nodes.append(key)
+            try:
+                used_as_value.add(e)
+            except TypeError:  # unhashable values cannot be keys
+                pass
 
-    return root_nodes
+    return [key for key in remade_graph.keys() if key not in used_as_value]
 
 
-def get_chunk_shape(proxy_to_slices, origarr_to_obj, origarr_to_blocks_shape):
-    first_key = list(proxy_to_slices.keys())[0]
-    sample_slices = proxy_to_slices[first_key]   
-    chunk_shape = list()
-    for s in sample_slices:
-        start = s.start
-        stop = s.stop
-        chunk_shape.append(stop - start)
-    chunk_shape = tuple(chunk_shape)
+def get_blocks_boundaries(proxy_to_slices, proxy_to_origarr, origarr_to_obj):
+    """ Find the boundaries of the blocks of each original array along each axis, using the slices of all its proxies.
+    Supports irregular chunks and partial edge blocks.
 
-    # create the new dictionary (to be replaced)
+    Returns:
+    --------
+        origarr_to_boundaries: original array name -> tuple of sorted lists of boundaries (one list per axis), 
+            from 0 to the length of the original array along the axis
+    """
+    origarr_to_boundaries = dict()
+    for proxy, slices in proxy_to_slices.items():
+        origarr_name = proxy_to_origarr[proxy]
+        if origarr_name not in origarr_to_boundaries:
+            shape = origarr_to_obj[origarr_name].shape
+            origarr_to_boundaries[origarr_name] = [{0, length} for length in shape]
+        for axis_boundaries, s in zip(origarr_to_boundaries[origarr_name], slices):
+            axis_boundaries.add(s.start)
+            axis_boundaries.add(s.stop)
+
+    return {origarr_name: tuple([sorted(b) for b in boundaries]) 
+            for origarr_name, boundaries in origarr_to_boundaries.items()}
+
+
+def get_chunk_shape(origarr_to_boundaries):
+    """ Get the chunk shape and the number of blocks per axis of each original array from the blocks boundaries.
+    For irregular chunks, the chunk shape is the shape of the biggest block along each axis.
+
+    Returns:
+    --------
+        chunk_shape: chunk shape of the first original array
+        origarr_to_blocks_shape: original array name -> number of blocks per axis
+        origarr_to_chunk_shape: original array name -> chunk shape
+    """
     origarr_to_blocks_shape = dict()
-    for key, obj in origarr_to_obj.items():
-        logger.debug("Supposed to be original array: %s -> %s", key, obj)
-        blocks_dims = get_array_block_dims(obj.shape, chunk_shape)
+    origarr_to_chunk_shape = dict()
+    for key, boundaries in origarr_to_boundaries.items():
+        origarr_to_chunk_shape[key] = tuple([max([b - a for a, b in zip(l[:-1], l[1:])], default=0) for l in boundaries])
+
+        blocks_dims = tuple([len(l) - 1 for l in boundaries])
         logger.debug('Found following block dimensions: %s', blocks_dims)
         origarr_to_blocks_shape[key] = blocks_dims 
 
-    return chunk_shape, origarr_to_blocks_shape
+    chunk_shape = next(iter(origarr_to_chunk_shape.values()), None)
+    return chunk_shape, origarr_to_blocks_shape, origarr_to_chunk_shape
 
 
-def get_used_proxies(graph):
+def get_used_proxies(graph, keys=None):
     """ Find the proxies that are used by other tasks in the task graph.
     We call ``proxy" a task that uses ``getitem" directly on the ``original-array".
+
+    Arguments:
+    ----------
+        graph: dask graph (array.dask.dicts)
+        keys: output keys of the graph. If None, all proxies are considered used.
     """
-    unused_keys = list()
     proxy_to_slices = dict()
-    origarr_to_used_proxies = dict()
+    proxy_to_origarr = dict()
     origarr_to_obj = dict()
-    origarr_to_blocks_shape = dict()
     proxy_to_dict = dict()
+    dependencies = dict() if keys else None
+
+    dump_graph(graph, 'input_graph')
+
+    logger.info("Searching proxies in dask low-level graph")
+    with timer('proxy_search'):
+        nb_tasks = search_dask_graph(graph,
+                                     proxy_to_slices,
+                                     proxy_to_origarr,
+                                     origarr_to_obj,
+                                     proxy_to_dict,
+                                     dependencies)
+        remove_false_proxies(proxy_to_slices, proxy_to_origarr, proxy_to_dict, origarr_to_obj)
+    incr('tasks_scanned', nb_tasks)
+    origarr_to_boundaries = get_blocks_boundaries(proxy_to_slices, proxy_to_origarr, origarr_to_obj)
+
+    if keys:
+        with timer('reachability'):
+            used_nodes = get_reachable_nodes(flatten_iterable(keys), dependencies)
+            del dependencies
+            for proxy in [k for k in proxy_to_slices.keys() if k not in used_nodes]:
+                del proxy_to_slices[proxy]
+                del proxy_to_dict[proxy]
+            del used_nodes
+    incr('proxies_found', len(proxy_to_slices))
 
-    logger.info("Computing simpler graph from dask low-level graph")
-    remade_graph = get_graph_from_dask(graph, undirected=False)
-    
-    log_file_path = os.path.join('/tmp', 'dask_io_input_graph.log')
-    logger.info('Input graph log can be found at %s', log_file_path)
-    with open(log_file_path, "w+") as f:
-        for k, v in graph.items():    
-            f.write("\n\n " + str(k))
-            f.write("\n" + str(v))
-
-    all_nodes = list()
-    for root in get_root_nodes(remade_graph):
-        nodes_used_list, depth = standard_BFS(root, remade_graph)
-        all_nodes.append(nodes_used_list)
-
-    search_dask_graph(graph, all_nodes,
-                      proxy_to_slices,
-                      origarr_to_used_proxies,
-                      origarr_to_obj,
-                      origarr_to_blocks_shape,
-                      proxy_to_dict,
-                      unused_keys)
+    origarr_to_used_proxies = dict()
+    for proxy in proxy_to_slices.keys():
+        add_to_dict_of_lists(origarr_to_used_proxies, proxy_to_origarr[proxy], proxy)
+    del proxy_to_origarr
     
     if not len(list(proxy_to_slices.keys())) > 0:
         return None, None
     else:
-        chunk_shape, origarr_to_blocks_shape = get_chunk_shape(
-            proxy_to_slices, 
-            origarr_to_obj, 
-            origarr_to_blocks_shape)
+        chunk_shape, origarr_to_blocks_shape, origarr_to_chunk_shape = get_chunk_shape(origarr_to_boundaries)
 
     return chunk_shape, {
         'proxy_to_slices': proxy_to_slices, 
         'origarr_to_used_proxies': origarr_to_used_proxies,
         'origarr_to_obj': origarr_to_obj,
         'origarr_to_blocks_shape': origarr_to_blocks_shape,
+        'origarr_to_boundaries': origarr_to_boundaries,
+        'origarr_to_chunk_shape': origarr_to_chunk_shape,
+        'origarr_to_layout': {name: get_layout(origarr_to_obj[name]) for name in origarr_to_used_proxies.keys()},
         'proxy_to_dict': proxy_to_dict
-    }
\ No newline at end of file
+    }
+
+
+def get_reachable_layers(hlg, keys):
+    """ Find the layers of a HighLevelGraph the output keys depend on, using the layers dependencies.
+    If the layer of an output key cannot be found from its name, all layers are returned.
+    """
+    roots = list()
+    for key in flatten_iterable(keys):
+        name = key[0] if isinstance(key, tuple) else key
+        if name not in hlg.dependencies:
+            return set(hlg.dependencies.keys())
+        roots.append(name)
+    return get_reachable_nodes(roots, hlg.dependencies)
+
+
+def get_origarr_layers(hlg, keys=None):
+    """ Find the layers of a HighLevelGraph that contain or consume original arrays 
+    without materializing the other layers.
+
+    An original array is searched in a layer using the names given by dask.array.from_array:
+    layer "array-<token>" containing key "array-original-<token>", layer named "array-original-<token>" 
+    or layer "<name>" containing key "<name>" for custom names.
+
+    Arguments:
+    ----------
+        hlg: HighLevelGraph
+        keys: output keys of the graph. If not None, only layers the keys depend on are considered.
+
+    Returns:
+    --------
+        origarr_to_layer: dictionary mapping each original array name to the name of the layer containing it
+        consumer_layers: set of the names of the layers containing proxies
+    """
+    layers = hlg.layers
+    candidates = get_reachable_layers(hlg, keys) if keys else set(layers.keys())
+
+    origarr_to_layer = dict()
+    for name in candidates:
+        if not isinstance(name, str):
+            continue
+        if "array-original" in name:
+            origarr_to_layer[name] = name
+            continue
+        if not isinstance(layers[name], dict):
+            continue
+        origarr_names = [name]
+        if name.startswith("array-"):
+            origarr_names.append("array-original-" + name[len("array-"):])
+        for origarr_name in origarr_names:
+            if origarr_name in layers[name] and is_source(origarr_name, layers[name][origarr_name]):
+                origarr_to_layer[origarr_name] = name
+
+    origarr_layers = set(origarr_to_layer.values())
+    consumer_layers = set()
+    for name in candidates:
+        if not isinstance(layers[name], dict):
+            continue  # Blockwise and other lazy layers do not contain proxies
+        if name in origarr_layers and (not name in origarr_to_layer or len(layers[name]) > 1):
+            consumer_layers.add(name)  # "array-<token>" and custom-named layers contain the proxies
+        elif hlg.dependencies.get(name, set()) & origarr_layers:
+            consumer_layers.add(name)
+
+    return origarr_to_layer, consumer_layers
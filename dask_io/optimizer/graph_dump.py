@@ -0,0 +1,130 @@
+import os
+import json
+import queue
+import atexit
+import threading
+import logging
+
+import dask
+
+logger = logging.getLogger(__name__)
+
+
+"""
+    Debug facility to dump dask graphs into files.
+    Disabled by default. It is enabled by setting the ``io-optimizer.graph_dump" configuration (see configure.enable_graph_dump):
+        directory: directory where to write the dump files
+        format: "jsonl" for one json object {"key": ..., "task": ...} per line, "text" for the legacy text format
+        every: dump one task every k tasks
+        max_tasks: maximum number of tasks to dump, None for no limit
+
+    The conversion of the tasks to strings and the writes are done by a background thread.
+"""
+
+FORMATS = {'jsonl': '.jsonl', 'text': '.log'}
+DUMP_QUEUE = queue.Queue()
+WRITER = None
+WRITER_LOCK = threading.Lock()
+
+
+def get_dump_config():
+    """ Return the graph dump configuration with default values, or None if disabled.
+    """
+    config = dask.config.get("io-optimizer.graph_dump", None)
+    if not config:
+        return None
+
+    config = dict(config)
+    config.setdefault('directory', '/tmp')
+    config.setdefault('format', 'jsonl')
+    config.setdefault('every', 1)
+    config.setdefault('max_tasks', None)
+    if config['format'] not in FORMATS:
+        raise ValueError(f"Unsupported graph dump format: {config['format']}")
+    if config['every'] < 1:
+        raise ValueError("Graph dump sampling step must be >= 1.")
+    return config
+
+
+def iter_tasks(graph):
+    """ Iterate over the (key, value) pairs of a dask graph, recursing into the layers that are dictionaries.
+    Other layers (Blockwise...) are not materialized and are yielded as a single pair.
+    """
+    for k, v in graph.items():
+        if isinstance(v, dict):
+            yield from iter_tasks(v)
+        else:
+            yield k, v
+
+
+def sample_tasks(graph, every=1, max_tasks=None):
+    """ Select one task every ``every" tasks, stopping after max_tasks tasks.
+    """
+    sample = list()
+    for i, (k, v) in enumerate(iter_tasks(graph)):
+        if max_tasks is not None and len(sample) >= max_tasks:
+            break
+        if i % every == 0:
+            sample.append((k, v))
+    return sample
+
+
+def write_dump(file_path, fmt, tasks):
+    with open(file_path, "w+") as f:
+        for k, v in tasks:
+            if fmt == 'jsonl':
+                f.write(json.dumps({'key': str(k), 'task': str(v)}) + "\n")
+            else:
+                f.write("\n\n " + str(k))
+                f.write("\n" + str(v))
+
+
+def writer_loop():
+    while True:
+        file_path, fmt, tasks = DUMP_QUEUE.get()
+        try:
+            write_dump(file_path, fmt, tasks)
+        except Exception:
+            logger.exception("Failed to write graph dump at %s", file_path)
+        finally:
+            DUMP_QUEUE.task_done()
+
+
+def start_writer():
+    global WRITER
+    with WRITER_LOCK:
+        if WRITER is None or not WRITER.is_alive():
+            WRITER = threading.Thread(target=writer_loop, name="dask_io-graph-dump", daemon=True)
+            WRITER.start()
+
+
+@atexit.register
+def flush():
+    """ Wait for the pending graph dumps to be written.
+    """
+    if WRITER is not None and WRITER.is_alive():
+        DUMP_QUEUE.join()
+
+
+def dump_graph(graph, name):
+    """ Dump a dask graph in background if enabled in the configuration. Does nothing otherwise.
+
+    Arguments:
+    ----------
+        graph: dask graph (array.dask.dicts)
+        name: name of the dump, used to create the file name
+
+    Returns:
+    --------
+        path of the dump file or None if graph dump is disabled
+    """
+    config = get_dump_config()
+    if not config:
+        return None
+
+    file_path = os.path.join(config['directory'], 'dask_io_' + name + FORMATS[config['format']])
+    tasks = sample_tasks(graph, config['every'], config['max_tasks'])
+    start_writer()
+    DUMP_QUEUE.put((file_path, config['format'], tasks))
+    logger.info('Graph dump %s will be written at %s', name, file_path)
+    return file_path
@@ -0,0 +1,399 @@
+import sys
+import math
+import threading
+import itertools
+import logging
+import collections
+from operator import getitem
+
+import numpy as np
+import dask
+
+from dask_io.optimizer.sources import get_source_id, read_into
+
+logger = logging.getLogger(__name__)
+
+
+"""
+    Tasks loading the buffers of the original arrays.
+
+    The buffers can be kept in memory between computations, in a LRU cache bounded in bytes,
+    so that graphs reading the same parts of a dataset several times (parameter sweeps, repeated computations)
+    read them from disk only once. The cache is keyed by the identifier of the data on disk (see sources.get_source_id)
+    and the slices of the buffers. A buffer included in a cached buffer is served by slicing the cached buffer.
+    A buffer overlapping cached buffers is assembled from their parts, only its missing parts being read from disk.
+    The cache assumes that the files are not modified between computations, see clear_buffer_cache.
+
+    The buffers can also be read into arrays of a pool of preallocated arenas (see sources.read_into, 
+    which uses Dataset.read_direct for HDF5 datasets), instead of allocating a new array for each buffer.
+    An arena is reused once no array refers to it anymore, i.e. when the buffer and all the views 
+    of its proxies have been released.
+
+    Configuration:
+    --------------
+        io-optimizer.buffer_cache_size: maximum number of bytes of the cache, 0 (default) to disable it
+        io-optimizer.buffer_pool_size: maximum number of bytes of the pool, 0 (default) to disable it
+"""
+
+
+class BufferCache():
+    """ LRU cache of the buffers loaded, bounded in bytes, indexed by source.
+    """
+    def __init__(self, maxbytes=0):
+        self.lock = threading.Lock()
+        self.maxbytes = maxbytes
+        self.buffers = collections.OrderedDict()
+        self.source_to_keys = dict()
+        self.nbytes = 0
+        self.hits = 0
+        self.partial_hits = 0
+        self.misses = 0
+        self.bytes_hit = 0
+        self.bytes_missed = 0
+
+    def get(self, source_id, buffer_slices, read=None, empty=np.empty):
+        """ Return the data of buffer_slices from the cached buffers, updating the counters.
+
+        Arguments:
+        ----------
+            source_id: identifier of the data on disk (see sources.get_source_id)
+            buffer_slices: tuple of slices with start and stop
+            read: function reading a tuple of slices from disk, None to only serve buffers included in a cached buffer
+            empty: function allocating an array from its shape and dtype
+
+        Returns:
+        --------
+            a view of a cached buffer containing buffer_slices if any. 
+            Else, if read is given: an array of the cached parts of buffer_slices and of the missing parts read,
+            or the data read if no part is cached. None otherwise.
+        """
+        bounds = get_bounds(buffer_slices)
+        with self.lock:
+            overlapping = list()
+            for key in self.source_to_keys.get(source_id, ()):
+                cached_bounds = key[1]
+                if contains(cached_bounds, bounds):
+                    self.buffers.move_to_end(key)
+                    self.hits += 1
+                    result = self.buffers[key][get_relative_slices(bounds, cached_bounds)]
+                    self.bytes_hit += result.nbytes
+                    return result
+                intersection = get_box_intersection(bounds, cached_bounds)
+                if intersection is not None:
+                    overlapping.append((intersection, key))
+            if not overlapping or read is None:
+                self.misses += 1
+                if read is None:
+                    return None
+                parts = list()
+            else:
+                self.partial_hits += 1
+                overlapping = sorted(overlapping, key=lambda part: get_box_size(part[0]), reverse=True)[:MAX_CACHED_PARTS]
+                for _, key in overlapping:
+                    self.buffers.move_to_end(key)
+                parts = [(intersection, self.buffers[key][get_relative_slices(intersection, key[1])]) 
+                         for intersection, key in overlapping]
+
+        if not parts:
+            data = read(buffer_slices)
+            with self.lock:
+                self.bytes_missed += data.nbytes
+            return data
+
+        # copy the cached parts and read the missing ones, outside the lock
+        data = empty(tuple(stop - start for start, stop in bounds), parts[0][1].dtype)
+        for part_bounds, part in parts:
+            data[get_relative_slices(part_bounds, bounds)] = part
+        bytes_missed = 0
+        for missing_bounds in get_missing_boxes(bounds, [part_bounds for part_bounds, _ in parts]):
+            missing = read(tuple(slice(start, stop) for start, stop in missing_bounds))
+            data[get_relative_slices(missing_bounds, bounds)] = missing
+            bytes_missed += missing.nbytes
+        with self.lock:
+            self.bytes_missed += bytes_missed
+            self.bytes_hit += data.nbytes - bytes_missed
+        return data
+
+    def put(self, source_id, buffer_slices, data):
+        """ Store a loaded buffer, evicting the least recently used ones. Buffers bigger than the cache are not stored.
+        """
+        with self.lock:
+            if data.nbytes > self.maxbytes:
+                return
+            key = (source_id, get_bounds(buffer_slices))
+            if key in self.buffers:
+                self.nbytes -= self.buffers.pop(key).nbytes
+            data.setflags(write=False)  # the cached data is shared between tasks
+            self.buffers[key] = data
+            self.source_to_keys.setdefault(source_id, set()).add(key)
+            self.nbytes += data.nbytes
+            self._evict()
+
+    def resize(self, maxbytes):
+        """ Set the maximum number of bytes, evicting the least recently used buffers.
+        """
+        with self.lock:
+            self.maxbytes = maxbytes
+            self._evict()
+
+    def _evict(self):
+        while self.nbytes > self.maxbytes:
+            key, data = self.buffers.popitem(last=False)
+            self.nbytes -= data.nbytes
+            keys = self.source_to_keys[key[0]]
+            keys.discard(key)
+            if not keys:
+                del self.source_to_keys[key[0]]
+
+    def clear(self):
+        with self.lock:
+            self.buffers.clear()
+            self.source_to_keys.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.partial_hits = 0
+            self.misses = 0
+            self.bytes_hit = 0
+            self.bytes_missed = 0
+
+    def info(self):
+        with self.lock:
+            return {'hits': self.hits, 'partial_hits': self.partial_hits, 'misses': self.misses,
+                    'bytes_hit': self.bytes_hit, 'bytes_missed': self.bytes_missed,
+                    'nbytes': self.nbytes, 'maxbytes': self.maxbytes, 'size': len(self.buffers)}
+
+
+class BufferPool():
+    """ Pool of arenas (flat arrays of bytes) in which the buffers are read, bounded in bytes.
+    """
+    def __init__(self, maxbytes=0):
+        self.lock = threading.Lock()
+        self.maxbytes = maxbytes
+        self.arenas = list()
+        self.nbytes = 0
+        self.allocations = 0
+        self.reuses = 0
+        self.unpooled = 0
+
+    def is_free(self, i):
+        """ Check if the arena i is only referenced by the pool: 
+        the list of arenas and the argument of getrefcount.
+        """
+        return sys.getrefcount(self.arenas[i]) <= 2
+
+    def empty(self, shape, dtype):
+        """ Return an uninitialized array of the given shape and dtype, using a free arena if possible.
+        """
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        with self.lock:
+            free = [i for i in range(len(self.arenas)) if self.is_free(i)]
+            fitting = [i for i in free if self.arenas[i].nbytes >= nbytes]
+            if fitting:
+                i = min(fitting, key=lambda i: self.arenas[i].nbytes)  # best fit
+                self.reuses += 1
+            else:
+                for j in sorted(free, reverse=True):  # make room by dropping the free arenas too small
+                    if self.nbytes + nbytes <= self.maxbytes:
+                        break
+                    self.nbytes -= self.arenas.pop(j).nbytes
+                if self.nbytes + nbytes > self.maxbytes:
+                    self.unpooled += 1
+                    return np.empty(shape, dtype)
+                self.arenas.append(np.empty(nbytes, dtype=np.uint8))
+                self.nbytes += nbytes
+                self.allocations += 1
+                i = len(self.arenas) - 1
+            return self.arenas[i][:nbytes].view(dtype).reshape(shape)
+
+    def resize(self, maxbytes):
+        """ Set the maximum number of bytes, dropping free arenas if needed.
+        """
+        with self.lock:
+            self.maxbytes = maxbytes
+            for i in reversed(range(len(self.arenas))):
+                if self.nbytes <= self.maxbytes:
+                    break
+                if self.is_free(i):
+                    self.nbytes -= self.arenas.pop(i).nbytes
+
+    def clear(self):
+        with self.lock:
+            self.arenas.clear()
+            self.nbytes = 0
+            self.allocations = 0
+            self.reuses = 0
+            self.unpooled = 0
+
+    def info(self):
+        with self.lock:
+            return {'allocations': self.allocations, 'reuses': self.reuses, 'unpooled': self.unpooled,
+                    'nbytes': self.nbytes, 'maxbytes': self.maxbytes, 'size': len(self.arenas)}
+
+
+MAX_CACHED_PARTS = 8  # maximum number of cached buffers assembled into one buffer
+BUFFER_CACHE = BufferCache()
+BUFFER_POOL = BufferPool()
+
+
+def get_bounds(buffer_slices):
+    """ Convert a tuple of slices into a hashable tuple of (start, stop).
+    """
+    return tuple((s.start, s.stop) for s in buffer_slices)
+
+
+def get_relative_slices(bounds, outer_bounds):
+    """ Slices of the box bounds in an array covering the box outer_bounds.
+    """
+    return tuple(slice(start - o_start, stop - o_start) for (start, stop), (o_start, _) in zip(bounds, outer_bounds))
+
+
+def get_box_size(bounds):
+    return math.prod(stop - start for start, stop in bounds)
+
+
+def get_box_intersection(bounds1, bounds2):
+    """ Intersection of two boxes given as tuples of (start, stop), None if they do not overlap.
+    """
+    if len(bounds1) != len(bounds2):
+        return None
+    intersection = tuple((max(start1, start2), min(stop1, stop2)) for (start1, stop1), (start2, stop2) in zip(bounds1, bounds2))
+    if any(start >= stop for start, stop in intersection):
+        return None
+    return intersection
+
+
+def merge_boxes(boxes):
+    """ Merge the adjacent boxes having the same extent on the other axes, axis by axis from the last one.
+    """
+    boxes = list(boxes)
+    for axis in reversed(range(len(boxes[0]) if boxes else 0)):
+        boxes.sort(key=lambda box: (box[:axis] + box[axis + 1:], box[axis]))
+        merged = list()
+        for box in boxes:
+            if merged and merged[-1][:axis] + merged[-1][axis + 1:] == box[:axis] + box[axis + 1:] and merged[-1][axis][1] == box[axis][0]:
+                merged[-1] = box[:axis] + ((merged[-1][axis][0], box[axis][1]),) + box[axis + 1:]
+            else:
+                merged.append(box)
+        boxes = merged
+    return boxes
+
+
+def get_missing_boxes(bounds, parts):
+    """ Get the parts of the box bounds not covered by the boxes parts (included in bounds), as a list of boxes.
+    The box is cut along the edges of the parts, and the cells not covered are merged (see merge_boxes).
+    """
+    cuts = [sorted(set([start, stop] + [part[axis][i] for part in parts for i in range(2)])) 
+            for axis, (start, stop) in enumerate(bounds)]
+    cells = itertools.product(*[list(zip(c[:-1], c[1:])) for c in cuts])
+    return merge_boxes(cell for cell in cells if not any(contains(part, cell) for part in parts))
+
+
+def contains(outer_bounds, inner_bounds):
+    """ Check if the box inner_bounds is included in the box outer_bounds, boxes given as tuples of (start, stop).
+    """
+    return len(outer_bounds) == len(inner_bounds) and all(
+        o_start <= i_start and i_stop <= o_stop for (o_start, o_stop), (i_start, i_stop) in zip(outer_bounds, inner_bounds))
+
+
+def get_buffer_cache_size():
+    return dask.config.get("io-optimizer.buffer_cache_size", None) or 0
+
+
+def get_buffer_pool_size():
+    return dask.config.get("io-optimizer.buffer_pool_size", None) or 0
+
+
+def use_load_buffer():
+    """ Check if the buffers have to be loaded using load_buffer instead of getitem.
+    """
+    return bool(get_buffer_cache_size() or get_buffer_pool_size())
+
+
+def get_buffer_cache():
+    return BUFFER_CACHE
+
+
+def clear_buffer_cache():
+    BUFFER_CACHE.clear()
+
+
+def get_buffer_pool():
+    return BUFFER_POOL
+
+
+def empty_buffer(shape, dtype):
+    """ Allocate an uninitialized buffer, in an arena of the buffer pool if enabled.
+    """
+    pool_size = get_buffer_pool_size()
+    if not pool_size:
+        return np.empty(shape, dtype=dtype)
+    BUFFER_POOL.resize(pool_size)
+    return BUFFER_POOL.empty(shape, dtype)
+
+
+def read_buffer(origarr, buffer_slices):
+    """ Read the part buffer_slices of an original array, into an arena of the buffer pool if enabled.
+    """
+    if not get_buffer_pool_size() or not hasattr(origarr, 'dtype'):
+        data = getitem(origarr, buffer_slices)
+        if isinstance(data, np.memmap):  # keep the data, not a view of the file
+            data = np.array(data)
+        return data
+
+    data = empty_buffer(tuple(s.stop - s.start for s in buffer_slices), origarr.dtype)
+    read_into(origarr, buffer_slices, data)
+    return data
+
+
+def load_buffer(origarr, buffer_slices):
+    """ Load the part buffer_slices of an original array, using the buffer cache and the buffer pool.
+    The parts of the buffer in the cache are copied from it, only the missing parts are read.
+
+    Arguments:
+    ----------
+        origarr: original array
+        buffer_slices: tuple of slices with start and stop
+    """
+    cache_size = get_buffer_cache_size()
+    source_id = get_source_id(origarr) if cache_size else None
+    if source_id is None:
+        return read_buffer(origarr, buffer_slices)
+
+    BUFFER_CACHE.resize(cache_size)
+    data = BUFFER_CACHE.get(source_id, buffer_slices, read=lambda slices: read_buffer(origarr, slices), empty=empty_buffer)
+    if data.flags.writeable:  # not a view of a cached buffer
+        BUFFER_CACHE.put(source_id, buffer_slices, data)
+    return data
+
+
+def write_buffer(out, buffer_slices, blocks_slices, blocks, lock):
+    """ Write blocks into the part buffer_slices of out with one write (see clustered_writes).
+
+    Arguments:
+    ----------
+        out: array written
+        buffer_slices: tuple of slices of out written
+        blocks_slices: list of the slices of each block in the buffer
+        blocks: list of the blocks to write
+        lock: lock to acquire during the write, or None/False
+    """
+    buffer = empty_buffer(tuple(s.stop - s.start for s in buffer_slices), out.dtype)
+    for block_slices, block in zip(blocks_slices, blocks):
+        buffer[block_slices] = block
+
+    if lock:
+        lock.acquire()
+    try:
+        out[buffer_slices] = buffer
+    finally:
+        if lock:
+            lock.release()
+    return None
+
+
+def keep_volume(block):
+    """ Copy a part of an output file kept in memory until its write (see keep), 
+    so that it does not keep its buffer in memory.
+    """
+    return np.array(block)
@@ -0,0 +1,359 @@
+import math
+import logging
+import itertools
+from operator import getitem
+
+import numpy as np
+
+from dask_io.optimizer.cases.resplit_case import compute_zones, get_main_volumes, get_theta
+from dask_io.optimizer.cases.resplit_utils import get_blocks_shape
+from dask_io.optimizer.clustered_writes import get_stores, get_regions_grid
+from dask_io.optimizer.find_proxies import get_used_proxies
+from dask_io.optimizer.io_tasks import write_buffer, keep_volume
+from dask_io.optimizer.rechunk_model import ALL_VOLUMES, choose_buffer_shape, get_cache_footprint
+from dask_io.optimizer.utils.utils import _3d_to_numeric_pos
+from dask_io.optimizer.stats import timer, incr
+
+logger = logging.getLogger(__name__)
+
+
+"""
+    Keep algorithm: resplit of an original array R into output files of shape O,
+    writing each output file in as few operations as possible.
+
+    R is read in buffers of shape B. The parts of the output files crossing several buffers
+    are kept in memory until the parts of the next buffers are loaded, and written together
+    (see cases.resplit_case.compute_zones). The volumes kept are numbered as in the paper:
+    volume 1 is kept until the next buffer along k, volumes 2 and 3 along j and volumes 4 to 7 along i.
+
+    The buffer shape and the volumes to keep are chosen so that the buffers (concurrent and prefetched),
+    the kept volumes and one output file fit in the memory available (see plan_keep).
+    The store tasks writing into each output file are then replaced by one write_buffer task per volume
+    of compute_zones. The parts of a volume read by a buffer before the last buffer of the volume are kept: 
+    they are copied (see io_tasks.keep_volume) so that they do not hold their buffers in memory, 
+    and counted in the memory limit of the scheduler.
+    The original array is then read in buffers of shape B, in C order (see get_buffer_box), 
+    so that the volumes are kept as planned.
+
+    Only 3-dimensional original arrays are supported, split into output files of the same shape
+    by slicing (stores whose sources are slices of the proxies of the original array).
+    The output files not written following compute_zones are left to the clustered writes.
+"""
+
+KEEP_CANDIDATES = (ALL_VOLUMES, [1, 2, 3], [1], [])  # see resplit_case.get_merge_rules
+
+
+def get_alias(tasks, task):
+    """ Return the key aliased by task, or None if task is not an alias.
+    """
+    try:
+        return task if task in tasks else None
+    except TypeError:  # unhashable task
+        return None
+
+
+def is_slicing_task(task):
+    return (isinstance(task, tuple)
+            and len(task) == 3
+            and task[0] is getitem
+            and isinstance(task[2], tuple)
+            and all(isinstance(s, slice) and s.step in [None, 1] for s in task[2]))
+
+
+def get_source_region(tasks, key, proxy_to_slices):
+    """ Get the part of the original array computed by the task at key,
+    following the aliases and the getitem tasks up to a proxy.
+
+    Arguments:
+    ----------
+        tasks: dask graph
+        key: key of the task
+        proxy_to_slices: slices of the proxies in their original array (see find_proxies.get_used_proxies)
+
+    Returns:
+    --------
+        (proxy, tuple of slices in the original array), None if the task is not a part of a proxy
+    """
+    slices_chain = list()
+    while not key in proxy_to_slices:
+        task = tasks.get(key)
+        alias = get_alias(tasks, task)
+        if alias is not None:
+            key = alias
+        elif is_slicing_task(task):
+            slices_chain.append(task[2])
+            key = task[1]
+        else:
+            return None
+
+    region = [(s.start, s.stop) for s in proxy_to_slices[key]]
+    for slices in reversed(slices_chain):
+        if len(slices) != len(region):
+            return None
+        region = [(start + (s.start or 0), start + s.stop if s.stop is not None else stop)
+                  for s, (start, stop) in zip(slices, region)]
+    return key, tuple(slice(start, stop) for start, stop in region)
+
+
+def get_outfiles(graph, dicts):
+    """ Find the output files of a graph of layers: the targets written by store tasks
+    whose sources are parts of the proxies of an original array.
+
+    Returns:
+    --------
+        list of dictionaries with the keys:
+            origarr_name: name of the original array written
+            position: position of the output file in the original array
+            target: array written
+            layer_name: layer of the store tasks
+            stores: list of (layer_name, key, task) of the store tasks
+            sources: slices of the original array written by each store task
+    """
+    tasks = dict()
+    for layer in graph.values():
+        if isinstance(layer, dict):
+            tasks.update(layer)
+
+    proxy_to_origarr = {proxy: origarr_name for origarr_name, proxies in dicts['origarr_to_used_proxies'].items()
+                        for proxy in proxies}
+    outfiles = list()
+    for (_, layer_name), stores in get_stores(graph).items():
+        target = stores[0][2][2]
+        regions = [task[3] for _, _, task in stores]
+        if len(target.shape) != 3 or get_regions_grid(regions) is None \
+            or sum(math.prod(s.stop - s.start for s in r) for r in regions) != math.prod(target.shape):
+            continue
+
+        origarr_names, positions, sources = set(), set(), list()
+        for _, _, task in stores:
+            source = get_source_region(tasks, task[1], dicts['proxy_to_slices'])
+            if source is None:
+                break
+            proxy, source_slices = source
+            if any(s.stop - s.start != r.stop - r.start for s, r in zip(source_slices, task[3])):
+                break
+            origarr_names.add(proxy_to_origarr[proxy])
+            positions.add(tuple(s.start - r.start for s, r in zip(source_slices, task[3])))
+            sources.append(source_slices)
+        else:
+            if len(origarr_names) == 1 and len(positions) == 1:
+                outfiles.append({
+                    'origarr_name': origarr_names.pop(),
+                    'position': positions.pop(),
+                    'target': target,
+                    'layer_name': layer_name,
+                    'stores': stores,
+                    'sources': sources})
+    return outfiles
+
+
+def is_valid_buffer_size(b, o, r):
+    """ Check if buffers of size b along an axis of size r fit the model of compute_zones with output files of size o:
+    the Theta of each buffer is between 0 and o (see resplit_case.get_theta), 
+    so that each volume of a buffer belongs to one output file.
+    """
+    return r % b == 0 and all(0 <= get_theta((n,), (b,), (o,))[0] <= o for n in range(r // b))
+
+
+def get_buffer_shapes(R, I, O):
+    """ Get the candidate buffer shapes, by decreasing size: shapes of whole input blocks I dividing R,
+    valid for compute_zones (see is_valid_buffer_size).
+    """
+    axes = list()
+    for r, i, o in zip(R, I, O):
+        sizes = [b for b in range(i, r + 1, i) if is_valid_buffer_size(b, o, r)]
+        if not sizes:
+            sizes = [b for b in range(1, r + 1) if is_valid_buffer_size(b, o, r)]
+        axes.append(sizes)
+    return sorted(itertools.product(*axes), key=lambda B: (math.prod(B), B), reverse=True)
+
+
+def get_buffer_box(B, I):
+    """ Get the shape of the buffers of shape B in input blocks of shape I, None if B is not made of whole blocks.
+    """
+    if any(b % i for b, i in zip(B, I)):
+        return None
+    return tuple(b // i for b, i in zip(B, I))
+
+
+def plan_keep(R, I, O, dtype, memory, nb_buffers=1):
+    """ Choose the volumes to keep and the buffer shape.
+    The most volumes are kept, with the biggest buffer such that the buffers,
+    the kept volumes (see rechunk_model.get_cache_footprint) and one output file fit into memory. 
+    The buffer shape of the model (see rechunk_model.choose_buffer_shape) is tried first.
+    The buffer shapes for which compute_zones fails are skipped.
+
+    Arguments:
+    ----------
+        R: shape of the original array
+        I: shape of its input blocks
+        O: shape of the output files
+        dtype: data type of the output files
+        memory: memory available in bytes
+        nb_buffers: number of buffers in memory at the same time
+
+    Returns:
+    --------
+        (B, volumestokeep, kept_nbytes, regions_dict), None if no plan fits into memory,
+        regions_dict mapping each output file to the regions written (see compute_zones)
+    """
+    itemsize = np.dtype(dtype).itemsize
+    outfile_nbytes = math.prod(O) * itemsize
+    buffer_shapes = get_buffer_shapes(R, I, O)
+    model_B, _ = choose_buffer_shape(R, I, O, max(memory - outfile_nbytes, 0) // nb_buffers, dtype)
+    if all(is_valid_buffer_size(b, o, r) for b, o, r in zip(model_B, O, R)):
+        buffer_shapes = [model_B] + [B for B in buffer_shapes if B != model_B]
+    for volumestokeep in KEEP_CANDIDATES:
+        for B in buffer_shapes:
+            buffers_nbytes = nb_buffers * math.prod(B) * itemsize
+            if buffers_nbytes + outfile_nbytes > memory:
+                continue
+            kept_nbytes = (get_cache_footprint(B, R, O, volumestokeep) - math.prod(B)) * itemsize
+            if buffers_nbytes + kept_nbytes + outfile_nbytes > memory:
+                continue
+            try:
+                _, regions_dict = compute_zones(B, O, R, volumestokeep)
+            except KeyError:  # a volume crossing several output files
+                logger.debug(f'Buffer shape {B} not supported by compute_zones')
+                buffer_shapes = [shape for shape in buffer_shapes if shape != B]
+                continue
+            return B, volumestokeep, kept_nbytes, regions_dict
+    return None
+
+
+def is_partition(regions, shape):
+    """ Check if regions (tuples of slices) partition an array of the given shape.
+    """
+    bounds = [[(s.start, s.stop) for s in region] for region in regions]
+    if any(start < 0 or stop > n or start >= stop for region in bounds for (start, stop), n in zip(region, shape)):
+        return False
+    if sum(math.prod(stop - start for start, stop in region) for region in bounds) != math.prod(shape):
+        return False
+    for region1, region2 in itertools.combinations(bounds, 2):
+        if all(start1 < stop2 and start2 < stop1 for (start1, stop1), (start2, stop2) in zip(region1, region2)):
+            return False
+    return True
+
+
+def get_intersection(slices1, slices2):
+    """ Intersection of two boxes as tuples of slices, None if they do not overlap.
+    """
+    intersection = tuple(slice(max(s1.start, s2.start), min(s1.stop, s2.stop)) for s1, s2 in zip(slices1, slices2))
+    if any(s.start >= s.stop for s in intersection):
+        return None
+    return intersection
+
+
+def get_kept_key(layer, source):
+    """ Add a task copying source to the layer, once (see io_tasks.keep_volume).
+    """
+    kept_key = (source[0] + '-kept',) + source[1:] if isinstance(source, tuple) else source + '-kept'
+    if not kept_key in layer:
+        layer[kept_key] = (keep_volume, source)
+    return kept_key
+
+
+def create_keep_nodes(graph, outfile, regions, B):
+    """ Replace the store tasks of an output file by one write_buffer task per region.
+    A store task becomes an alias of the write tasks writing its parts.
+    The parts read by a buffer before the last buffer of their region are copied (see get_kept_key).
+
+    Arguments:
+    ----------
+        graph: dictionary of layers
+        outfile: output file, see get_outfiles
+        regions: regions of the output file to write at a time, as tuples of slices
+        B: shape of the buffers reading the original array, in C order
+    """
+    layer_name, stores = outfile['layer_name'], outfile['stores']
+    graph[layer_name] = dict(graph[layer_name])
+    layer = graph[layer_name]
+    _, first_key, first_task = stores[0]
+    target, lock = first_task[2], first_task[4]
+
+    store_to_writes = {key: list() for _, key, _ in stores}
+    for i, region in enumerate(regions):
+        parts = list()
+        for (_, key, task), source_slices in zip(stores, outfile['sources']):
+            intersection = get_intersection(task[3], region)
+            if intersection is not None:
+                buffer_index = tuple((s.start + i.start - r.start) // b for s, i, r, b in zip(source_slices, intersection, task[3], B))
+                parts.append((key, task, intersection, buffer_index))
+        last_buffer = max(buffer_index for _, _, _, buffer_index in parts)
+
+        blocks_slices, blocks = list(), list()
+        for key, task, intersection, buffer_index in parts:
+            source = get_kept_key(layer, task[1]) if buffer_index < last_buffer else task[1]
+            if intersection != task[3]:
+                source = (getitem, source, tuple(slice(s.start - r.start, s.stop - r.start) for s, r in zip(intersection, task[3])))
+            blocks.append(source)
+            blocks_slices.append(tuple(slice(s.start - r.start, s.stop - r.start) for s, r in zip(intersection, region)))
+
+        write_key = (first_key[0] + '-merged', i)
+        layer[write_key] = (write_buffer, target, region, blocks_slices, blocks, lock)
+        for key, _, _, _ in parts:
+            store_to_writes[key].append(write_key)
+
+    for key, writes in store_to_writes.items():
+        layer[key] = writes[0] if len(writes) == 1 else writes
+    incr('write_buffers', len(regions))
+    incr('stores_merged', len(stores))
+
+
+def apply_keep(graph, keys=None, memory=None, nb_buffers=1):
+    """ Rewrite the store tasks of a graph of layers following the keep algorithm.
+    The layers modified are replaced by copies, so that the input layers are not modified.
+
+    Arguments:
+    ----------
+        graph: dictionary of layers
+        keys: output keys of the graph
+        memory: memory available in bytes
+        nb_buffers: number of buffers in memory at the same time
+
+    Returns:
+    --------
+        (number of bytes of memory reserved for the kept volumes and the output file written,
+        shape of the buffers to read in blocks, see get_buffer_box), 
+        (0, None) if the graph was not rewritten, None if no proxy was found
+    """
+    with timer('keep'):
+        chunk_shape, dicts = get_used_proxies(graph, keys)
+        if chunk_shape is None or dicts is None:
+            return None
+
+        outfiles = get_outfiles(graph, dicts)
+        origarr_names = set(outfile['origarr_name'] for outfile in outfiles)
+        shapes = set(tuple(outfile['target'].shape) for outfile in outfiles)
+        if len(origarr_names) != 1 or len(shapes) != 1:
+            logger.info("Keep algorithm needs output files of the same shape, from one original array. Stores not modified.")
+            return 0, None
+
+        origarr_name = origarr_names.pop()
+        R = tuple(dicts['origarr_to_obj'][origarr_name].shape)
+        I = tuple(dicts['origarr_to_chunk_shape'][origarr_name])
+        O = shapes.pop()
+        if len(R) != 3 or any(r % o != 0 for r, o in zip(R, O)):
+            logger.info("Output files do not split the original array into a grid. Stores not modified.")
+            return 0, None
+
+        dtype = max((np.dtype(outfile['target'].dtype) for outfile in outfiles), key=lambda dtype: dtype.itemsize)
+        itemsize = dtype.itemsize
+        plan = plan_keep(R, I, O, dtype, memory, nb_buffers)
+        if plan is None:
+            logger.info("No buffer shape fits into memory. Stores not modified.")
+            return 0, None
+        B, volumestokeep, kept_nbytes, regions_dict = plan
+        logger.info("Keep algorithm: buffer shape %s, volumes kept %s, kept bytes %s", B, volumestokeep, kept_nbytes)
+        box = get_buffer_box(B, I)
+        if box is None:
+            logger.warning(f"Buffer shape {B} not made of input blocks {I}, the kept volumes may exceed the memory available.")
+
+        outfiles_partition = get_blocks_shape(R, O)
+        for outfile in outfiles:
+            _3d_index = tuple(p // o for p, o in zip(outfile['position'], O))
+            regions = regions_dict.get(_3d_to_numeric_pos(_3d_index, outfiles_partition, order='F'))
+            if regions is None or any(p % o for p, o in zip(outfile['position'], O)) or not is_partition(regions, O):
+                continue
+            create_keep_nodes(graph, outfile, regions, B)
+    return kept_nbytes + math.prod(O) * itemsize, box
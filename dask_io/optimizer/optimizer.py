@@ -4,9 +4,20 @@ import math
 import time
 import datetime 
 import logging
+import collections
 
-from dask_io.optimizer.clustering import apply_clustered_strategy
-from dask_io.optimizer.find_proxies import get_used_proxies, get_array_block_dims
+import dask
+from dask.base import tokenize
+from dask.highlevelgraph import HighLevelGraph
+
+from dask_io.optimizer.clustering import apply_clustered_strategy, apply_plan, get_buffers_key, get_memory_budget, \
+    get_memory_available, get_concurrent_buffers, get_prefetch_depth
+from dask_io.optimizer.clustered_writes import apply_clustered_writes
+from dask_io.optimizer.find_proxies import get_used_proxies, get_array_block_dims, get_origarr_layers
+from dask_io.optimizer.graph_dump import dump_graph
+from dask_io.optimizer.io_tasks import use_load_buffer
+from dask_io.optimizer.keep import apply_keep
+from dask_io.optimizer.stats import start_stats, end_stats, timer, incr
 
 now = datetime.datetime.now()
 date_info = now.strftime("%c")
@@ -16,55 +27,246 @@ logfilename = "/tmp/dask_io_" + date_info + ".log"
 logger = logging.getLogger(__name__)
 
 
-def clustered_optimization(graph):
+class PlanCache():
+    """ LRU cache of the plans computed by the clustered strategy, 
+    to skip planning when computing graphs with the same structure.
+    """
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.plans = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ Return the plan stored at key or None, updating the counters.
+        """
+        if not key in self.plans:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.plans.move_to_end(key)
+        return self.plans[key]
+
+    def put(self, key, plan):
+        self.plans[key] = plan
+        self.plans.move_to_end(key)
+        self.resize(self.maxsize)
+
+    def resize(self, maxsize):
+        """ Set the maximum number of plans, evicting the least recently used ones.
+        """
+        self.maxsize = maxsize
+        while len(self.plans) > self.maxsize:
+            self.plans.popitem(last=False)
+
+    def clear(self):
+        self.plans.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.plans), 'maxsize': self.maxsize}
+
+
+PLAN_CACHE_SIZE = 32
+PLAN_CACHE = PlanCache(PLAN_CACHE_SIZE)
+
+
+def get_plan_key(dicts):
+    """ Tokenize the original arrays, the slices of their used proxies, their blocks boundaries and the configuration of the planner.
+    """
+    proxies = [(origarr_name, [(proxy, dicts['proxy_to_slices'][proxy]) for proxy in used_proxies]) 
+               for origarr_name, used_proxies in sorted(dicts['origarr_to_used_proxies'].items())]
+    shapes = [(name, tuple(obj.shape)) for name, obj in sorted(dicts['origarr_to_obj'].items())]
+    boundaries = sorted(dicts['origarr_to_boundaries'].items())
+    config = [get_memory_budget()] + [dask.config.get("io-optimizer." + k, None) for k in ['strategy', 'seek_time', 'read_bandwidth']] + [use_load_buffer()]
+    return tokenize(shapes, proxies, boundaries, config)
+
+
+def apply_cached_plan(graph, dicts, chunk_shape):
+    """ Apply the clustered strategy on the graph, reusing the plan from the cache if the same proxies have been optimized before.
+    The cache size is read from the ``io-optimizer.plan_cache_size" configuration, 0 disables the cache.
+    """
+    cache_size = dask.config.get("io-optimizer.plan_cache_size", PLAN_CACHE_SIZE)
+    if not cache_size:
+        return apply_clustered_strategy(graph, dicts, chunk_shape)
+    PLAN_CACHE.resize(cache_size)
+
+    key = get_plan_key(dicts)
+    plan = PLAN_CACHE.get(key)
+    if plan is None:
+        plan = apply_clustered_strategy(graph, dicts, chunk_shape)
+        PLAN_CACHE.put(key, plan)
+    else:
+        logger.info("Optimization plan found in cache, skipping planning.")
+        incr('plan_cache_hits')
+        with timer('update_io_tasks'):
+            apply_plan(graph, dicts, plan)
+    return plan
+
+
+def copy_proxy_layers(graph, dicts):
+    """ Replace the layers of the graph containing proxies by copies, 
+    so that rewriting the proxies does not modify the input graph.
+    """
+    layer_names = {id(layer): name for name, layer in graph.items() if isinstance(layer, dict)}
+    copies = dict()
+    for proxy, proxy_dict in dicts['proxy_to_dict'].items():
+        name = layer_names.get(id(proxy_dict))
+        if name is None:
+            continue
+        if not name in copies:
+            copies[name] = dict(proxy_dict)
+            graph[name] = copies[name]
+        dicts['proxy_to_dict'][proxy] = copies[name]
+
+
+def clustered_optimization(graph, keys=None):
     """ Applies clustered IO optimization on a Dask graph.
 
     Arguments:
     ----------
         graph : dark_array.dask.dicts
+        keys: output keys of the graph, used to find the proxies to optimize
     """
     logger.info(f"Configuration file is at {os.path.join(current_dir, 'logging_config.ini')}")
     logger.info("Log file: %s", logfilename)
     logger.info("Finding proxies.")
-    chunk_shape, dicts = get_used_proxies(graph)
+    chunk_shape, dicts = get_used_proxies(graph, keys)
 
     if chunk_shape == None or dicts == None:
         logger.error("Chunk shape or dicts = None. Aborting dask_io optimization.")
         raise ValueError()
 
     logger.info("Launching optimization algorithm.") 
-    apply_clustered_strategy(graph, dicts, chunk_shape)
+    copy_proxy_layers(graph, dicts)
+    apply_cached_plan(graph, dicts, chunk_shape)
+    apply_clustered_writes(graph)
     return graph
 
 
+def layer_aware_optimization(dsk, keys):
+    """ Applies clustered IO optimization on the layers of a HighLevelGraph that contain or consume original arrays.
+    Other layers are not materialized. The input graph is not modified.
+
+    The original arrays are moved into their own layers, and the buffers of each original array 
+    are emitted as a new layer depending on it, on which the layers containing the proxies depend.
+
+    Arguments:
+    ----------
+        dsk: HighLevelGraph
+        keys: output keys of the graph
+
+    Returns:
+    --------
+        a new HighLevelGraph
+    """
+    origarr_to_layer, consumer_layers = get_origarr_layers(dsk, keys)
+    if not consumer_layers:
+        logger.info("No layer consuming original arrays found. Aborting dask_io optimization.")
+        return dsk
+
+    layers = dict(dsk.layers)
+    dependencies = {k: set(v) for k, v in dsk.dependencies.items()}
+
+    # materialize the consumer layers only, working on copies
+    subgraph = {name: dict(layers[name]) for name in consumer_layers}
+    for origarr_name, layer_name in origarr_to_layer.items():
+        if layer_name in subgraph:  # the original array is in the same layer as its proxies
+            new_layer_name = origarr_name if origarr_name != layer_name else origarr_name + '-source'
+            layers[new_layer_name] = {origarr_name: subgraph[layer_name].pop(origarr_name)}
+            dependencies[new_layer_name] = set()
+            dependencies[layer_name].add(new_layer_name)
+            origarr_to_layer[origarr_name] = new_layer_name
+        subgraph[origarr_to_layer[origarr_name]] = layers[origarr_to_layer[origarr_name]]  # so that proxies' targets are found
+
+    chunk_shape, dicts = get_used_proxies(subgraph)
+    if chunk_shape == None or dicts == None:
+        logger.info("No proxy found. Aborting dask_io optimization.")
+        return dsk
+
+    logger.info("Launching optimization algorithm on %s layers.", len(consumer_layers)) 
+    apply_cached_plan(subgraph, dicts, chunk_shape)
+
+    layer_of_dict = {id(subgraph[name]): name for name in consumer_layers}
+    buffers_key_to_origarr = {get_buffers_key(origarr_name): origarr_name for origarr_name in dicts['origarr_to_used_proxies'].keys()}
+    for name, layer in subgraph.items():
+        if name in consumer_layers:
+            layers[name] = layer
+        elif name in buffers_key_to_origarr:  # buffers layer
+            origarr_name = buffers_key_to_origarr[name]
+            layers[name] = layer
+            dependencies[name] = {origarr_to_layer[origarr_name]}
+            for proxy in dicts['origarr_to_used_proxies'][origarr_name]:
+                dependencies[layer_of_dict[id(dicts['proxy_to_dict'][proxy])]].add(name)
+
+    apply_clustered_writes(layers)
+    return HighLevelGraph(layers, dependencies)
+
+
 def optimize_func(dsk, keys): # TODO: change function name
     """ Apply an optimization on the dask graph.
 
     Arguments:
     ----------
         dsk: dask graph
-        keys: 
+        keys: output keys of the graph
 
     Returns: 
     ----------
         the optimized dask graph
     """
     t = time.time()
-    dask_graph = dsk.dicts
-    dask_graph = clustered_optimization(dask_graph)
+    start_stats()
+    try:
+        with timer('total'):
+            if dask.config.get("io-optimizer.layer_aware", False) and isinstance(dsk, HighLevelGraph):
+                dsk = layer_aware_optimization(dsk, keys)
+                dask_graph = dsk.dicts
+            else:
+                dask_graph = dict(dsk.dicts)
+                dask_graph = clustered_optimization(dask_graph, keys)
+                dsk = HighLevelGraph(dask_graph, dsk.dependencies)
+    finally:
+        end_stats()
     logger.info("Time spent to create the graph: {0:.2f} milliseconds.".format((time.time() - t) * 1000))
 
-    log_file_path = os.path.join('/tmp', 'dask_io_output_graph.log')
-    logger.info('Output graph log can be found at %s', log_file_path)
-    with open(log_file_path, "w+") as f:
-        for k, v in dask_graph.items():    
-            f.write("\n\n " + str(k))
-            f.write("\n" + str(v))
+    dump_graph(dask_graph, 'output_graph')
     return dsk
 
 
 def keep_algorithm(dsk, keys):
-    print("Inside the keep algorithm")
-    dask_graph = dsk.dicts
-    chunk_shape, dicts = get_used_proxies(dask_graph)
-    return dsk
\ No newline at end of file
+    """ Apply the keep algorithm on the dask graph: the store tasks are rewritten to write 
+    each output file in as few operations as possible (see keep), then the clustered 
+    optimization is applied within the memory left by the volumes kept, reading the buffers of the keep plan.
+
+    Arguments:
+    ----------
+        dsk: dask graph
+        keys: output keys of the graph
+
+    Returns: 
+    ----------
+        the optimized dask graph
+    """
+    t = time.time()
+    start_stats()
+    try:
+        with timer('total'):
+            dask_graph = dict(dsk.dicts)
+            memory = get_memory_available()
+            kept = apply_keep(dask_graph, keys, memory, get_concurrent_buffers() + get_prefetch_depth())
+            if kept is None:
+                logger.debug("No proxy found, graph not modified by the keep algorithm.")
+                return dsk
+            reserved, box_shape = kept
+            with dask.config.set({'io-optimizer.memory_available': max(memory - reserved, 1), 
+                                  'io-optimizer.box_shape': box_shape}):
+                dask_graph = clustered_optimization(dask_graph, keys)
+            dsk = HighLevelGraph(dask_graph, dsk.dependencies)
+    finally:
+        end_stats()
+    logger.info("Time spent to create the graph: {0:.2f} milliseconds.".format((time.time() - t) * 1000))
+
+    dump_graph(dask_graph, 'output_graph')
+    return dsk
@@ -0,0 +1,310 @@
+import math
+import logging
+
+import numpy as np
+import dask
+
+logger = logging.getLogger(__name__)
+
+
+"""
+    Planner of the buffers of an original array.
+
+    A strategy groups the used blocks into box-shaped buffers of whole blocks that fit into the memory budget:
+        blocks: runs of blocks along the last axis, complete rows and complete slices merged (see clustering.buffering)
+        rows: bundles of complete rows (box of shape (1, ..., 1, m, nb_blocks_per_row))
+        slices: slabs of complete slices (box of shape (1, ..., 1, m, nb_rows, nb_blocks_per_row))
+        bricks: boxes as cubic as possible
+
+    The cost of a set of buffers is estimated as:
+        nb_seeks * seek_time + nb_bytes_read / read_bandwidth
+    where the bytes read include the unused blocks inside the bounding box of each buffer,
+    and the number of seeks depends on the physical layout of the original array.
+    With strategy "auto", the strategy of lowest cost is chosen, then the one with the fewest read calls (buffers).
+    If a box shape is configured, the buffers are the boxes of this shape tiling the array instead (strategy "box"),
+    in C order of the boxes: the keep algorithm reads the buffers of its plan this way (see keep.plan_keep).
+
+    Alignment:
+    ----------
+    If the original array is physically chunked (HDF5, zarr) with chunks not aligned with the blocks,
+    the blocks are first grouped into the smallest boxes whose edges are both blocks boundaries and physical chunks edges.
+    The strategies are then applied on the groups instead of the blocks, so that no physical chunk is read
+    (and decompressed) by two buffers. The buffers are ordered by index of their first physical chunk.
+
+    Configuration:
+    --------------
+        io-optimizer.strategy: "auto" (default) or the name of a strategy
+        io-optimizer.box_shape: shape of the buffers in blocks, None (default) to apply the strategy
+        io-optimizer.seek_time: time to start a read call in seconds
+        io-optimizer.read_bandwidth: read throughput in bytes per second
+"""
+
+STRATEGIES = ['blocks', 'rows', 'slices', 'bricks']
+SEEK_TIME = 0.01
+READ_BANDWIDTH = 150 * 10**6
+
+
+def get_cost_model():
+    """ Return the seek time and read bandwidth from the configuration.
+    """
+    seek_time = dask.config.get("io-optimizer.seek_time", None)
+    read_bandwidth = dask.config.get("io-optimizer.read_bandwidth", None)
+    return (seek_time if seek_time is not None else SEEK_TIME,
+            read_bandwidth if read_bandwidth is not None else READ_BANDWIDTH)
+
+
+def get_box_shape(strategy, blocks_shape, max_blocks):
+    """ Get the shape (in blocks) of the boxes of a strategy, or None if the strategy does not fit into the memory budget.
+
+    Arguments:
+    ----------
+        strategy: "rows", "slices" or "bricks"
+        blocks_shape: number of blocks per axis of the original array
+        max_blocks: maximum number of blocks per buffer
+    """
+    ndim = len(blocks_shape)
+    if strategy in ['rows', 'slices']:
+        nb_full_axes = 1 if strategy == 'rows' else 2
+        if ndim <= nb_full_axes:
+            box = tuple(blocks_shape)
+        else:
+            full_size = math.prod(blocks_shape[-nb_full_axes:])
+            m = min(max_blocks // full_size, blocks_shape[-nb_full_axes - 1])
+            if m < 1:
+                return None
+            box = (1,) * (ndim - nb_full_axes - 1) + (m,) + tuple(blocks_shape[-nb_full_axes:])
+        return box if math.prod(box) <= max_blocks else None
+
+    elif strategy == 'bricks':
+        side = max(int(round(max_blocks ** (1 / ndim))), 1)
+        while side > 1 and side ** ndim > max_blocks:  # rounding errors of the root
+            side -= 1
+        box = [min(side, n) for n in blocks_shape]
+        for i in reversed(range(ndim)):  # use the remaining budget along the fastest axes first
+            while box[i] < blocks_shape[i] and math.prod(box) // box[i] * (box[i] + 1) <= max_blocks:
+                box[i] += 1
+        return tuple(box)
+
+    raise ValueError(f'Unknown strategy {strategy}')
+
+
+def tile_buffers(blocks, blocks_shape, box_shape):
+    """ Group the used blocks by box of shape box_shape, the boxes tiling the array from its origin.
+
+    Returns:
+    --------
+        buffers: list of buffers (sorted lists of blocks), in the order of the boxes
+    """
+    blocks = np.asarray(blocks, dtype=np.int64)
+    if not len(blocks):
+        return list()
+    positions = np.unravel_index(blocks, blocks_shape)
+    tiles_shape = [-(-n // b) for n, b in zip(blocks_shape, box_shape)]
+    tiles = np.ravel_multi_index([p // b for p, b in zip(positions, box_shape)], tiles_shape)
+    order = np.argsort(tiles, kind='stable')
+    tiles = tiles[order]
+    blocks = blocks[order].tolist()
+    starts = np.flatnonzero(np.concatenate(([True], tiles[1:] != tiles[:-1]))).tolist()
+    ends = starts[1:] + [len(blocks)]
+    return [blocks[a:b] for a, b in zip(starts, ends)]
+
+
+def get_buffers_cost(buffers, blocks_shape, boundaries, itemsize, layout=None, cost_model=None):
+    """ Estimate the cost of reading the bounding boxes of the buffers.
+
+    Arguments:
+    ----------
+        buffers: list of buffers (lists of blocks)
+        blocks_shape: number of blocks per axis of the original array
+        boundaries: blocks boundaries along each axis of the original array
+        itemsize: number of bytes per voxel
+        layout: physical layout of the original array (see sources.get_layout), contiguous C order if None
+        cost_model: (seek_time, read_bandwidth), read from the configuration if None
+
+    Returns:
+    --------
+        dictionary with the number of read calls (one per buffer), seeks, bytes read, 
+        bytes read but not used and the estimated cost in seconds
+    """
+    seek_time, read_bandwidth = cost_model if cost_model else get_cost_model()
+    if not len(buffers):
+        return {'read_calls': 0, 'seeks': 0, 'bytes_read': 0, 'bytes_wasted': 0, 'cost': 0}
+
+    sizes = np.array([len(b) for b in buffers])
+    offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    positions = np.unravel_index(np.concatenate(buffers).astype(np.int64), blocks_shape)
+    boundaries = [np.asarray(b, dtype=np.int64) for b in boundaries]
+    shape = np.array([b[-1] for b in boundaries])
+
+    lo = np.stack([b[np.minimum.reduceat(p, offsets)] for p, b in zip(positions, boundaries)], axis=1)
+    hi = np.stack([b[np.maximum.reduceat(p, offsets) + 1] for p, b in zip(positions, boundaries)], axis=1)
+    extents = hi - lo
+    bytes_read = int(np.prod(extents, axis=1).sum()) * itemsize
+    block_sizes = [b[p + 1] - b[p] for p, b in zip(positions, boundaries)]
+    bytes_used = int(np.prod(block_sizes, axis=0).sum()) * itemsize
+
+    physical_chunks = layout.get('chunks') if layout else None
+    if physical_chunks:
+        # one seek per physical chunk intersected
+        physical_chunks = np.array(physical_chunks)
+        seeks = np.prod((hi + physical_chunks - 1) // physical_chunks - lo // physical_chunks, axis=1)
+    else:
+        # one seek per contiguous run: the runs are along the last axis not fully covered
+        if layout and layout.get('order') == 'F':
+            extents, lo, hi, shape = extents[:, ::-1], lo[:, ::-1], hi[:, ::-1], shape[::-1]
+        not_full = (lo != 0) | (hi != shape)
+        indexes = np.arange(len(shape))
+        last_not_full = np.where(not_full, indexes, -1).max(axis=1)
+        runs_before = np.concatenate((np.ones((len(buffers), 1), dtype=np.int64), np.cumprod(extents, axis=1)), axis=1)
+        seeks = runs_before[np.arange(len(buffers)), np.maximum(last_not_full, 0)]
+    seeks = int(np.sum(seeks))
+
+    return {
+        'read_calls': len(buffers),
+        'seeks': seeks,
+        'bytes_read': bytes_read,
+        'bytes_wasted': bytes_read - bytes_used,
+        'cost': seeks * seek_time + bytes_read / read_bandwidth
+    }
+
+
+def get_aligned_boundaries(boundaries, physical_chunks):
+    """ Keep the blocks boundaries that are also edges of the physical chunks.
+    The first and last boundaries of each axis (the bounds of the grid, which may be a region of the array) are always kept.
+    """
+    return tuple([axis[0]] + [b for b in axis[1:-1] if b % c == 0] + [axis[-1]] if len(axis) > 1 else list(axis)
+                 for axis, c in zip(boundaries, physical_chunks))
+
+
+def group_blocks(blocks, blocks_shape, boundaries, groups_boundaries):
+    """ Group the used blocks by box of blocks delimited by groups_boundaries.
+
+    Arguments:
+    ----------
+        blocks: list of the blocks used
+        blocks_shape: number of blocks per axis of the original array
+        boundaries: blocks boundaries along each axis of the original array
+        groups_boundaries: groups boundaries along each axis, subset of boundaries
+
+    Returns:
+    --------
+        groups_shape: number of groups per axis
+        groups: sorted list of the groups used
+        group_to_blocks: dictionary mapping each group used to the sorted list of its blocks used
+        blocks_per_group: maximum number of blocks in a group
+    """
+    groups_shape = tuple(len(g) - 1 for g in groups_boundaries)
+    blocks_per_group = math.prod(
+        int(np.diff(np.searchsorted(b, g)).max()) for b, g in zip(boundaries, groups_boundaries))
+
+    blocks = np.asarray(blocks, dtype=np.int64)
+    positions = np.unravel_index(blocks, blocks_shape)
+    groups = np.ravel_multi_index(
+        [np.searchsorted(g, np.asarray(b)[p], side='right') - 1 for p, b, g in zip(positions, boundaries, groups_boundaries)],
+        groups_shape)
+
+    group_to_blocks = dict()
+    for group, block in zip(groups.tolist(), blocks.tolist()):
+        group_to_blocks.setdefault(group, list()).append(block)
+    for group_blocks_used in group_to_blocks.values():
+        group_blocks_used.sort()
+    return groups_shape, sorted(group_to_blocks.keys()), group_to_blocks, blocks_per_group
+
+
+def sort_by_physical_chunk(buffers, blocks_shape, boundaries, physical_chunks):
+    """ Sort the buffers by index of the physical chunk containing their first voxel (lower corner of their bounding box).
+    """
+    chunks_grid = [-(-b[-1] // c) for b, c in zip(boundaries, physical_chunks)]
+
+    def first_chunk(buffer):
+        positions = np.unravel_index(np.asarray(buffer, dtype=np.int64), blocks_shape)
+        corner = [b[int(p.min())] // c for p, b, c in zip(positions, boundaries, physical_chunks)]
+        return int(np.ravel_multi_index(corner, chunks_grid))
+
+    return sorted(buffers, key=first_chunk)
+
+
+def plan_buffers(blocks, blocks_shape, boundaries, max_blocks, blocks_buffering, itemsize=2, layout=None, strategy=None):
+    """ Group the used blocks into buffers following a strategy.
+    The buffers are aligned on the physical chunks of the original array if possible (see Alignment).
+
+    Arguments:
+    ----------
+        blocks: sorted list of the blocks used
+        blocks_shape: number of blocks per axis of the original array
+        boundaries: blocks boundaries along each axis of the original array
+        max_blocks: maximum number of blocks per buffer
+        blocks_buffering: function returning the buffers of the "blocks" strategy 
+            from the list of blocks, the blocks shape and the maximum number of blocks per buffer
+        itemsize: number of bytes per voxel
+        layout: physical layout of the original array
+        strategy: name of the strategy or "auto", read from the configuration if None.
+            If the strategy does not fit in memory, the "blocks" strategy is used.
+
+    Returns:
+    --------
+        strategy: the strategy used
+        buffers: list of buffers (lists of blocks)
+        cost: estimated cost of the buffers (see get_buffers_cost)
+    """
+    if strategy is None:
+        strategy = dask.config.get("io-optimizer.strategy", None) or 'auto'
+    if strategy != 'auto' and strategy not in STRATEGIES:
+        raise ValueError(f'Unknown strategy {strategy}')
+
+    box_shape = dask.config.get("io-optimizer.box_shape", None)
+    if box_shape is not None:
+        box_shape = tuple(min(b, n) for b, n in zip(box_shape, blocks_shape))
+        if math.prod(box_shape) > max_blocks:
+            logger.warning(f'Box shape {box_shape} does not fit in a buffer of {max_blocks} blocks.')
+        buffers = tile_buffers(blocks, blocks_shape, box_shape)
+        return 'box', buffers, get_buffers_cost(buffers, blocks_shape, boundaries, itemsize, layout)
+
+    physical_chunks = layout.get('chunks') if layout else None
+    if not physical_chunks:
+        return choose_buffers(blocks, blocks_shape, boundaries, max_blocks, blocks_buffering, itemsize, layout, strategy)
+
+    groups_boundaries = get_aligned_boundaries(boundaries, physical_chunks)
+    if any(len(g) < 2 for g in groups_boundaries):  # empty grid
+        return choose_buffers(blocks, blocks_shape, boundaries, max_blocks, blocks_buffering, itemsize, layout, strategy)
+    groups_shape, groups, group_to_blocks, blocks_per_group = group_blocks(blocks, blocks_shape, boundaries, groups_boundaries)
+    if blocks_per_group == 1:  # blocks already aligned
+        name, buffers, cost = choose_buffers(blocks, blocks_shape, boundaries, max_blocks, blocks_buffering, itemsize, layout, strategy)
+    elif blocks_per_group <= max_blocks:
+        name, group_buffers, _ = choose_buffers(
+            groups, groups_shape, groups_boundaries, max_blocks // blocks_per_group, blocks_buffering, itemsize, layout, strategy)
+        buffers = [sorted(b for g in group_buffer for b in group_to_blocks[g]) for group_buffer in group_buffers]
+        cost = get_buffers_cost(buffers, blocks_shape, boundaries, itemsize, layout)
+    else:
+        logger.warning(f'Physical chunks {physical_chunks} do not fit in a buffer of {max_blocks} blocks, '
+                       'physical chunks may be read by several buffers.')
+        name, buffers, cost = choose_buffers(blocks, blocks_shape, boundaries, max_blocks, blocks_buffering, itemsize, layout, strategy)
+    return name, sort_by_physical_chunk(buffers, blocks_shape, boundaries, physical_chunks), cost
+
+
+def choose_buffers(blocks, blocks_shape, boundaries, max_blocks, blocks_buffering, itemsize, layout, strategy):
+    """ Apply the strategy (or all strategies if "auto") and return the buffers of lowest cost (see plan_buffers).
+    """
+    cost_model = get_cost_model()
+
+    candidates = STRATEGIES if strategy == 'auto' else [strategy]
+    best = None
+    for name in candidates:
+        if name == 'blocks':
+            buffers = blocks_buffering(list(blocks), blocks_shape, max_blocks)
+        else:
+            box_shape = get_box_shape(name, blocks_shape, max_blocks)
+            if box_shape is None:
+                logger.debug(f'Strategy {name} does not fit in memory')
+                continue
+            buffers = tile_buffers(blocks, blocks_shape, box_shape)
+        cost = get_buffers_cost(buffers, blocks_shape, boundaries, itemsize, layout, cost_model)
+        logger.debug(f'Strategy {name}: {len(buffers)} buffers, cost {cost}')
+        if best is None or (cost['cost'], cost['read_calls']) < (best[2]['cost'], best[2]['read_calls']):
+            best = (name, buffers, cost)
+
+    if best is None:  # the "blocks" strategy always fits
+        logger.warning(f'Strategy {strategy} does not fit in memory, using strategy "blocks" instead.')
+        return choose_buffers(blocks, blocks_shape, boundaries, max_blocks, blocks_buffering, itemsize, layout, 'blocks')
+    logger.debug(f'Strategy chosen: {best[0]}')
+    return best
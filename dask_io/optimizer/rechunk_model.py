@@ -1,124 +1,183 @@
+import math
+import logging
 from math import floor
 
-def model(m, n, N):
-    print(f'\n--------Running new case--------')
-    
-    R, I, O, m = case["R"], case["I"], case["O"], case["m"]
-    Lambd = I 
+import numpy as np
+
+from dask_io.optimizer.cases.resplit_utils import get_blocks_shape
+
+logger = logging.getLogger(__name__)
+
+
+"""
+    Model of the buffer shape of the keep algorithm (see keep).
+
+    The buffer B is a part of an input block Lambda = I. It is extended axis by axis,
+    as long as the buffer and the parts of the output files it keeps in memory (F1 to F7, see paper) fit in m voxels:
+        1. Bj up to Theta_j, storing F1 (Omega_k x Bj per row),
+        2. Bj up to Lambda_j, storing F2 and F3 during the n blocks of a row of input blocks,
+        3. Bi up to Theta_i, storing F1, F2, F3 for each slice,
+        4. Bi up to Lambda_i, storing F4 to F7 during the N blocks of a slice of input blocks.
+    Omega and Theta are computed for the first input block: Omega = Lambda % O, Theta = Lambda - Omega.
+
+    The model is used by the keep algorithm only (see keep.plan_keep, which validates B with compute_zones).
+    The buffers of the clustered reads are made of whole input blocks (see planner), 
+    so that a buffer shape within an input block does not apply to them.
+
+    The memory of a buffer shape is given by get_cache_footprint, for the buffers read in C order as by 
+    the keep algorithm: it is the footprint checked by keep.plan_keep, and the one fitted by choose_buffer_shape.
+"""
+
+
+ALL_VOLUMES = [1, 2, 3, 4, 5, 6, 7]
+
+
+def get_omega_theta(I, O):
+    omega = [I[dim] % O[dim] for dim in range(3)]
+    theta = [I[dim] - omega[dim] for dim in range(3)]
+    return omega, theta
+
+
+def get_nb_blocks(R, I):
+    """ Get the number of input blocks in a row (n) and in a slice (N) of the original array.
+    """
+    partition = [R[dim] // I[dim] for dim in range(3)]
+    return partition[2], partition[1] * partition[2]
+
+
+def get_slice_cost(I, O, n):
+    """ Voxels stored for each slice of a buffer of shape (1, I_j, I_k): the buffer, F1, and F2, F3 during a row.
+    """
+    omega, theta = get_omega_theta(I, O)
+    return omega[2] * theta[1] + n * omega[1] * I[2] + I[1] * I[2]
+
+
+def model(I, O, m, n, N):
+    """ Get the largest buffer shape fitting in memory.
+
+    Arguments:
+    ----------
+        I: shape of the input blocks
+        O: shape of the output files
+        m: memory available, in voxels
+        n: number of input blocks in a row of the original array
+        N: number of input blocks in a slice of the original array
+
+    Returns:
+    --------
+        B: buffer shape, (1, 1, I_k) if no buffer fits in memory
+    """
+    Lambd = I
+    omega, theta = get_omega_theta(I, O)
     B = [1, 1, Lambd[2]]
+    logger.debug(f'Omega: {omega}, Theta: {theta}')
+
+    # storing F1
+    phi = floor(m / (omega[2] + Lambd[2]))
+    if phi < theta[1]:
+        B[1] = max(phi, 1)
+        logger.debug(f'Bj <- max value {B[1]}')
+        return tuple(B)
+    B[1] = max(theta[1], 1)
+
+    # storing F2 and F3
+    phi2 = floor((m - theta[1] * (omega[2] + Lambd[2])) / ((n + 1) * Lambd[2]))
+    if B[1] + phi2 < Lambd[1]:
+        B[1] = B[1] + phi2
+        logger.debug(f'Bj <- max value {B[1]}')
+        return tuple(B)
+    B[1] = Lambd[1]
+
+    # extending F1, F2 and F3
+    slice_cost = get_slice_cost(I, O, n)
+    phi3 = floor(m / slice_cost)
+    if phi3 < theta[0]:
+        B[0] = max(phi3, 1)
+        logger.debug(f'Bi <- max value {B[0]}')
+        return tuple(B)
+    B[0] = max(theta[0], 1)
+
+    # storing F4, F5, F6, F7
+    phi4 = floor((m - theta[0] * slice_cost) / ((N + 1) * Lambd[1] * Lambd[2]))
+    if B[0] + phi4 < Lambd[0]:
+        B[0] = B[0] + phi4
+        logger.debug(f'Bi <- max value {B[0]}')
+        return tuple(B)
+    B[0] = Lambd[0]
+    return tuple(B)
+
+
+def get_axis_thetas(b, o, r):
+    """ Get the distinct Theta of the buffers of size b along an axis of size r, with output files of size o
+    (see resplit_case.get_theta), bounded by b for the buffer sizes not supported by keep (see keep.is_valid_buffer_size).
+    """
+    C = (np.arange(1, r // b + 1) * b) % o
+    if b != o:  # particular case
+        C[C == 0] = o
+    return np.unique(np.clip(b - C, 0, b))
+
+
+def get_cache_footprint(B, R, O, volumestokeep=ALL_VOLUMES):
+    """ Get the voxels in memory when the original array R is read in buffers of shape B in C order 
+    and the volumes volumestokeep are kept (see keep): one buffer and the most voxels kept at a time.
+    A volume kept until the next buffer along k is kept during one buffer,
+    along j during a row of buffers and along i during a slice of buffers.
+
+    The volumes of a buffer are products of Theta or B - Theta along each axis (see resplit_case.get_main_volumes), 
+    and the buffers cover all the combinations of the Theta of the axes: the most voxels kept 
+    are products of the most kept along each axis, except for the volumes 4 to 7 which exist if Theta_j < B_j.
+    """
+    buffers_partition = get_blocks_shape(R, B)
+    Ti, Tj, Tk = [get_axis_thetas(b, o, r) for b, o, r in zip(B, O, R)]
+    Bi, Bj, Bk = B
+    keep = [v in volumestokeep for v in range(8)]
+
+    max_kept = [0, 0, 0]
+    if keep[1]:
+        max_kept[2] = Ti.max() * Tj.max() * (Bk - Tk).max()
+    if keep[2] or keep[3]:
+        max_kept[1] = Ti.max() * (Bj - Tj).max() * (keep[2] * Tk + keep[3] * (Bk - Tk)).max()
+    Tj = Tj[Tj < Bj][:, None]
+    if any(keep[4:]) and Tj.size:
+        kept = (keep[4] * Tj * Tk + keep[5] * Tj * (Bk - Tk) 
+                + keep[6] * (Bj - Tj) * Tk + keep[7] * (Bj - Tj) * (Bk - Tk))
+        max_kept[0] = (Bi - Ti).max() * kept.max()
+
+    buffers_kept = [math.prod(buffers_partition[axis + 1:]) for axis in range(3)]
+    return math.prod(B) + sum(int(m) * n for m, n in zip(max_kept, buffers_kept))
+
+
+def get_model_shapes(I):
+    """ Get the buffer shapes through which the model extends the buffer (see model), by increasing size.
+    """
+    return ([(1, j, I[2]) for j in range(1, I[1] + 1)] 
+            + [(i, I[1], I[2]) for i in range(2, I[0] + 1)])
+
+
+def choose_buffer_shape(R, I, O, memory_bytes, dtype):
+    """ Choose the largest buffer shape of the model whose buffer and kept volumes fit in memory (see get_cache_footprint).
+    The footprint does not grow with the buffer shape, as the buffers aligned on the output files keep less: 
+    all the shapes of the model are evaluated (see get_model_shapes).
+
+    Arguments:
+    ----------
+        R: shape of the original array
+        I: shape of the input blocks
+        O: shape of the output files
+        memory_bytes: memory available, in bytes
+        dtype: data type of the arrays
 
-    for i in range(1):
-        for j in range(1):
-            for k in range(1):
-                omega = [(i+1) * Lambd[0] % O[0], 
-                         (j+1) * Lambd[1] % O[1],
-                         (k+1) * Lambd[2] % O[2]]
-                
-                theta = [
-                    Lambd[0] - omega[0],
-                    Lambd[1] - omega[1],
-                    Lambd[2] - omega[2]
-                ]
-
-                print(f'Omega: {omega}')
-                print(f'Theta: {theta}')
-
-                print(f'--------Storing F1--------')
-                phi = floor(m / (omega[2] + Lambd[2]))
-                print(f'Max value for Bj: {phi}')
-
-                if phi >= theta[1]:
-                    print(f'Setting Bj to thetaj')
-                    B[1] = theta[1]
-                else:
-                    B[1] = phi if phi > 1 else 1
-                    print("End of algorithm, Bj <- max_value")
-                    return tuple(B)
-
-                print(f'--------Storing F2 and F3--------')
-                phi2 = floor( (m - theta[1] * (omega[2] + Lambd[2])) / ((n+1) * Lambd[2]))
-                print(f'Max value for lambdaj - thetaj: {phi2}')
-                print(f'Max value for Bj: {B[1] + phi2}')
-
-                if (B[1] + phi2) >= Lambd[1]:   
-                    print(f'Setting Bj to lambdaj')
-                    B[1] = Lambd[1]
-                else:
-                    B[1] = B[1] + phi2 
-                    print("End of algorithm, Bj <- max_value")
-                    return tuple(B)
-
-                print(f'--------Extending F1, F2 and F3--------')
-                phi3 = floor( m / ( omega[2]*theta[1] + n*omega[1]*Lambd[2] + Lambd[1]*Lambd[2] ) )
-                print(f'Max value for Bi: {phi3}')
-                if phi3 >= theta[0]:
-                    print(f'Setting Bi to thetai')
-                    B[0] = theta[0]
-                else:
-                    B[0] = phi3 if phi3 > 1 else 1
-                    print("End of algorithm, Bi <- max_value")
-                    return tuple(B)
-
-                print(f'--------Storing F4, F5, F6, F7--------')
-                phi4 = floor( (m - theta[0] * ( omega[2]*theta[1] + n*omega[j]*Lambd[2] + Lambd[1]*Lambd[2] )) / ((N+1) * Lambd[1] * Lambd[2]) )
-                print(f'Max value for Bi: {B[0] + phi4}')
-                if (B[0] + phi4) >= Lambd[0]:
-                    print(f'Setting Bi to lambdai')
-                    B[0] = Lambd[0]
-                else:
-                    B[0] = B[0] + phi4 
-                    print("End of algorithm, Bi <- max_value")
-                    return tuple(B)
-
-                return tuple(B)
-
-
-if __name__ == "__main__":
-    # WARNING: m is a number of voxels, not bytes
-    
-    partitionI = (2,2,2)  # partition of R by I
-    n = partitionI[2]
-    N = partitionI[1] * partitionI[2]
-
-    cases = [
-        {   
-            'R': (1,120,120),
-            'I': (1,60,60),
-            'O': (1,40,40),
-            'm': 60*40 + (40*20), # buffer size + F1
-            'Bexpected': (1,40,60)
-        },{
-            'R': (1,120,120),
-            'I': (1,60,60),
-            'O': (1,40,40),
-            'm': 60*60 + 40*20 + n*60*20,  # buffer size + F1 + n(F2+F3)
-            'Bexpected': (1,60,60)
-        },{
-            'R': (120,120,120),
-            'I': (60,60,60),
-            'O': (40,40,40),
-            'm': 60*60*40 + 40*20*40 + n*60*20*40,  # buffer size + F1 + n(F2+F3)
-            'Bexpected': (40,60,60)
-        },{
-            'R': (120,120,120),
-            'I': (60,60,60),
-            'O': (40,40,40),
-            'm': 60*60 + 40*20 + n*60*20,  # buffer size + F1 + n(F2+F3)
-            'Bexpected': (1,60,60)
-        },{
-            'R': (120,120,120),
-            'I': (60,60,60),
-            'O': (40,40,40),
-            'm': 60*60*60 + 40*20*40 + n*60*20*40 + N*20*60*60,  # buffer size + F1 + n(F2+F3) + N(F4+F5+F6+F7)
-            'Bexpected': (60,60,60)
-        }
-    ]
-    
-    for case in cases:
-        B = model(case, n, N)
-        print(f'Final buffer shape: {B}')
-        try:
-            assert case["Bexpected"] == B
-            print("Success.")
-        except:
-            print('Bad output.')            
\ No newline at end of file
+    Returns:
+    --------
+        B: buffer shape, (1, 1, I_k) if no buffer fits in memory
+        footprint: number of bytes in memory predicted for B (see get_cache_footprint),
+            bigger than memory_bytes if no buffer fits in memory
+    """
+    itemsize = np.dtype(dtype).itemsize
+    shapes = get_model_shapes(I)
+    B, footprint = shapes[0], get_cache_footprint(shapes[0], R, O) * itemsize
+    for shape in shapes[1:]:
+        shape_footprint = get_cache_footprint(shape, R, O) * itemsize
+        if shape_footprint <= memory_bytes:
+            B, footprint = shape, shape_footprint
+    return B, footprint
@@ -0,0 +1,408 @@
+import os
+import math
+import logging
+import threading
+import collections
+from operator import getitem
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import dask
+from dask import threaded
+from dask.local import get_async
+from dask.callbacks import Callback, local_callbacks, normalize_callback
+
+from dask_io.optimizer.clustering import get_memory_available, get_concurrent_buffers, get_prefetch_depth
+from dask_io.optimizer.io_tasks import load_buffer, keep_volume, write_buffer
+from dask_io.optimizer.sources import get_path
+from dask_io.optimizer.utils.utils import is_rotational
+
+logger = logging.getLogger(__name__)
+
+
+"""
+    Memory-bounded execution of the optimized graphs.
+
+    The threaded scheduler fires every task as soon as it is ready, so that all the buffers
+    of an original array may be loaded at the same time. The MemoryLimitCallback holds back
+    the buffers loads while the bytes of the buffers in memory exceed the memory limit:
+    a buffer is in memory from the time it is allowed to load until the scheduler releases it 
+    and its proxies, which are views of the buffer.
+    At least one buffer is always allowed to load, so that a buffer bigger than the limit does not block the computation.
+    The volumes kept in memory by the keep algorithm (see keep) count in the limit from their copy to their write.
+
+    The buffers loads can also run on a dedicated pool of I/O threads, the other tasks keeping the whole compute pool.
+    One I/O thread avoids interleaving the reads on a hard disk drive, several threads keep an SSD busy.
+
+    Read-ahead: with a prefetch depth d, the buffers are sized so that d more buffers than the buffers
+    being processed fit in memory (see clustering.get_memory_budget). The next d buffers in storage order 
+    are then read, on the I/O threads if any, while the compute threads process the current ones.
+
+    Configuration:
+    --------------
+        io-optimizer.scheduler_opti: if True, enable_clustering(..., set_scheduler=True) sets the scheduler to get,
+            which limits the buffers in memory to the memory available (see clustering.get_memory_available).
+            Otherwise get is used by the computations run with scheduler=get only.
+        io-optimizer.io_threads: number of I/O threads, 
+            "auto" for 1 if a file read is on a rotational disk and IO_THREADS_SSD otherwise (see get_io_threads),
+            None or 0 to load the buffers in the compute pool.
+        io-optimizer.prefetch_depth: number of buffers read in advance, 0 (default) to only limit the memory
+"""
+
+IO_THREADS_SSD = 4
+GET_KWARGS = ('cache', 'rerun_exceptions_locally')
+EXECUTORS = dict()
+EXECUTORS_LOCK = threading.Lock()
+
+
+def is_buffer_task(key, task):
+    """ Check if the task at key of a dask graph loads a buffer (see clustering.create_buffer_node).
+    """
+    return (isinstance(key, tuple)
+            and isinstance(key[0], str)
+            and key[0].endswith('-merged')
+            and isinstance(task, tuple)
+            and len(task) == 3
+            and task[0] in (getitem, load_buffer)
+            and isinstance(task[2], tuple)
+            and all(isinstance(s, slice) for s in task[2]))
+
+
+def is_kept_task(task):
+    """ Check if a task copies a volume kept in memory (see keep.get_kept_key).
+    """
+    return isinstance(task, tuple) and len(task) == 2 and task[0] is keep_volume
+
+
+def is_write_buffer_task(task):
+    """ Check if a task writes a write buffer (see clustered_writes.create_write_node and keep.create_keep_nodes).
+    """
+    return isinstance(task, tuple) and len(task) == 6 and task[0] is write_buffer
+
+
+def get_write_nbytes(task):
+    """ Number of bytes of the write buffer assembled by task.
+    """
+    _, target, buffer_slices, _, _, _ = task
+    dtype = getattr(target, 'dtype', None)
+    itemsize = np.dtype(dtype).itemsize if dtype is not None else 1
+    return math.prod(s.stop - s.start for s in buffer_slices) * itemsize
+
+
+def get_write_parts(dsk, task):
+    """ Keys of the parts of a write buffer, computed before the write.
+    """
+    parts = list()
+    for block in task[4]:
+        try:
+            if block in dsk:
+                parts.append(block)
+        except TypeError:  # unhashable task
+            continue
+    return parts
+
+
+def get_views(dsk, buffer_key, dependents):
+    """ Get the proxies of a buffer among its dependents: the getitem tasks on the buffer, 
+    whose results are views holding the buffer in memory (see clustering.update_io_tasks).
+    """
+    return [key for key in dependents 
+            if isinstance(dsk[key], tuple) 
+            and len(dsk[key]) == 3 
+            and dsk[key][0] is getitem 
+            and isinstance(dsk[key][1], tuple) 
+            and dsk[key][1] == buffer_key]
+
+
+def get_aliases(dsk, key, dependents):
+    """ Get the aliases of key among its dependents: the tasks returning the result of key.
+    """
+    return [dependent for dependent in dependents 
+            if isinstance(dsk[dependent], type(key)) and dsk[dependent] == key]
+
+
+def get_holders(dsk, buffer_key, dependents):
+    """ Get the keys holding a buffer in memory: the buffer, its proxies, the views of its proxies 
+    (e.g. the slices of the proxies stored into output files) and their aliases.
+
+    Arguments:
+    ----------
+        dsk: dask graph
+        buffer_key: key of the buffer
+        dependents: dictionary of the dependents of each key (see dask.core.get_deps)
+    """
+    holders, views = set([buffer_key]), [buffer_key]
+    while views:
+        view = views.pop()
+        view_dependents = dependents.get(view, ())
+        for key in get_views(dsk, view, view_dependents) + get_aliases(dsk, view, view_dependents):
+            if not key in holders:
+                holders.add(key)
+                views.append(key)
+    return holders
+
+
+def get_buffer_nbytes(dsk, task):
+    """ Number of bytes of the buffer loaded by task.
+    """
+    _, origarr_key, buffer_slices = task
+    dtype = getattr(dsk.get(origarr_key), 'dtype', None)
+    itemsize = np.dtype(dtype).itemsize if dtype is not None else 1
+    return math.prod(s.stop - s.start for s in buffer_slices) * itemsize
+
+
+class MemoryLimitCallback(Callback):
+    """ Scheduler callback limiting the bytes of the buffers in memory to memory_limit,
+    and their number to max_buffers if not None.
+    In a graph rewritten by the keep algorithm, the number of buffers is limited to the buffers of its plan
+    (see keep.plan_keep) by default: the memory left by the buffers is reserved for the volumes kept later.
+
+    The buffers loads are removed from the ready tasks of the scheduler and given back
+    when the buffers in memory leave enough room. The buffers of an original array are given back 
+    in the order of the graph, i.e. in the storage order in which create_buffers produced them, 
+    so that a buffer loaded in advance is the next one on disk. Between original arrays,
+    the next buffer of the array whose load was made ready first by the scheduler is given back first,
+    the ready tasks being sorted in the order of dask (see dask.order).
+    A buffer counts in the limit until it and all its proxies (getitem views holding the buffer) are released,
+    as well as the views of its proxies (see get_holders).
+    A write buffer counts from the computation of each of its parts (not counted otherwise) until its write, 
+    plus the array assembled while it is written (see io_tasks.write_buffer).
+    If nothing else runs, a load is given back even if the buffers do not fit, so that the computation goes on.
+
+    Attributes:
+    -----------
+        max_bytes: maximum number of bytes of the buffers, kept volumes and write buffers in memory during the last computation
+        max_live_buffers: maximum number of buffers in memory during the last computation
+        deferred_loads: number of buffers loads held back during the last computation
+    """
+    def __init__(self, memory_limit, max_buffers=None):
+        super().__init__()
+        self.memory_limit = memory_limit
+        self.max_buffers = max_buffers
+        self.max_bytes = 0
+        self.max_live_buffers = 0
+        self.deferred_loads = 0
+
+    def _start_state(self, dsk, state):
+        buffer_keys = [key for key, task in dsk.items() if is_buffer_task(key, task)]
+        self.buffer_to_nbytes = {key: get_buffer_nbytes(dsk, dsk[key]) for key in buffer_keys}
+        self.storage_rank = {key: i for i, key in enumerate(buffer_keys)}
+        self.ready_rank = dict()
+        self.kept_keys = set(key for key, task in dsk.items() if is_kept_task(task))
+        self.buffers_limit = self.max_buffers
+        if self.buffers_limit is None and self.kept_keys:
+            self.buffers_limit = get_concurrent_buffers() + get_prefetch_depth()
+        self.holders = {key: get_holders(dsk, key, state['dependents']) for key in buffer_keys}
+        self.holder_to_owner = {holder: key for key, holders in self.holders.items() for holder in holders}
+        write_keys = [key for key, task in dsk.items() if is_write_buffer_task(task)]
+        self.write_to_nbytes = {key: get_write_nbytes(dsk[key]) for key in write_keys}
+        self.part_to_write = {part: key for key in write_keys for part in get_write_parts(dsk, dsk[key]) 
+                              if part not in self.holder_to_owner and part not in self.kept_keys}
+        self.writes = dict()
+        self.live = dict()
+        self.kept = dict()
+        self.live_bytes = 0
+        self.deferred = dict()
+        self.max_bytes = 0
+        self.max_live_buffers = 0
+        self.deferred_loads = 0
+        self.defer_loads(state)
+
+    def _pretask(self, key, dsk, state):
+        if key in self.write_to_nbytes:  # array assembled
+            self.add_write_bytes(key, self.write_to_nbytes[key])
+
+    def _posttask(self, key, result, dsk, state, worker_id):
+        if key in self.part_to_write:
+            self.add_write_bytes(self.part_to_write[key], getattr(result, 'nbytes', 0))
+        if key in self.write_to_nbytes:
+            self.live_bytes -= self.writes.pop(key, 0)
+        if not self.buffer_to_nbytes:
+            return
+        if key in self.kept_keys:
+            self.kept[key] = getattr(result, 'nbytes', 0)
+            self.holders[key] = set([key])
+            self.holder_to_owner[key] = key
+            self.live_bytes += self.kept[key]
+            self.max_bytes = max(self.max_bytes, self.live_bytes)
+        released = self.release_holders(state['dependencies'][key], state)
+        if any(dependent in self.buffer_to_nbytes for dependent in state['dependents'].get(key, ())):
+            self.defer_loads(state)
+        if released or not (state['ready'] or state['running']):
+            self.allow_loads(state)
+
+    def add_write_bytes(self, write_key, nbytes):
+        self.writes[write_key] = self.writes.get(write_key, 0) + nbytes
+        self.live_bytes += nbytes
+        self.max_bytes = max(self.max_bytes, self.live_bytes)
+
+    def release_holders(self, keys, state):
+        """ Release the buffers and kept volumes whose holders (see get_views) are all released by the scheduler.
+        The keys released by the scheduler after a task are among its dependencies.
+        """
+        released = list()
+        for key in keys:
+            owner = self.holder_to_owner.get(key)
+            if owner is None or key not in state['released']:
+                continue
+            holders = self.holders[owner]
+            holders.discard(key)
+            if not holders and (owner in self.live or owner in self.kept):
+                self.live_bytes -= self.live.pop(owner) if owner in self.live else self.kept.pop(owner)
+                released.append(owner)
+        return released
+
+    def defer_loads(self, state):
+        """ Move the buffers loads from the ready tasks to the deferred loads, 
+        a queue per original array in storage order.
+        """
+        ready = state['ready']
+        loads = [key for key in ready if key in self.buffer_to_nbytes]
+        if not loads:
+            return
+        ready[:] = [key for key in ready if not key in self.buffer_to_nbytes]
+        for key in reversed(loads):  # the last ready task is fired first
+            self.ready_rank.setdefault(key, len(self.ready_rank))
+        for buffers_name in set(key[0] for key in loads):
+            queue = list(self.deferred.get(buffers_name, list())) + [key for key in loads if key[0] == buffers_name]
+            self.deferred[buffers_name] = collections.deque(sorted(queue, key=self.storage_rank.get))
+        self.allow_loads(state)
+        self.deferred_loads += sum(1 for key in loads if key in self.deferred[key[0]])
+
+    def is_full(self, nbytes):
+        if not self.live:
+            return False
+        if self.buffers_limit is not None and len(self.live) >= self.buffers_limit:
+            return True
+        return self.live_bytes + nbytes > self.memory_limit
+
+    def allow_loads(self, state):
+        """ Give back deferred loads to the scheduler while the buffers fit in memory.
+        """
+        allowed = list()
+        while True:
+            heads = [queue[0] for queue in self.deferred.values() if queue]
+            if not heads:
+                break
+            key = min(heads, key=self.ready_rank.get)
+            nbytes = self.buffer_to_nbytes[key]
+            if self.is_full(nbytes) and (allowed or state['ready'] or state['running']):
+                break
+            self.deferred[key[0]].popleft()
+            self.live[key] = nbytes
+            self.live_bytes += nbytes
+            allowed.append(key)
+        state['ready'].extend(reversed(allowed))  # the last ready task is fired first
+        self.max_bytes = max(self.max_bytes, self.live_bytes)
+        self.max_live_buffers = max(self.max_live_buffers, len(self.live))
+
+
+def get_io_threads(dsk, buffer_keys):
+    """ Get the number of I/O threads to load the buffers of a graph, from the ``io-optimizer.io_threads" configuration.
+    In "auto" mode, returns 1 if one of the files read is on a rotational disk, 
+    IO_THREADS_SSD otherwise, and None if no buffer is read from a file.
+    """
+    io_threads = dask.config.get("io-optimizer.io_threads", None)
+    if io_threads != 'auto':
+        return io_threads or None
+
+    paths = set()
+    for key in buffer_keys:
+        path = get_path(dsk.get(dsk[key][1]))
+        if path is not None:
+            paths.add(path)
+    if not paths:
+        return None
+    if any(is_rotational(path) for path in paths):
+        return 1
+    return IO_THREADS_SSD
+
+
+def get_executor(kind, nb_threads):
+    """ Return a thread pool of nb_threads threads, shared between the computations.
+    """
+    with EXECUTORS_LOCK:
+        if not (kind, nb_threads) in EXECUTORS:
+            EXECUTORS[(kind, nb_threads)] = ThreadPoolExecutor(nb_threads, thread_name_prefix=f'dask-io-{kind}')
+        return EXECUTORS[(kind, nb_threads)]
+
+
+def shutdown_executors():
+    """ Shut down the thread pools created by get_executor, waiting for their running tasks.
+    """
+    with EXECUTORS_LOCK:
+        executors = list(EXECUTORS.values())
+        EXECUTORS.clear()
+    for executor in executors:
+        executor.shutdown(wait=True)
+
+
+class IORouterCallback(Callback):
+    """ Scheduler callback giving an apply_async function for dask.local.get_async, which runs the tasks io_keys 
+    on io_executor and the other tasks on compute_executor.
+
+    The key of a task is the one of the last pretask call: get_async calls the pretask callbacks 
+    of a task right before submitting it to apply_async. A task submitted without pretask call runs on compute_executor.
+    """
+    def __init__(self, compute_executor, io_executor, io_keys):
+        super().__init__()
+        self.compute_executor = compute_executor
+        self.io_executor = io_executor
+        self.io_keys = io_keys
+        self.key = None
+
+    def _pretask(self, key, dsk, state):
+        self.key = key
+
+    def apply_async(self, func, args=(), kwds={}, callback=None):
+        key, self.key = self.key, None
+        executor = self.io_executor if key is not None and key in self.io_keys else self.compute_executor
+        future = executor.submit(func, *args, **kwds)
+        if callback is not None:
+            future.add_done_callback(lambda f: callback(f.result()))
+
+
+def get(dsk, keys, memory_limit=None, num_workers=None, **kwargs):
+    """ Threaded scheduler limiting the bytes and number of the buffers in memory (see MemoryLimitCallback)
+    and loading the buffers on dedicated I/O threads (see get_io_threads).
+
+    Arguments:
+    ----------
+        dsk, keys, num_workers: see dask.threaded.get
+        memory_limit: maximum number of bytes of the buffers in memory,
+            memory available for the io optimization if None
+        kwargs: callbacks and GET_KWARGS (see dask.local.get_async), the other arguments are ignored
+    """
+    if memory_limit is None:
+        memory_limit = get_memory_available()
+    prefetch_depth = get_prefetch_depth()
+    max_buffers = get_concurrent_buffers() + prefetch_depth if prefetch_depth else None
+    callback = MemoryLimitCallback(memory_limit, max_buffers)
+    buffer_keys = set(key for key, task in dsk.items() if is_buffer_task(key, task))
+    io_threads = get_io_threads(dsk, buffer_keys) if buffer_keys else None
+
+    ignored = [name for name in kwargs if name not in GET_KWARGS + ('callbacks',)]
+    if ignored:
+        logger.warning(f'Arguments {ignored} not supported by the scheduler, ignored.')
+    callbacks = kwargs.pop('callbacks', None)
+    kwargs = {name: value for name, value in kwargs.items() if name in GET_KWARGS}
+
+    with local_callbacks(callbacks) as callbacks:
+        callbacks = [normalize_callback(cb) for cb in callbacks] + [callback._callback]
+        if not io_threads:
+            result = threaded.get(dsk, keys, num_workers=num_workers, callbacks=callbacks, **kwargs)
+        else:
+            compute_threads = num_workers or dask.config.get("num_workers", None) or os.cpu_count() or 1
+            router = IORouterCallback(get_executor('compute', compute_threads), get_executor('io', io_threads), buffer_keys)
+            result = get_async(
+                router.apply_async, 
+                compute_threads + io_threads, 
+                dsk, 
+                keys, 
+                get_id=threading.get_ident, 
+                pack_exception=threaded.pack_exception, 
+                callbacks=callbacks + [router._callback],
+                **kwargs)
+    logger.debug(f'Max bytes of buffers in memory: {callback.max_bytes}, deferred loads: {callback.deferred_loads}, '
+                 f'I/O threads: {io_threads}')
+    return result
@@ -0,0 +1,194 @@
+import logging
+
+import numpy as np
+from h5py import Dataset
+
+logger = logging.getLogger(__name__)
+
+
+"""
+    Registry of the source adapters used to recognize the original arrays of a dask graph.
+
+    An original array is an object stored as is in the dask graph (see dask.array.from_array),
+    from which the proxies read blocks using a getter. An adapter recognizes a type of object
+    and describes its physical layout as a dictionary:
+        chunks: shape of the physical chunks, None if the data is not chunked
+        order: 'C' or 'F', order of the data on disk
+        contiguous: True if the data is stored in one contiguous block on disk
+    and may give an identifier of the data on disk, used to cache the buffers between computations (see io_tasks).
+    Adapters also read parts of the original arrays into preallocated arrays (see read_into).
+
+    New adapters can be added using register_source_adapter.
+"""
+
+
+class SourceAdapter():
+    """ Base class of the source adapters.
+    """
+    name = None
+
+    def match(self, obj):
+        """ Return True if obj can be handled by the adapter.
+        """
+        raise NotImplementedError()
+
+    def get_layout(self, obj):
+        """ Return the physical layout of obj.
+        """
+        raise NotImplementedError()
+
+    def get_id(self, obj):
+        """ Return a hashable identifier of the data of obj on disk, or None if it has none.
+        """
+        return None
+
+    def read_into(self, obj, slices, out):
+        """ Read the part slices of obj into the array out.
+        """
+        out[...] = obj[slices]
+
+    def get_path(self, obj):
+        """ Return the path of the file or directory storing obj, or None.
+        """
+        return None
+
+
+class HDF5Adapter(SourceAdapter):
+    """ h5py datasets.
+    """
+    name = 'hdf5'
+
+    def match(self, obj):
+        return isinstance(obj, Dataset)
+
+    def get_layout(self, obj):
+        return {'chunks': obj.chunks, 'order': 'C', 'contiguous': obj.chunks is None}
+
+    def get_id(self, obj):
+        return ('hdf5', obj.file.filename, obj.name)
+
+    def read_into(self, obj, slices, out):
+        obj.read_direct(out, source_sel=slices)
+
+    def get_path(self, obj):
+        return obj.file.filename
+
+
+class MemmapAdapter(SourceAdapter):
+    """ numpy memory-mapped arrays, i.e. .npy files opened with np.load(mmap_mode=...)
+    and raw binary files opened with np.memmap.
+    """
+    name = 'memmap'
+
+    def match(self, obj):
+        return isinstance(obj, np.memmap)
+
+    def get_layout(self, obj):
+        order = 'F' if obj.flags.f_contiguous and not obj.flags.c_contiguous else 'C'
+        return {'chunks': None, 'order': order, 'contiguous': True,
+                'filename': obj.filename, 'offset': obj.offset}
+
+    def get_id(self, obj):
+        if obj.filename is None:
+            return None
+        return ('memmap', obj.filename, obj.offset, obj.dtype.str, obj.shape, obj.flags.f_contiguous)
+
+    def get_path(self, obj):
+        return obj.filename
+
+
+class ZarrAdapter(SourceAdapter):
+    """ zarr-like arrays, stored as a directory of chunks.
+    Recognized by duck typing, so that zarr is not required.
+    """
+    name = 'zarr'
+
+    def match(self, obj):
+        return (type(obj).__module__.split('.')[0] == 'zarr'
+                and hasattr(obj, 'chunks')
+                and hasattr(obj, 'store'))
+
+    def get_layout(self, obj):
+        return {'chunks': tuple(obj.chunks), 'order': getattr(obj, 'order', 'C'), 'contiguous': False}
+
+    def get_id(self, obj):
+        store_path = getattr(obj.store, 'path', None)
+        if store_path is None:
+            return None
+        return ('zarr', str(store_path), getattr(obj, 'path', ''))
+
+    def get_path(self, obj):
+        store_path = getattr(obj.store, 'path', None)
+        return str(store_path) if store_path is not None else None
+
+
+SOURCE_ADAPTERS = [HDF5Adapter(), MemmapAdapter(), ZarrAdapter()]
+
+
+def register_source_adapter(adapter):
+    """ Add a source adapter to the registry.
+    Adapters registered last are tried first, so that an adapter can override the default ones.
+    """
+    if not isinstance(adapter, SourceAdapter):
+        raise TypeError('Not a SourceAdapter')
+    SOURCE_ADAPTERS.insert(0, adapter)
+
+
+def unregister_source_adapter(adapter):
+    SOURCE_ADAPTERS.remove(adapter)
+
+
+def get_source_adapter(obj):
+    """ Return the first adapter of the registry matching obj, or None.
+    """
+    for adapter in SOURCE_ADAPTERS:
+        if adapter.match(obj):
+            return adapter
+    return None
+
+
+def is_source(key, obj):
+    """ Check if the task obj at key of a dask graph is an original array.
+    Objects under a key containing "array-original" (default name given by dask.array.from_array)
+    are considered original arrays even if no adapter matches them.
+    """
+    if get_source_adapter(obj) is not None:
+        return True
+    return isinstance(key, str) and "array-original" in key
+
+
+def get_layout(obj):
+    """ Return the physical layout of an original array, or None if no adapter matches it.
+    """
+    adapter = get_source_adapter(obj)
+    if adapter is None:
+        return None
+    return adapter.get_layout(obj)
+
+
+def get_source_id(obj):
+    """ Return the identifier of an original array on disk, or None if no adapter matches it or it has none.
+    """
+    adapter = get_source_adapter(obj)
+    if adapter is None:
+        return None
+    return adapter.get_id(obj)
+
+
+def get_path(obj):
+    """ Return the path of the file storing an original array, or None if no adapter matches it or it has none.
+    """
+    adapter = get_source_adapter(obj)
+    if adapter is None:
+        return None
+    return adapter.get_path(obj)
+
+
+def read_into(obj, slices, out):
+    """ Read the part slices of an original array into the array out, without intermediate array if the adapter allows it.
+    """
+    adapter = get_source_adapter(obj)
+    if adapter is None:
+        out[...] = obj[slices]
+    else:
+        adapter.read_into(obj, slices, out)
@@ -0,0 +1,167 @@
+import time
+import threading
+import logging
+import contextlib
+
+import dask
+
+logger = logging.getLogger(__name__)
+
+
+"""
+    Timings and counters of the optimization function.
+
+    An OptimizationStats object is created for each call to the optimization function (see start_stats).
+    The functions of the optimizer record their timings and counters into it using the timer and incr functions,
+    which do nothing if no optimization is running in the current thread.
+
+    When the optimization ends (see end_stats), the stats are passed to the callback stored
+    in the ``io-optimizer.stats_callback" configuration, if any, and can be retrieved using get_last_stats.
+
+    Phases:
+    -------
+        proxy_search: single traversal of the graph (search_dask_graph)
+        reachability: search of the proxies used by the output keys
+        get_blocks_used, buffering, merge_rows, merge_slices: buffers creation (create_buffers).
+            Timing of buffering includes the merges.
+        create_buffer_node, update_io_tasks: graph rewrite
+        total: whole optimization function
+
+    Counters:
+    ---------
+        tasks_scanned, proxies_found, blocks_used, buffers_created, plan_cache_hits,
+        read_calls, seeks, bytes_read, bytes_wasted (estimated by the planner)
+
+    Strategies:
+    -----------
+        buffering strategy chosen for each original array (see planner)
+"""
+
+LOCAL = threading.local()
+LAST_STATS = None
+
+
+class OptimizationStats():
+    """ Timings (in seconds) and counters of one call to the optimization function.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = dict()
+        self.counters = dict()
+        self.strategies = dict()
+        self.max_blocks_per_buffer = 0
+
+    def add_time(self, phase, seconds):
+        with self.lock:
+            self.timings[phase] = self.timings.get(phase, 0) + seconds
+
+    def incr(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def add_buffer(self, buffer):
+        """ Record a buffer created, buffer being the list of the blocks it contains.
+        """
+        self.incr('buffers_created')
+        self.incr('blocks_in_buffers', len(buffer))
+        with self.lock:
+            self.max_blocks_per_buffer = max(self.max_blocks_per_buffer, len(buffer))
+
+    @property
+    def avg_blocks_per_buffer(self):
+        nb_buffers = self.counters.get('buffers_created', 0)
+        if not nb_buffers:
+            return 0
+        return self.counters['blocks_in_buffers'] / nb_buffers
+
+    def to_dict(self):
+        d = {'timings': dict(self.timings), 'counters': dict(self.counters), 'strategies': dict(self.strategies)}
+        d['counters']['avg_blocks_per_buffer'] = self.avg_blocks_per_buffer
+        d['counters']['max_blocks_per_buffer'] = self.max_blocks_per_buffer
+        return d
+
+    def __repr__(self):
+        return f'OptimizationStats({self.to_dict()})'
+
+
+def current_stats():
+    """ Return the stats of the optimization running in the current thread, or None.
+    """
+    return getattr(LOCAL, 'stats', None)
+
+
+def start_stats():
+    LOCAL.stats = OptimizationStats()
+    return LOCAL.stats
+
+
+@contextlib.contextmanager
+def use_stats(stats):
+    """ Record into the given stats in the current thread, to share the stats of an optimization with worker threads.
+    """
+    previous = current_stats()
+    LOCAL.stats = stats
+    try:
+        yield stats
+    finally:
+        LOCAL.stats = previous
+
+
+def end_stats():
+    """ Close the stats of the current optimization, store them as last stats and send them to the stats callback.
+    """
+    global LAST_STATS
+    stats = current_stats()
+    LOCAL.stats = None
+    if stats is None:
+        return None
+
+    LAST_STATS = stats
+    logger.debug('Optimization stats: %s', stats)
+    callback = dask.config.get("io-optimizer.stats_callback", None)
+    if callback:
+        callback(stats)
+    return stats
+
+
+def get_last_stats():
+    """ Return the stats of the last optimization that ended.
+    """
+    return LAST_STATS
+
+
+@contextlib.contextmanager
+def timer(phase):
+    """ Add the time spent in the context to the phase of the current stats.
+    """
+    stats = current_stats()
+    if stats is None:
+        yield
+        return
+
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.add_time(phase, time.perf_counter() - t)
+
+
+def incr(counter, n=1):
+    stats = current_stats()
+    if stats is not None:
+        stats.incr(counter, n)
+
+
+def set_strategy(origarr_name, strategy):
+    """ Record the buffering strategy chosen for an original array.
+    """
+    stats = current_stats()
+    if stats is not None:
+        with stats.lock:
+            stats.strategies[origarr_name] = strategy
+
+
+def add_buffer(buffer):
+    stats = current_stats()
+    if stats is not None:
+        stats.add_buffer(buffer)
@@ -1,3 +1,4 @@
+import math
 from h5py import Dataset
 import dask
 import logging
@@ -7,7 +8,7 @@ logger = logging.getLogger(__name__)
 
 def get_array_block_dims(shape, chunk_shape):
     """ from shape of image and size of chukns=blocks, return the dimensions of the array in terms of blocks
-    i.e. number of blocks in each dimension
+    i.e. number of blocks in each dimension, including partial blocks at the edges
     """
     chunks = chunk_shape 
     logger.debug(f'Chunks for get_array_block_dims: {chunks}')
@@ -16,7 +17,7 @@ def get_array_block_dims(shape, chunk_shape):
             "chunks and shape should have the same dimension",
             shape,
             chunks)
-    return tuple([int(s / c) for s, c in zip(shape, chunks)])
+    return tuple([math.ceil(s / c) for s, c in zip(shape, chunks)])
 
 
 def get_arr_shapes(arr, dtype=False):
@@ -64,7 +64,9 @@ def add_to_dict_of_lists(d, k, v, unique=False):
     return d
 
 
-def flatten_iterable(l, plain_list=list()):
+def flatten_iterable(l, plain_list=None):
+    if plain_list is None:
+        plain_list = list()
     for e in l:
         if isinstance(e, list) and not isinstance(e, (str, bytes)):
             plain_list = flatten_iterable(e, plain_list)
@@ -102,4 +104,63 @@ def _3d_to_numeric_pos(_3d_pos, shape, order):
         raise ValueError("unsupported")
 
     return (_3d_pos[0] * nb_blocks_per_slice) + \
-        (_3d_pos[1] * nb_blocks_per_row) + _3d_pos[2]
\ No newline at end of file
+        (_3d_pos[1] * nb_blocks_per_row) + _3d_pos[2]
+
+def numeric_to_nd_pos(numeric_pos, blocks_shape, order):
+    """ N-dimensional version of numeric_to_3d_pos.
+    With order 'F', the last axis is the fastest-varying one (as in numeric_to_3d_pos).
+    """
+    if order != 'F':
+        raise ValueError("unsupported")
+
+    pos = list()
+    for nb_blocks in reversed(blocks_shape):
+        pos.append(numeric_pos % nb_blocks)
+        numeric_pos = numeric_pos // nb_blocks
+    return tuple(reversed(pos))
+
+
+def _nd_to_numeric_pos(_nd_pos, shape, order):
+    """ N-dimensional version of _3d_to_numeric_pos.
+    """
+    if order != 'F':
+        raise ValueError("unsupported")
+
+    numeric_pos = 0
+    for i, nb_blocks in zip(_nd_pos, shape):
+        numeric_pos = numeric_pos * nb_blocks + i
+    return numeric_pos
+
+
+def get_available_memory():
+    """ Return the memory available on the machine in bytes, using psutil if installed, sysconf otherwise.
+    Returns None if it cannot be found.
+    """
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def is_rotational(path):
+    """ Check if the file at path is stored on a rotational disk (HDD), using /sys/dev/block (Linux only).
+    Returns None if it cannot be found.
+    """
+    try:
+        st = os.stat(path)
+        device_dir = os.path.realpath(f'/sys/dev/block/{os.major(st.st_dev)}:{os.minor(st.st_dev)}')
+    except (OSError, ValueError):
+        return None
+
+    while device_dir.startswith('/sys/'):  # partitions have the queue information in their parent directory
+        rotational_file = os.path.join(device_dir, 'queue', 'rotational')
+        if os.path.isfile(rotational_file):
+            with open(rotational_file) as f:
+                return f.read().strip() == '1'
+        device_dir = os.path.dirname(device_dir)
+    return None
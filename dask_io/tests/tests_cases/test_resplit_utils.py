@@ -1,3 +1,4 @@
+import numpy as np
 from dask_io.optimizer.cases.resplit_utils import *
 from dask_io.optimizer.utils.utils import _3d_to_numeric_pos
 
@@ -124,6 +125,22 @@ def test_get_crossed_outfiles():
         assert set(expected[buffer_index]) == set(indices)
 
 
+def test_get_crossed_indices():
+    """ The indices computed should be the output files found by testing the overlap with all output files.
+    """
+    R, O = (120, 120, 60), (40, 30, 20)
+    outfiles = get_named_volumes(get_blocks_shape(R, O), O)
+    assert get_grid(outfiles) == (O, (3, 4, 3))
+
+    np.random.seed(42)
+    for _ in range(50):
+        p1 = tuple(int(x) for x in np.random.randint(0, 100, size=3))
+        p2 = tuple(a + int(x) for a, x in zip(p1, np.random.randint(0, 50, size=3)))
+        volume = Volume(0, p1, p2)
+        expected = [v.index for v in outfiles.values() if hypercubes_overlap(volume, v)]
+        assert get_crossed_indices(volume, O, (3, 4, 3)) == expected
+
+
 def test_merge_volumes():
     v1 = Volume(0, (0,40,1), (40,60,1))
     v2 = Volume(1, (0,60,1), (40,80,1))
@@ -0,0 +1,87 @@
+import h5py
+import pytest
+import numpy as np
+import dask.array as da
+
+from dask_io.optimizer.configure import enable_clustering, disable_clustering
+from dask_io.optimizer.stats import get_last_stats
+from dask_io.optimizer.clustered_writes import *  # package being tested
+
+
+@pytest.fixture
+def data():
+    return np.random.random_sample((40, 40, 40))
+
+
+def test_get_regions_grid():
+    regions = [(slice(0, 10), slice(0, 5)), (slice(0, 10), slice(5, 20)), (slice(10, 15), slice(5, 20))]
+    blocks_shape, boundaries, blocks = get_regions_grid(regions)
+    assert blocks_shape == (2, 2)
+    assert boundaries == ([0, 10, 15], [0, 5, 20])
+    assert blocks == [0, 1, 3]
+
+    assert get_regions_grid([(slice(0, 10),), (slice(5, 15),)]) is None  # overlap
+    assert get_regions_grid([(slice(0, 10),), (slice(0, 10),)]) is None  # same region
+
+
+def test_is_full_box():
+    assert is_full_box([0, 1, 4, 5], (4, 4))
+    assert not is_full_box([0, 1, 5], (4, 4))
+    assert not is_full_box([3, 4], (4, 4))
+
+
+@pytest.mark.parametrize("region", [None, (slice(10, 50), slice(0, 40), slice(0, 40))])
+def test_clustered_writes(tmp_path, data, region):
+    in_path, out_path = str(tmp_path / 'in.hdf5'), str(tmp_path / 'out.hdf5')
+    with h5py.File(in_path, 'w') as f:
+        f.create_dataset('/data', data=data)
+
+    with h5py.File(in_path, 'r') as f, h5py.File(out_path, 'w') as out:
+        arr = da.from_array(f['/data'], chunks=(10, 10, 10)) + 1
+        shape = (60, 40, 40) if region else data.shape
+        dset = out.create_dataset('/data', shape=shape, dtype=data.dtype, fillvalue=-1)
+        enable_clustering(10 * 40 * 40 * data.itemsize, clustered_writes=True)  # one slice of blocks
+        da.store(arr, dset, regions=region, compute=False).compute()
+        counters = get_last_stats().to_dict()['counters']
+        disable_clustering()
+
+        if region:
+            assert np.all(dset[:10] == -1) and np.all(dset[50:] == -1)
+            assert np.array_equal(dset[10:50], data + 1)
+        else:
+            assert np.array_equal(dset[()], data + 1)
+    assert counters['write_buffers'] == 4
+    assert counters['stores_merged'] == 64
+
+
+def test_clustered_writes_chunked_target_offset(tmp_path):
+    """ Regions at an offset of a physically chunked target are written once, aligned on the physical chunks.
+    """
+    data = np.random.random_sample((20, 40))
+    region = (slice(1, 21), slice(2, 42))
+    with h5py.File(str(tmp_path / 'out.hdf5'), 'w') as out:
+        dset = out.create_dataset('/data', shape=(50, 50), dtype=data.dtype, chunks=(15, 15), fillvalue=-1)
+        enable_clustering(10 ** 6, clustered_writes=True)
+        da.store(da.from_array(data, chunks=(10, 10)), dset, regions=region)
+        counters = get_last_stats().to_dict()['counters']
+        disable_clustering()
+
+        assert np.array_equal(dset[region], data)
+        assert np.sum(dset[()] == -1) == 50 * 50 - data.size
+    assert counters['stores_merged'] == 8
+
+
+def test_clustered_writes_disabled(tmp_path, data):
+    in_path, out_path = str(tmp_path / 'in.hdf5'), str(tmp_path / 'out.hdf5')
+    with h5py.File(in_path, 'w') as f:
+        f.create_dataset('/data', data=data)
+
+    with h5py.File(in_path, 'r') as f, h5py.File(out_path, 'w') as out:
+        arr = da.from_array(f['/data'], chunks=(10, 10, 10)) + 1
+        dset = out.create_dataset('/data', shape=data.shape, dtype=data.dtype)
+        enable_clustering(10 * 40 * 40 * data.itemsize)  # disabled by default
+        da.store(arr, dset)
+        counters = get_last_stats().to_dict()['counters']
+        disable_clustering()
+        assert np.array_equal(dset[()], data + 1)
+    assert not 'write_buffers' in counters
@@ -1,12 +1,17 @@
 import os 
 import sys
 import pytest
+import numpy as np
+import dask
+import dask.array as da
 
 from dask_io.optimizer.configure import enable_clustering
 from dask_io.optimizer.cases.case_config import Split
 from dask_io.optimizer.utils.array_utils import get_arr_shapes
 from dask_io.optimizer.utils.get_arrays import get_dask_array_from_hdf5
 from dask_io.optimizer.find_proxies import get_used_proxies
+from dask_io.optimizer.stats import get_last_stats
+from dask_io.optimizer.utils.utils import get_available_memory
 from dask_io.optimizer.clustering import *  # package being tested
 
 from ..utils import create_test_array_nochunk, ONE_GIG
@@ -202,11 +207,41 @@ def test_create_buffer_node():
 
     
 def test_get_load_strategy():
-    strat, max_nb_blocks = get_load_strategy(4000, (10, 10, 1), None, nb=4)
+    strat, max_nb_blocks = get_load_strategy(4000, (10, 10, 1), None, itemsize=4)
     assert strat == 'blocks'
     assert max_nb_blocks == 10
 
 
+def test_get_memory_budget():
+    enable_clustering(ONE_GIG)
+    assert get_memory_budget() == ONE_GIG
+
+    enable_clustering(ONE_GIG, concurrent_buffers=4)
+    assert get_memory_budget() == ONE_GIG // 4
+
+    enable_clustering(ONE_GIG, concurrent_buffers=2, prefetch_depth=2)
+    assert get_memory_budget() == ONE_GIG // 4
+
+    with dask.config.set({'num_workers': 2}):
+        enable_clustering(ONE_GIG, concurrent_buffers='auto')
+        assert get_memory_budget() == ONE_GIG // 2
+
+        enable_clustering('auto')
+        budget = get_memory_budget()
+        assert budget > 0
+        assert budget * 2 <= get_available_memory()
+
+
+def test_itemsize_budget():
+    """ The number of blocks per buffer should depend on the dtype of the original array.
+    """
+    for dtype, nb_blocks in [(np.uint8, 8), (np.float64, 1)]:
+        arr = da.from_array(np.ones((40, 40), dtype=dtype), chunks=(10, 10)) + 1
+        enable_clustering(10 * 10 * 8)
+        arr.compute()
+        assert get_last_stats().to_dict()['counters']['max_blocks_per_buffer'] == nb_blocks
+
+
 def test_start_new_buffer():    
     # WARNING: only blocks strategy have been implemented so far
 
@@ -311,4 +346,72 @@ def test_buffering():
     row_concat, slices_concat = (False, False)
     exp = [[0,1,2,3], [6,7], [8, 9, 10, 11], [12]]
     out = buffering(blocks, strategy, blocks_shape, max_nb_blocks_per_buffer, row_concat=row_concat, slices_concat=slices_concat)
-    assert out == exp
\ No newline at end of file
+    assert out == exp
+
+
+def test_buffering_nd():
+    """ In 4D, complete slices of two different volumes should not be merged together.
+    """
+    strategy = "blocks"
+    blocks_shape = (2, 3, 2, 2)  # 3 slices of 4 blocks per volume
+    blocks = list(range(24))
+    out = buffering(blocks, strategy, blocks_shape, 8)
+    assert out == [list(range(8)), list(range(8, 12)), list(range(12, 20)), list(range(20, 24))]
+
+    blocks = list(range(24))
+    out = buffering(blocks, strategy, blocks_shape, 24)
+    assert out == [list(range(12)), list(range(12, 24))]
+
+
+def test_get_buffer_slices_from_original_array_nd():
+    blocks_shape = (2, 3, 2, 2)
+    boundaries = ([0, 1, 2], [0, 5, 10, 15], [0, 10, 20], [0, 10, 20])
+    slices = get_buffer_slices_from_original_array(list(range(12, 20)), blocks_shape, boundaries)
+    assert slices == (slice(1, 2), slice(0, 10), slice(0, 20), slice(0, 20))
+
+    # irregular chunks with partial edge blocks
+    boundaries = ([0, 1, 3], [0, 5, 10, 12], [0, 7, 20], [0, 10, 15])
+    slices = get_buffer_slices_from_original_array(list(range(20, 24)), blocks_shape, boundaries)
+    assert slices == (slice(1, 3), slice(10, 12), slice(0, 20), slice(0, 15))
+
+
+def test_get_covered_blocks_irregular():
+    boundaries = ([0, 30, 70, 103], [0, 57], [0, 10, 30, 41])
+    slice_tuple = (slice(30, 103), slice(0, 57), slice(10, 30))
+    ranges = get_covered_blocks(slice_tuple, None, boundaries)
+    assert [list(r) for r in ranges] == [[1, 2], [0], [1]]
+
+
+def test_get_blocks_used_overlapping_proxies():
+    """ Proxies covering several blocks, and blocks covered by several proxies.
+    """
+    proxy_to_slices = {
+        'p0': (slice(0, 10), slice(0, 20)),
+        'p1': (slice(5, 25), slice(10, 20)),
+        'p2': (slice(30, 40), slice(0, 10)),
+    }
+    dicts = {
+        'origarr_to_used_proxies': {'origarr': list(proxy_to_slices.keys())},
+        'origarr_to_blocks_shape': {'origarr': (4, 2)},
+        'origarr_to_boundaries': {'origarr': ([0, 10, 20, 30, 40], [0, 10, 20])},
+        'proxy_to_slices': proxy_to_slices
+    }
+    blocks_used, block_to_proxies = get_blocks_used(dicts, 'origarr', None, (10, 10))
+    assert blocks_used == [0, 1, 3, 5, 6]
+    assert block_to_proxies == {0: ['p0'], 1: ['p0', 'p1'], 3: ['p1'], 5: ['p1'], 6: ['p2']}
+
+
+def test_run_length_buffering():
+    """ The run-length buffering engine should give the same buffers as the reference engine.
+    """
+    rng = np.random.RandomState(0)
+    for _ in range(1000):
+        blocks_shape = tuple(rng.randint(1, 5, size=rng.randint(1, 6)))
+        nb_blocks = int(np.prod(blocks_shape))
+        blocks = np.flatnonzero(rng.rand(nb_blocks) < rng.choice([0.3, 0.7, 1.0])).tolist()
+        max_nb_blocks_per_buffer = rng.randint(1, nb_blocks + 2)
+        row_concat, slices_concat = bool(rng.randint(2)), bool(rng.randint(2))
+
+        expected = reference_buffering(list(blocks), "blocks", blocks_shape, max_nb_blocks_per_buffer, row_concat, slices_concat)
+        out = run_length_buffering(blocks, "blocks", blocks_shape, max_nb_blocks_per_buffer, row_concat, slices_concat)
+        assert out == expected
@@ -0,0 +1,83 @@
+import h5py
+import pytest
+import numpy as np
+import dask.array as da
+
+from dask_io.optimizer.configure import enable_clustering, disable_clustering
+from dask_io.optimizer.stats import get_last_stats
+from dask_io.optimizer.dry_run import *  # package being tested
+
+
+R, I, O = (60, 60, 60), (15, 15, 15), (20, 20, 20)
+COST_MODEL = (0.01, 150 * 10**6)
+
+
+def test_get_outfiles_patterns():
+    patterns = get_outfiles_patterns((60,), (15,), (20,))
+    assert sorted(patterns) == [(((0, 5, 20),), 1), (((0, 10, 20),), 1), (((0, 15, 20),), 1)]
+    patterns = get_outfiles_patterns(R, I, O)
+    assert len(patterns) == 27
+    assert sum(count for _, count in patterns) == 27
+
+
+def test_get_boxes_cost():
+    boxes = [(slice(0, 10), slice(0, 20)), (slice(10, 20), slice(0, 5)), (slice(10, 20), slice(5, 20))]
+    cost = get_boxes_cost(boxes, (20, 20), 1, cost_model=COST_MODEL)
+    assert cost['read_calls'] == 3
+    assert cost['bytes_read'] == 400
+    assert cost['seeks'] == 1 + 10 + 10
+
+
+def test_dry_run():
+    estimates, recommended = dry_run(R, I, O, 'f4', [100000, 400000, 2 * 10**6], cost_model=COST_MODEL)
+    none = [e for e in estimates if e['strategy'] == 'none'][0]
+    assert none['read_calls'] == 64
+    assert none['write_calls'] == 216
+    assert none['bytes_read'] == none['bytes_written'] == 60 * 60 * 60 * 4
+
+    for e in estimates:
+        assert e['bytes_read'] == e['bytes_written'] == 60 * 60 * 60 * 4
+        if e['strategy'] != 'none':
+            assert e['read_calls'] <= none['read_calls'] and e['write_calls'] <= none['write_calls']
+
+    keep = [e for e in estimates if e['strategy'] == 'keep']
+    assert [e['buffer_size'] for e in keep] == [400000, 2 * 10**6]  # no plan fits into 100000 bytes
+    assert keep[0]['plan']['volumestokeep'] == [1, 2, 3] and keep[0]['write_calls'] == 50
+    assert keep[1]['write_calls'] == 27
+
+    assert recommended['peak_memory'] <= recommended['buffer_size']
+    assert recommended['cost'] == min(e['cost'] for e in estimates if e['buffer_size'] and e['peak_memory'] <= e['buffer_size'])
+
+
+def test_dry_run_unsupported_keep():
+    """ The keep estimates are skipped or use another buffer shape when the keep algorithm does not apply to a shape.
+    """
+    R, I, O = (24, 12, 24), (4, 4, 4), (12, 12, 12)
+    estimates, recommended = dry_run(R, I, O, 'f4', [10**6, 10**9], cost_model=COST_MODEL)
+    keep = [e for e in estimates if e['strategy'] == 'keep']
+    assert len(keep) == 2 and all(e['plan']['B'] == (12, 12, 24) for e in keep)
+    assert all(e['bytes_written'] == 24 * 12 * 24 * 4 for e in estimates)
+    assert recommended is not None
+
+    estimates, _ = dry_run((24, 12, 24), I, (10, 12, 12), 'f4', [10**6], cost_model=COST_MODEL)
+    assert [e['strategy'] for e in estimates] == ['none', 'clustered']
+
+
+def test_dry_run_matches_optimizer(tmp_path):
+    """ The reads estimated should be the reads planned by the optimizer.
+    """
+    data = np.random.random_sample(R).astype('f4')
+    in_path, out_path = str(tmp_path / 'in.hdf5'), str(tmp_path / 'out.hdf5')
+    with h5py.File(in_path, 'w') as f:
+        f.create_dataset('/data', data=data)
+
+    buffer_size = 400000
+    estimates, _ = dry_run(R, I, O, 'f4', [buffer_size], strategies=['clustered'], cost_model=COST_MODEL)
+    with h5py.File(in_path, 'r') as f, h5py.File(out_path, 'w') as out:
+        dset = out.create_dataset('/data', shape=R, dtype='f4')
+        enable_clustering(buffer_size, clustered_writes=True)
+        da.store(da.from_array(f['/data'], chunks=I), dset)
+        counters = get_last_stats().to_dict()['counters']
+        disable_clustering()
+    assert counters['read_calls'] == estimates[0]['read_calls']
+    assert counters['bytes_read'] == estimates[0]['bytes_read']
@@ -1,4 +1,6 @@
 import os, pytest
+import numpy as np
+import dask.array as da
 
 from dask_io.optimizer.configure import enable_clustering
 from dask_io.optimizer.utils.utils import CHUNK_SHAPES_EXP1
@@ -35,6 +37,21 @@ def test_get_array_block_dims():
     expected = (5, 4, 15)
     assert block_dims == expected
 
+    shape = (1540, 1610, 1400)
+    chunks = (770, 605, 700)
+    assert get_array_block_dims(shape, chunks) == (2, 3, 2)
+
+
+def test_get_blocks_boundaries():
+    """ Boundaries should be found for irregular chunks and partial edge blocks.
+    """
+    arr = da.from_array(np.zeros((103, 57, 41)), chunks=((30, 40, 33), (57,), (20, 20, 1)))
+    chunk_shape, dicts = get_used_proxies(arr.dask.dicts)
+    origarr_name = list(dicts['origarr_to_obj'].keys())[0]
+    assert dicts['origarr_to_boundaries'][origarr_name] == ([0, 30, 70, 103], [0, 57], [0, 20, 40, 41])
+    assert dicts['origarr_to_blocks_shape'][origarr_name] == (3, 1, 3)
+    assert chunk_shape == (40, 57, 20)
+
 
 def test_get_graph_from_dask():
     """ Test if it runs well.
@@ -50,6 +67,26 @@ def test_get_graph_from_dask():
     graph = get_graph_from_dask(dask_graph, undirected=False)
 
 
+def test_get_used_proxies_from_keys():
+    """ Only the proxies reachable from the output keys should be returned.
+    """
+    case = Split(pytest.test_array_path, (20, 20, 20))
+    case.sum(nb_chunks=2)
+    dask_array = case.get()
+    graph = dask_array.dask.dicts
+
+    _, dicts = get_used_proxies(graph)
+    assert len(dicts['proxy_to_slices']) == 125
+
+    _, dicts = get_used_proxies(graph, dask_array.__dask_keys__())
+    assert len(dicts['proxy_to_slices']) == 2
+
+
+def test_get_dependencies():
+    task = (sum, [('a', 0), ('a', 1)], (len, 'b'), (slice(0, 1, None),))
+    assert get_dependencies(task) == [('a', 0), ('a', 1), 'b']
+
+
 def test_BFS():
     graph = {
         'a': ['b', 'c'],
@@ -68,6 +105,23 @@ def test_BFS():
     assert depth == 1
 
 
+def test_get_reachable_nodes():
+    graph = {
+        'a': ['b', 'c'],
+        'b': [],
+        'c': ['d', 'e'],
+        'd': [],
+        'e': [],
+        'f': ['e'],
+        'g': ['h']
+    }
+    reachable = get_reachable_nodes(['a', 'f'], graph)
+    assert reachable == {'a', 'b', 'c', 'd', 'e', 'f'}
+
+    expected = set(standard_BFS('a', graph)[0]) | set(standard_BFS('f', graph)[0])
+    assert reachable == expected
+
+
 def test_get_root_nodes():
     graph = {
         'a': ['b', 'c'],
@@ -0,0 +1,44 @@
+import os, json
+import pytest
+import dask
+
+from dask_io.optimizer.configure import enable_clustering, enable_graph_dump, disable_graph_dump
+from dask_io.optimizer.graph_dump import *  # package being tested
+
+from ..utils import ONE_GIG
+
+
+graph = {
+    'layer-a': {('a', i): (sum, [i]) for i in range(10)},
+    'layer-b': {('b', 0): (sum, [('a', i) for i in range(10)])}
+}
+
+
+def test_sample_tasks():
+    assert len(sample_tasks(graph)) == 11
+    assert [k for k, _ in sample_tasks(graph, every=5)] == [('a', 0), ('a', 5), ('b', 0)]
+    assert [k for k, _ in sample_tasks(graph, max_tasks=2)] == [('a', 0), ('a', 1)]
+
+
+def test_dump_graph_disabled():
+    enable_clustering(ONE_GIG)
+    assert dump_graph(graph, 'test_graph') == None
+
+
+def test_dump_graph():
+    enable_clustering(ONE_GIG)
+    enable_graph_dump(directory='./', fmt='jsonl', every=2)
+    file_path = dump_graph(graph, 'test_graph')
+    flush()
+
+    with open(file_path) as f:
+        lines = [json.loads(l) for l in f.readlines()]
+    assert len(lines) == 6
+    assert lines[0]['key'] == str(('a', 0))
+
+    disable_graph_dump()
+    assert dump_graph(graph, 'test_graph') == None
+
+    with dask.config.set({'io-optimizer.graph_dump': {'format': 'bad'}}):
+        with pytest.raises(ValueError):
+            dump_graph(graph, 'test_graph')
@@ -0,0 +1,143 @@
+import h5py
+import pytest
+import numpy as np
+import dask.array as da
+
+from dask_io.optimizer.configure import enable_clustering, enable_buffer_cache, disable_buffer_cache, enable_buffer_pool, disable_buffer_pool
+from dask_io.optimizer.io_tasks import *  # package being tested
+
+from ..utils import ONE_GIG
+
+
+def test_buffer_cache():
+    data = np.arange(100).reshape(10, 10)
+    cache = BufferCache(2 * data.nbytes)
+    cache.put('a', (slice(0, 10), slice(0, 10)), data.copy())
+    assert cache.get('b', (slice(0, 10), slice(0, 10))) is None
+    assert np.array_equal(cache.get('a', (slice(0, 10), slice(0, 10))), data)
+    assert np.array_equal(cache.get('a', (slice(2, 5), slice(3, 10))), data[2:5, 3:10])
+    assert cache.get('a', (slice(2, 5), slice(3, 11))) is None  # partially outside
+    assert cache.info()['hits'] == 2 and cache.info()['misses'] == 2
+
+    cache.put('b', (slice(0, 10), slice(0, 10)), data.copy())
+    cache.get('a', (slice(0, 1), slice(0, 1)))  # 'a' is now the most recently used
+    cache.put('c', (slice(0, 10), slice(0, 10)), data.copy())
+    assert cache.get('b', (slice(0, 10), slice(0, 10))) is None
+    assert cache.get('a', (slice(0, 10), slice(0, 10))) is not None
+    assert cache.info()['nbytes'] == 2 * data.nbytes
+
+    cache.put('d', (slice(0, 20), slice(0, 20)), np.zeros((20, 20)))  # bigger than the cache
+    assert cache.info()['size'] == 2
+
+
+def test_buffer_cache_partial():
+    data = np.arange(100).reshape(10, 10)
+    cache = BufferCache(10 * data.nbytes)
+    cache.put('a', (slice(0, 5), slice(0, 10)), data[:5].copy())
+    cache.put('a', (slice(0, 10), slice(0, 3)), data[:, :3].copy())
+    reads = list()
+    def read(slices):
+        reads.append(slices)
+        return data[slices].copy()
+
+    result = cache.get('a', (slice(2, 10), slice(1, 10)), read=read)
+    assert np.array_equal(result, data[2:10, 1:10])
+    assert reads == [(slice(5, 10), slice(3, 10))]  # only the missing part is read
+    info = cache.info()
+    assert info['partial_hits'] == 1 and info['bytes_missed'] == data[5:10, 3:10].nbytes
+    assert info['bytes_hit'] == result.nbytes - data[5:10, 3:10].nbytes
+
+    assert np.array_equal(cache.get('b', (slice(0, 2), slice(0, 2)), read=read), data[:2, :2])
+    assert cache.info()['misses'] == 1
+
+
+def test_get_missing_boxes():
+    bounds = ((0, 10), (0, 10))
+    assert get_missing_boxes(bounds, []) == [bounds]
+    assert get_missing_boxes(bounds, [bounds]) == []
+    assert sorted(get_missing_boxes(bounds, [((0, 5), (0, 10)), ((0, 10), (0, 3))])) == [((5, 10), (3, 10))]
+    missing = get_missing_boxes(bounds, [((2, 4), (2, 4))])
+    assert sum(get_box_size(box) for box in missing) == 100 - 4
+    assert len(missing) == 4
+
+
+def test_load_buffer(tmp_path):
+    file_path = str(tmp_path / 'data.hdf5')
+    data = np.random.random_sample((40, 40, 40))
+    with h5py.File(file_path, 'w') as f:
+        f.create_dataset('/data', data=data)
+
+    enable_clustering(ONE_GIG)
+    enable_buffer_cache(ONE_GIG)
+    cache = get_buffer_cache()
+    clear_buffer_cache()
+    try:
+        with h5py.File(file_path, 'r') as f:
+            arr = da.from_array(f['/data'], chunks=(10, 10, 10))
+            assert np.array_equal((arr + 1).compute(), data + 1)
+            info = cache.info()
+            assert info['misses'] == 1 and info['hits'] == 0
+            assert info['nbytes'] == data.nbytes
+
+            # same buffer
+            assert np.array_equal((arr * 2).compute(), data * 2)
+            # included in the cached buffer
+            assert np.array_equal((arr[10:30, :20] + 1).compute(), data[10:30, :20] + 1)
+            info = cache.info()
+            assert info['misses'] == 1 and info['hits'] == 2
+            assert info['bytes_hit'] == data.nbytes + data[10:30, :20].nbytes
+
+            # overlapping the cached buffer of arr[:20] only
+            clear_buffer_cache()
+            assert np.array_equal((arr[:20] + 1).compute(), data[:20] + 1)
+            assert np.array_equal((arr[10:] + 1).compute(), data[10:] + 1)
+            info = cache.info()
+            assert info['misses'] == 1 and info['partial_hits'] == 1
+            assert info['bytes_missed'] == data[:20].nbytes + data[20:].nbytes
+    finally:
+        disable_buffer_cache()
+    assert cache.info()['size'] == 0
+
+
+def test_buffer_pool():
+    pool = BufferPool(1000)
+    a = pool.empty((10, 10), np.float64)
+    b = pool.empty((10,), np.float64)
+    assert a.shape == (10, 10) and b.shape == (10,)
+    assert pool.info()['allocations'] == 2
+
+    view = a[2:4]
+    del a
+    c = pool.empty((5, 5), np.float64)  # the arena of a is still used by view
+    assert pool.info()['reuses'] == 0 and pool.info()['unpooled'] == 1
+
+    del view
+    c = pool.empty((5, 5), np.int16)
+    assert pool.info()['reuses'] == 1
+    assert c.dtype == np.int16 and c.shape == (5, 5)
+    c[...] = 1
+    assert np.all(c == 1)
+
+
+def test_read_buffer_pool(tmp_path):
+    file_path = str(tmp_path / 'data.hdf5')
+    data = np.random.random_sample((40, 40, 40))
+    with h5py.File(file_path, 'w') as f:
+        f.create_dataset('/data', data=data)
+
+    enable_clustering(10 * 40 * 40 * data.itemsize)  # four buffers
+    enable_buffer_pool(2 * 10 * 40 * 40 * data.itemsize)
+    pool = get_buffer_pool()
+    pool.clear()
+    try:
+        with h5py.File(file_path, 'r') as f:
+            arr = da.from_array(f['/data'], chunks=(10, 10, 10))
+            for _ in range(2):
+                assert np.array_equal((arr + 1).compute(), data + 1)
+            info = pool.info()
+            assert info['allocations'] + info['reuses'] + info['unpooled'] == 8
+            assert info['reuses'] > 0
+            assert info['nbytes'] <= 2 * 10 * 40 * 40 * data.itemsize
+    finally:
+        disable_buffer_pool()
+    assert pool.info()['size'] == 0
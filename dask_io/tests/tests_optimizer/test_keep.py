@@ -0,0 +1,171 @@
+import h5py
+import pytest
+import numpy as np
+import dask
+import dask.array as da
+from operator import getitem
+from dask.base import collections_to_dsk
+
+from dask_io.optimizer.configure import enable_keep, disable_clustering
+from dask_io.optimizer.scheduler import MemoryLimitCallback, is_kept_task
+from dask_io.optimizer.stats import get_last_stats
+from dask_io.optimizer.keep import *  # package being tested
+
+
+R, I, O = (60, 60, 60), (15, 15, 15), (20, 20, 20)
+
+
+@pytest.fixture
+def data():
+    return np.arange(np.prod(R), dtype='f4').reshape(R)
+
+
+def split(f, out, data, I=I, O=O):
+    """ Split the dataset of f into output files of shape O, as datasets of out.
+    """
+    arr = da.from_array(f['/data'], chunks=I)
+    arr_list, datasets = list(), list()
+    for index in np.ndindex(*[r // o for r, o in zip(data.shape, O)]):
+        arr_list.append(arr[tuple(slice(i * o, (i + 1) * o) for i, o in zip(index, O))])
+        datasets.append(out.create_dataset('/data_{}_{}_{}'.format(*index), shape=O, dtype=data.dtype))
+    return da.store(arr_list, datasets, compute=False)
+
+
+def check_split(out, data, O=O):
+    for index in np.ndindex(*[r // o for r, o in zip(data.shape, O)]):
+        expected = data[tuple(slice(i * o, (i + 1) * o) for i, o in zip(index, O))]
+        assert np.array_equal(out['/data_{}_{}_{}'.format(*index)][()], expected)
+
+
+def test_is_valid_buffer_size():
+    assert is_valid_buffer_size(30, 20, 60)
+    assert not is_valid_buffer_size(60, 20, 60)  # a volume would cross several output files
+    assert not is_valid_buffer_size(45, 20, 60)
+    assert get_buffer_shapes(R, I, O) == [(30, 30, 30)]
+    assert get_buffer_shapes((120, 120, 120), (60, 60, 60), (40, 40, 40)) == [(60, 60, 60)]
+
+
+def test_plan_keep():
+    buffer_nbytes, outfile_nbytes = 30 * 30 * 30 * 4, 20 * 20 * 20 * 4
+    B, volumestokeep, kept_nbytes, regions_dict = plan_keep(R, I, O, 'f4', 10 ** 9)
+    assert B == (30, 30, 30)
+    assert volumestokeep == [1, 2, 3, 4, 5, 6, 7]
+
+    memory = buffer_nbytes + outfile_nbytes + kept_nbytes - 1
+    B, volumestokeep, less_kept_nbytes, _ = plan_keep(R, I, O, 'f4', memory)
+    assert volumestokeep == [1, 2, 3]
+    assert buffer_nbytes + outfile_nbytes + less_kept_nbytes <= memory
+
+    assert plan_keep(R, I, O, 'f4', buffer_nbytes + outfile_nbytes, nb_buffers=1)[1] == []
+    assert plan_keep(R, I, O, 'f4', buffer_nbytes + outfile_nbytes, nb_buffers=2) is None
+    assert len(regions_dict) == 27 and all(is_partition(regions, O) for regions in regions_dict.values())
+
+
+def test_plan_keep_unsupported_buffer_shape():
+    """ Buffer shapes for which compute_zones fails are skipped.
+    """
+    R, I, O = (24, 12, 24), (4, 4, 4), (12, 12, 12)
+    assert get_buffer_shapes(R, I, O)[0] == (24, 12, 24)
+    B, _, _, regions_dict = plan_keep(R, I, O, 'f4', 10 ** 9)
+    assert B == (12, 12, 24)
+    assert len(regions_dict) == 4 and all(is_partition(regions, O) for regions in regions_dict.values())
+
+
+def test_get_source_region():
+    proxy_to_slices = {('array', 0, 1): (slice(0, 15), slice(15, 30))}
+    tasks = {
+        ('getitem', 0, 0): (getitem, ('array', 0, 1), (slice(None, None, None), slice(5, 10, 1))),
+        ('alias', 0, 0): ('getitem', 0, 0),
+        ('sum', 0, 0): (np.sum, ('array', 0, 1))}
+    assert get_source_region(tasks, ('alias', 0, 0), proxy_to_slices) == (('array', 0, 1), (slice(0, 15), slice(20, 25)))
+    assert get_source_region(tasks, ('sum', 0, 0), proxy_to_slices) is None
+
+
+def test_is_partition():
+    assert is_partition([(slice(0, 10), slice(0, 5)), (slice(0, 10), slice(5, 10))], (10, 10))
+    assert not is_partition([(slice(0, 10), slice(0, 5)), (slice(0, 10), slice(4, 9))], (10, 10))
+    assert not is_partition([(slice(0, 10), slice(0, 5))], (10, 10))
+
+
+@pytest.mark.parametrize("memory,nb_writes", [(10 ** 9, 27), (400000, 50), (100000, None)])
+def test_keep_algorithm(tmp_path, data, memory, nb_writes):
+    in_path, out_path = str(tmp_path / 'in.hdf5'), str(tmp_path / 'out.hdf5')
+    with h5py.File(in_path, 'w') as f:
+        f.create_dataset('/data', data=data)
+
+    with h5py.File(in_path, 'r') as f, h5py.File(out_path, 'w') as out:
+        enable_keep(memory)
+        split(f, out, data).compute()
+        counters = get_last_stats().to_dict()['counters']
+        disable_clustering()
+        check_split(out, data)
+
+    if nb_writes is None:  # no plan fits into memory: clustered writes only
+        assert counters['write_buffers'] > 27
+    else:
+        assert counters['write_buffers'] == nb_writes
+    assert counters['stores_merged'] == 216
+
+
+def test_enable_keep_default(tmp_path, data):
+    in_path, out_path = str(tmp_path / 'in.hdf5'), str(tmp_path / 'out.hdf5')
+    with h5py.File(in_path, 'w') as f:
+        f.create_dataset('/data', data=data)
+
+    with h5py.File(in_path, 'r') as f, h5py.File(out_path, 'w') as out:
+        enable_keep()
+        assert dask.config.get('io-optimizer.memory_available') == 'auto'
+        split(f, out, data).compute()
+        disable_clustering()
+        check_split(out, data)
+
+
+def test_keep_algorithm_no_proxy():
+    """ Graphs without original arrays are computed unchanged.
+    """
+    enable_keep()
+    arr = da.ones((20, 20), chunks=(10, 10)) + 1
+    assert np.array_equal(arr.compute(), np.full((20, 20), 2))
+    disable_clustering()
+
+
+def test_keep_algorithm_unsupported_buffer_shape(tmp_path):
+    R, I, O = (24, 12, 24), (4, 4, 4), (12, 12, 12)
+    data = np.arange(np.prod(R), dtype='f4').reshape(R)
+    in_path, out_path = str(tmp_path / 'in.hdf5'), str(tmp_path / 'out.hdf5')
+    with h5py.File(in_path, 'w') as f:
+        f.create_dataset('/data', data=data)
+
+    with h5py.File(in_path, 'r') as f, h5py.File(out_path, 'w') as out:
+        enable_keep(10 ** 9)
+        split(f, out, data, I, O).compute()
+        counters = get_last_stats().to_dict()['counters']
+        disable_clustering()
+        check_split(out, data, O)
+    assert counters['write_buffers'] == 4
+
+
+@pytest.mark.parametrize("memory", [1.5 * 10 ** 6, 3 * 10 ** 6, 6 * 10 ** 6])
+def test_keep_memory_limit(tmp_path, memory):
+    """ The buffers, the kept volumes and the write buffers in memory should not exceed the memory available,
+    the original array being several times bigger than the memory.
+    """
+    R, I, O = (120, 120, 120), (15, 15, 15), (40, 40, 40)
+    data = np.arange(np.prod(R), dtype='f4').reshape(R)
+    assert data.nbytes > memory
+    in_path, out_path = str(tmp_path / 'in.hdf5'), str(tmp_path / 'out.hdf5')
+    with h5py.File(in_path, 'w') as f:
+        f.create_dataset('/data', data=data)
+
+    with h5py.File(in_path, 'r') as f, h5py.File(out_path, 'w') as out:
+        enable_keep(memory, mem_limit=False)
+        store = split(f, out, data, I, O)
+        dsk = collections_to_dsk([store], optimize_graph=True)
+        assert any(is_kept_task(task) for task in dsk.values())
+
+        callback = MemoryLimitCallback(memory)
+        dask.threaded.get(dsk, store.__dask_keys__(), callbacks=[callback._callback])
+        disable_clustering()
+        check_split(out, data, O)
+    assert 0 < callback.max_bytes <= memory
+    assert callback.max_live_buffers == 1
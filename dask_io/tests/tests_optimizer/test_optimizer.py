@@ -17,6 +17,7 @@ import dask.array as da
 from dask_io.optimizer.cases.case_config import Split, Merge
 from dask_io.optimizer.cases.case_creation import get_arr_chunks
 from dask_io.optimizer.configure import enable_clustering, disable_clustering
+from dask_io.optimizer.stats import get_last_stats
 from dask_io.optimizer.utils.utils import ONE_GIG, CHUNK_SHAPES_EXP1
 from dask_io.optimizer.utils.get_arrays import get_dask_array_from_hdf5
 from dask_io.optimizer.utils.array_utils import inspect_h5py_file
@@ -49,7 +50,7 @@ def shape_to_test(request):
     return request.param 
 
 
-@pytest.fixture(params=[None]) # for the moment pass only None: all blocks are processed until solution find for get_used_proxies
+@pytest.fixture(params=[None, 2])
 def nb_chunks(request):
     return request.param 
 
@@ -79,6 +80,156 @@ def test_sum(shape_to_test, nb_chunks):
     assert np.array_equal(result_non_opti, result_opti)
 
 
+def test_sum_layer_aware(shape_to_test, nb_chunks):
+    """ Test if the sum of blocks yields the good result using the layer aware optimization.
+    """
+    case = Split(pytest.test_array_path, shape_to_test)
+    case.sum(nb_chunks)
+
+    disable_clustering()
+    result_non_opti = case.get().compute()
+
+    enable_clustering(buffer_size, layer_aware=True)
+    result_opti = case.get().compute()
+
+    assert np.array_equal(result_non_opti, result_opti)
+
+
+@pytest.mark.parametrize("shape, chunks, nb_blocks_per_buffer", [
+    ((100, 100), (20, 20), 7),
+    ((6, 10, 20, 20), (2, 5, 10, 20), 5),
+    ((6, 10, 20, 20), (2, 5, 10, 20), 30),
+    ((4, 2, 6, 10, 10), (2, 1, 3, 5, 10), 9),
+])
+def test_nd_arrays(tmp_path, shape, chunks, nb_blocks_per_buffer):
+    """ Clustered reads should give the same result for arrays of any dimensionality.
+    """
+    file_path = str(tmp_path / 'nd_array.hdf5')
+    data = np.random.random_sample(shape)
+    with h5py.File(file_path, 'w') as f:
+        f.create_dataset('/data', data=data)
+
+    with h5py.File(file_path, 'r') as f:
+        arr = da.from_array(f['/data'], chunks=chunks) + 1
+        block_mem_size = np.prod(chunks) * data.dtype.itemsize
+        enable_clustering(block_mem_size * nb_blocks_per_buffer)
+        result = arr.compute()
+        max_blocks_per_buffer = get_last_stats().max_blocks_per_buffer
+
+    assert np.array_equal(result, data + 1)
+    assert max_blocks_per_buffer > 1
+
+
+@pytest.mark.parametrize("shape, chunks", [
+    ((103, 57, 41), (20, 20, 20)),
+    ((103, 57, 41), ((30, 40, 33), (57,), (20, 20, 1))),
+    ((55, 21), ((5, 20, 30), (7, 7, 7))),
+])
+def test_irregular_chunks(tmp_path, shape, chunks):
+    """ Clustered reads should give the same result with partial edge blocks and irregular chunks.
+    """
+    file_path = str(tmp_path / 'irregular_array.hdf5')
+    data = np.random.random_sample(shape)
+    with h5py.File(file_path, 'w') as f:
+        f.create_dataset('/data', data=data)
+
+    with h5py.File(file_path, 'r') as f:
+        arr = da.from_array(f['/data'], chunks=chunks) + 1
+        enable_clustering(np.prod(arr.chunksize) * data.dtype.itemsize * 5)
+        result = arr.compute()
+        max_blocks_per_buffer = get_last_stats().max_blocks_per_buffer
+
+    assert np.array_equal(result, data + 1)
+    assert max_blocks_per_buffer > 1
+
+
+def test_multiple_sources(tmp_path):
+    """ Original arrays with different logical chunkings should each get their own plan.
+    """
+    from dask_io.optimizer.find_proxies import get_used_proxies
+    from dask_io.optimizer.clustering import apply_clustered_strategy
+
+    data = list()
+    for i in range(2):
+        data.append(np.random.random_sample((40, 40, 40)))
+        with h5py.File(str(tmp_path / f'source_{i}.hdf5'), 'w') as f:
+            f.create_dataset('/data', data=data[i])
+
+    with h5py.File(str(tmp_path / 'source_0.hdf5'), 'r') as f0, h5py.File(str(tmp_path / 'source_1.hdf5'), 'r') as f1:
+        a = da.from_array(f0['/data'], chunks=(20, 20, 20))
+        b = da.from_array(f1['/data'], chunks=(10, 40, 40)).rechunk((20, 20, 20))
+        arr = a + b
+
+        enable_clustering(40 * 40 * 40 * 2)
+        graph = {k: dict(v) if isinstance(v, dict) else v for k, v in arr.dask.dicts.items()}
+        chunk_shape, dicts = get_used_proxies(graph, arr.__dask_keys__())
+        chunk_shapes = sorted(dicts['origarr_to_chunk_shape'].values())
+        assert chunk_shapes == [(10, 40, 40), (20, 20, 20)]
+
+        apply_clustered_strategy(graph, dicts, chunk_shape)
+        block_to_proxies = dicts['origarr_to_block_to_proxies']
+        assert sorted([len(b) for b in block_to_proxies.values()]) == [4, 8]
+
+        result = arr.compute()
+    assert np.array_equal(result, data[0] + data[1])
+
+
+def test_layer_aware_optimization():
+    """ Only the layers consuming the original array should be rewritten, in a new graph.
+    """
+    from dask.blockwise import Blockwise
+    from dask_io.optimizer.optimizer import layer_aware_optimization
+
+    enable_clustering(buffer_size, layer_aware=True)
+    case = Split(pytest.test_array_path, (20, 20, 20))
+    case.sum(nb_chunks=None)
+    arr = case.get()
+    dsk = arr.__dask_graph__()
+    blockwise_layers = [k for k, v in dsk.layers.items() if isinstance(v, Blockwise)]
+    assert len(blockwise_layers) > 0
+
+    new_dsk = layer_aware_optimization(dsk, arr.__dask_keys__())
+    assert new_dsk is not dsk
+    for name in blockwise_layers:
+        assert new_dsk.layers[name] is dsk.layers[name]
+        assert not hasattr(dsk.layers[name], '_cached_dict')
+
+    merged_layers = [k for k in new_dsk.layers.keys() if isinstance(k, str) and k.endswith('-merged')]
+    assert len(merged_layers) == 1
+    origarr_name = 'array-original-' + merged_layers[0].split('-')[0]
+    assert new_dsk.dependencies[merged_layers[0]] == {origarr_name}
+    array_layer = 'array-' + merged_layers[0].split('-')[0]
+    assert merged_layers[0] in new_dsk.dependencies[array_layer]
+    assert origarr_name in dsk.layers[array_layer]  # input graph untouched
+
+
+def test_plan_cache():
+    """ Computing the same array twice should reuse the plan and give the same result.
+    """
+    from dask_io.optimizer.optimizer import PLAN_CACHE
+
+    disable_clustering()
+    case = Split(pytest.test_array_path, (20, 20, 20))
+    case.sum(nb_chunks=None)
+    arr = case.get()
+    expected = arr.compute()
+
+    enable_clustering(buffer_size)
+    PLAN_CACHE.clear()
+    assert np.array_equal(arr.compute(), expected)
+    assert PLAN_CACHE.info()['misses'] == 1
+    assert np.array_equal(arr.compute(), expected)
+    assert PLAN_CACHE.info()['hits'] == 1
+
+    enable_clustering(buffer_size / 2)  # different budget, different plan
+    assert np.array_equal(arr.compute(), expected)
+    assert PLAN_CACHE.info()['misses'] == 2
+
+    with dask.config.set({'io-optimizer.plan_cache_size': 1}):
+        assert np.array_equal(arr.compute(), expected)
+        assert PLAN_CACHE.info()['size'] == 1
+
+
 def test_split(optimized, nb_chunks, shape_to_test):
     def create_arrays_for_comparison():
         """ Get chunks as dask arrays to compare the chunks to the splitted files.
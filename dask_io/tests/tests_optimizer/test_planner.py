@@ -0,0 +1,196 @@
+import itertools
+
+import h5py
+import pytest
+import numpy as np
+import dask
+import dask.array as da
+
+from dask_io.optimizer.configure import enable_clustering
+from dask_io.optimizer.stats import get_last_stats
+from dask_io.optimizer.planner import *  # package being tested
+
+from ..utils import ONE_GIG
+
+
+def test_get_box_shape():
+    blocks_shape = (5, 4, 3)
+    assert get_box_shape('rows', blocks_shape, 7) == (1, 2, 3)
+    assert get_box_shape('rows', blocks_shape, 2) == None
+    assert get_box_shape('slices', blocks_shape, 30) == (2, 4, 3)
+    assert get_box_shape('slices', blocks_shape, 10) == None
+    assert get_box_shape('bricks', blocks_shape, 8) == (2, 2, 2)
+    assert get_box_shape('bricks', blocks_shape, 12) == (2, 2, 3)
+    assert get_box_shape('bricks', blocks_shape, 1) == (1, 1, 1)
+    assert get_box_shape('bricks', (2, 10), 10) == (2, 5)
+
+
+def test_tile_buffers():
+    blocks_shape = (4, 4)
+    blocks = [0, 1, 2, 5, 6, 10, 15]
+    assert tile_buffers(blocks, blocks_shape, (2, 2)) == [[0, 1, 5], [2, 6], [10, 15]]
+    assert tile_buffers(blocks, blocks_shape, (1, 4)) == [[0, 1, 2], [5, 6], [10], [15]]
+
+
+def test_get_buffers_cost():
+    blocks_shape = (4, 4)
+    boundaries = ([0, 10, 20, 30, 40], [0, 10, 20, 30, 40])
+    cost_model = (1, 100)
+
+    # two complete rows: one contiguous run
+    cost = get_buffers_cost([list(range(8))], blocks_shape, boundaries, 1, cost_model=cost_model)
+    assert cost == {'read_calls': 1, 'seeks': 1, 'bytes_read': 800, 'bytes_wasted': 0, 'cost': 9}
+
+    # 2x2 brick with a missing block: one run per line of voxels
+    cost = get_buffers_cost([[0, 1, 4]], blocks_shape, boundaries, 1, cost_model=cost_model)
+    assert cost['seeks'] == 20 and cost['bytes_read'] == 400 and cost['bytes_wasted'] == 100
+
+    # same brick in a dataset chunked by blocks: one seek per chunk
+    layout = {'chunks': (10, 10), 'order': 'C', 'contiguous': False}
+    cost = get_buffers_cost([[0, 1, 4]], blocks_shape, boundaries, 1, layout, cost_model)
+    assert cost['seeks'] == 4
+
+
+def test_plan_buffers():
+    blocks_shape = (4, 4, 4)
+    boundaries = tuple([[0, 10, 20, 30, 40]] * 3)
+    blocks = sorted([i * 16 + j * 4 + k for i in range(2) for j in range(2) for k in range(2)])  # 2x2x2 brick
+    layout = {'chunks': (10, 10, 10), 'order': 'C', 'contiguous': False}
+
+    def blocks_buffering(blocks, blocks_shape, max_blocks):
+        return [blocks[i:i + 2] for i in range(0, len(blocks), 2)]
+
+    strategy, buffers, cost = plan_buffers(blocks, blocks_shape, boundaries, 8, blocks_buffering, 1, layout, 'auto')
+    assert strategy == 'bricks'
+    assert buffers == [blocks]
+
+    strategy, buffers, cost = plan_buffers(blocks, blocks_shape, boundaries, 8, blocks_buffering, 1, layout, 'blocks')
+    assert strategy == 'blocks'
+    assert len(buffers) == 4
+
+    strategy, buffers, cost = plan_buffers(blocks, blocks_shape, boundaries, 8, blocks_buffering, 1, layout, 'slices')
+    assert strategy == 'blocks'  # does not fit in memory
+
+    with pytest.raises(ValueError):
+        plan_buffers(blocks, blocks_shape, boundaries, 8, blocks_buffering, 1, layout, 'unknown')
+
+
+def test_plan_buffers_box_shape():
+    """ A configured box shape overrides the strategy, the boxes being in C order.
+    """
+    blocks_shape = (4, 4)
+    boundaries = tuple([[0, 10, 20, 30, 40]] * 2)
+    blocks = list(range(16))
+    with dask.config.set({'io-optimizer.box_shape': (2, 2)}):
+        strategy, buffers, _ = plan_buffers(blocks, blocks_shape, boundaries, 16, None, 1, None, 'slices')
+    assert strategy == 'box'
+    assert buffers == [[0, 1, 4, 5], [2, 3, 6, 7], [8, 9, 12, 13], [10, 11, 14, 15]]
+
+
+@pytest.mark.parametrize("strategy", ['auto'] + STRATEGIES)
+def test_strategies(tmp_path, strategy):
+    """ All strategies should give the right result on a subregion of the array.
+    """
+    file_path = str(tmp_path / 'data.hdf5')
+    data = np.random.random_sample((60, 60, 60))
+    with h5py.File(file_path, 'w') as f:
+        f.create_dataset('/data', data=data, chunks=(10, 10, 10))
+
+    with h5py.File(file_path, 'r') as f:
+        arr = da.from_array(f['/data'], chunks=(10, 10, 10))[5:35, 5:35, 5:35] + 1
+        enable_clustering(10 * 10 * 10 * data.itemsize * 72, strategy=strategy)
+        result = arr.compute()
+
+    assert np.array_equal(result, data[5:35, 5:35, 5:35] + 1)
+    strategies = list(get_last_stats().to_dict()['strategies'].values())
+    assert strategies == ['bricks' if strategy == 'auto' else strategy]
+
+
+def test_get_aligned_boundaries():
+    boundaries = ([0, 10, 20, 30, 40, 50, 60], [0, 10, 20, 25])
+    assert get_aligned_boundaries(boundaries, (15, 20)) == ([0, 30, 60], [0, 20, 25])
+
+    # grid of a region of the array, starting between physical chunks edges
+    boundaries = ([5, 10, 20, 30], [2, 12])
+    assert get_aligned_boundaries(boundaries, (15, 20)) == ([5, 30], [2, 12])
+
+
+def test_plan_buffers_offset_grid():
+    blocks_shape = (3, 2)
+    boundaries = ([5, 10, 20, 30], [2, 12, 22])
+    layout = {'chunks': (15, 20), 'order': 'C', 'contiguous': False}
+
+    def blocks_buffering(blocks, blocks_shape, max_blocks):
+        return [blocks[i:i + max_blocks] for i in range(0, len(blocks), max_blocks)]
+
+    _, buffers, _ = plan_buffers(list(range(6)), blocks_shape, boundaries, 6, blocks_buffering, 1, layout, 'blocks')
+    assert sorted(b for buffer in buffers for b in buffer) == list(range(6))
+
+
+def test_group_blocks():
+    blocks_shape = (6, 6)
+    boundaries = ([0, 10, 20, 30, 40, 50, 60], [0, 10, 20, 30, 40, 50, 60])
+    groups_boundaries = ([0, 30, 60], [0, 30, 60])
+    groups_shape, groups, group_to_blocks, blocks_per_group = group_blocks([0, 2, 3, 14, 35], blocks_shape, boundaries, groups_boundaries)
+    assert groups_shape == (2, 2)
+    assert groups == [0, 1, 3]
+    assert group_to_blocks == {0: [0, 2, 14], 1: [3], 3: [35]}
+    assert blocks_per_group == 9
+
+
+def get_physical_chunks_read(buffer, blocks_shape, boundaries, physical_chunks):
+    positions = np.unravel_index(buffer, blocks_shape)
+    ranges = [range(b[min(p)] // c, (b[max(p) + 1] - 1) // c + 1) for p, b, c in zip(positions, boundaries, physical_chunks)]
+    return set(itertools.product(*ranges))
+
+
+@pytest.mark.parametrize("strategy", ['auto'] + STRATEGIES)
+def test_plan_buffers_aligned(strategy):
+    """ No physical chunk should be read by two buffers, and the buffers should be ordered by physical chunk.
+    """
+    blocks_shape = (6, 6, 6)
+    boundaries = tuple([list(range(0, 70, 10))] * 3)
+    physical_chunks = (15, 15, 15)
+    layout = {'chunks': physical_chunks, 'order': 'C', 'contiguous': False}
+    blocks = list(range(1, 6 * 6 * 6, 2))
+
+    def blocks_buffering(blocks, blocks_shape, max_blocks):
+        return [blocks[i:i + max_blocks] for i in range(0, len(blocks), max_blocks)]
+
+    _, buffers, cost = plan_buffers(blocks, blocks_shape, boundaries, 54, blocks_buffering, 1, layout, strategy)
+    assert sorted(b for buffer in buffers for b in buffer) == blocks
+    assert cost['read_calls'] == len(buffers)
+
+    chunks_read = [get_physical_chunks_read(buffer, blocks_shape, boundaries, physical_chunks) for buffer in buffers]
+    assert sum(len(c) for c in chunks_read) == len(set.union(*chunks_read))
+    first_chunks = [min(c) for c in chunks_read]
+    assert first_chunks == sorted(first_chunks)
+
+
+def test_plan_buffers_physical_chunks_too_big():
+    blocks_shape = (6, 6)
+    boundaries = tuple([list(range(0, 70, 10))] * 2)
+    layout = {'chunks': (60, 60), 'order': 'C', 'contiguous': False}
+
+    def blocks_buffering(blocks, blocks_shape, max_blocks):
+        return [blocks[i:i + max_blocks] for i in range(0, len(blocks), max_blocks)]
+
+    _, buffers, _ = plan_buffers(list(range(36)), blocks_shape, boundaries, 6, blocks_buffering, 1, layout, 'blocks')
+    assert len(buffers) == 6
+
+
+def test_physical_chunks_not_aligned(tmp_path):
+    file_path = str(tmp_path / 'data.hdf5')
+    data = np.random.random_sample((60, 60, 60))
+    with h5py.File(file_path, 'w') as f:
+        f.create_dataset('/data', data=data, chunks=(15, 15, 15))
+
+    with h5py.File(file_path, 'r') as f:
+        arr = da.from_array(f['/data'], chunks=(10, 10, 10))[5:55, 5:55, 5:55] + 1
+        enable_clustering(10 * 10 * 10 * data.itemsize * 54)
+        result = arr.compute()
+
+    assert np.array_equal(result, data[5:55, 5:55, 5:55] + 1)
+    counters = get_last_stats().to_dict()['counters']
+    assert counters['max_blocks_per_buffer'] <= 54
+    assert counters['blocks_in_buffers'] == 6 * 6 * 6
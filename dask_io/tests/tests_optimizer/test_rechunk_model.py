@@ -0,0 +1,53 @@
+import pytest
+
+from dask_io.optimizer.keep import plan_keep
+from dask_io.optimizer.rechunk_model import *  # package being tested
+
+
+n, N = 2, 4  # partition of R by I: (2, 2, 2)
+cases = [
+    ((1, 120, 120), (1, 60, 60), (1, 40, 40), 60*40 + 40*20, (1, 40, 60)),  # buffer + F1
+    ((1, 120, 120), (1, 60, 60), (1, 40, 40), 60*60 + 40*20 + n*60*20, (1, 60, 60)),  # buffer + F1 + n(F2+F3)
+    ((120, 120, 120), (60, 60, 60), (40, 40, 40), 60*60*40 + 40*20*40 + n*60*20*40, (40, 60, 60)),
+    ((120, 120, 120), (60, 60, 60), (40, 40, 40), 60*60 + 40*20 + n*60*20, (1, 60, 60)),
+    ((120, 120, 120), (60, 60, 60), (40, 40, 40), 60*60*60 + 40*20*40 + n*60*20*40 + N*20*60*60, (60, 60, 60)),  # + N(F4+F5+F6+F7)
+]
+
+
+@pytest.mark.parametrize("R,I,O,m,B", cases)
+def test_model(R, I, O, m, B):
+    assert get_nb_blocks(R, I) == (n, N)
+    assert model(I, O, m, n, N) == B
+    assert B in get_model_shapes(I)
+
+
+def test_get_cache_footprint():
+    """ The footprint is the buffer and the volumes kept by the keep algorithm (see keep.plan_keep).
+    """
+    R, O = (120, 120, 120), (40, 40, 40)
+    kept = 40*40*40 + 40*40*60*2 + 40*60*60*4  # F1 during a buffer, F2, F3 during a row, F4 to F7 during a slice
+    assert get_cache_footprint((60, 60, 60), R, O) == 60*60*60 + kept
+    assert get_cache_footprint((60, 60, 60), R, O, []) == 60*60*60
+    assert get_cache_footprint((40, 40, 40), R, O) == 40*40*40  # aligned on the output files: nothing kept
+
+    B, volumestokeep, kept_nbytes, _ = plan_keep(R, (15, 15, 15), O, 'f4', 10 ** 9)
+    assert (B, volumestokeep) == ((60, 60, 60), ALL_VOLUMES)
+    assert kept_nbytes == 4 * kept
+
+
+@pytest.mark.parametrize("R,I,O,m,B", cases)
+def test_choose_buffer_shape(R, I, O, m, B):
+    footprint = get_cache_footprint(B, R, O)
+    assert choose_buffer_shape(R, I, O, 2 * footprint, 'u2') == (B, 2 * footprint)
+
+    # one voxel less
+    smaller_B, smaller_footprint = choose_buffer_shape(R, I, O, 2 * (footprint - 1), 'u2')
+    assert smaller_B != B
+    assert smaller_footprint == 2 * get_cache_footprint(smaller_B, R, O)
+    assert smaller_footprint <= 2 * (footprint - 1) or smaller_B == (1, 1, I[2])
+
+
+def test_choose_buffer_shape_too_small():
+    B, footprint = choose_buffer_shape((120, 120, 120), (60, 60, 60), (40, 40, 40), 10, 'f8')
+    assert B == (1, 1, 60)
+    assert footprint > 10
@@ -0,0 +1,235 @@
+import h5py
+import threading
+import pytest
+import numpy as np
+import dask
+import dask.array as da
+from dask.base import collections_to_dsk
+from dask.callbacks import Callback
+
+from dask_io.optimizer.configure import enable_clustering, disable_clustering, set_io_threads
+from dask_io.optimizer.scheduler import *  # package being tested
+
+from ..utils import ONE_GIG
+
+
+@pytest.fixture
+def data():
+    return np.random.random_sample((40, 40, 40))
+
+
+def finalize(arr, result):
+    func, args = arr.__dask_postcompute__()
+    return func(result, *args)
+
+
+def test_is_buffer_task():
+    from operator import getitem
+    assert is_buffer_task(('a-merged', 0, 3), (getitem, 'array-original-a', (slice(0, 10), slice(0, 40))))
+    assert not is_buffer_task(('a', 0, 3), (getitem, 'array-original-a', (slice(0, 10), slice(0, 40))))
+    assert not is_buffer_task(('a-merged', 0, 3), (getitem, ('a-merged', 0, 3), 1))
+
+
+def test_get_holders():
+    from operator import getitem
+    dsk = {
+        ('a-merged', 0): (load_buffer, 'array-original-a', (slice(0, 10),)),
+        ('proxy', 0): (getitem, ('a-merged', 0), (slice(0, 5),)),
+        ('slice', 0): (getitem, ('proxy', 0), (slice(0, 2),)),
+        ('alias', 0): ('slice', 0),
+        ('sum', 0): (np.sum, ('alias', 0))}
+    _, dependents = dask.core.get_deps(dsk)
+    assert get_holders(dsk, ('a-merged', 0), dependents) == {('a-merged', 0), ('proxy', 0), ('slice', 0), ('alias', 0)}
+
+
+def test_memory_limit_callback(data):
+    """ The buffers in memory should never exceed the memory limit.
+    """
+    buffer_nbytes = 10 * 40 * 40 * data.itemsize  # one slice of blocks
+    enable_clustering(buffer_nbytes, mem_limit=False)
+    arr = da.from_array(data, chunks=(10, 10, 10)) + 1
+    dsk = collections_to_dsk([arr], optimize_graph=True)
+    assert sum(1 for key, task in dsk.items() if is_buffer_task(key, task)) == 4
+
+    callback = MemoryLimitCallback(2 * buffer_nbytes)
+    result = dask.threaded.get(dsk, arr.__dask_keys__(), callbacks=[callback._callback], num_workers=8)
+    assert np.array_equal(finalize(arr, result), data + 1)
+    assert 0 < callback.max_bytes <= 2 * buffer_nbytes
+    assert callback.deferred_loads == 2
+
+    # a buffer bigger than the limit is loaded anyway
+    callback = MemoryLimitCallback(1)
+    result = dask.threaded.get(dsk, arr.__dask_keys__(), callbacks=[callback._callback])
+    assert np.array_equal(finalize(arr, result), data + 1)
+    assert callback.max_bytes == buffer_nbytes
+    disable_clustering()
+
+
+def test_memory_limit_views(data):
+    """ A buffer should count in the limit as long as its proxies, which are views of it, are in memory.
+    """
+    buffer_nbytes = 10 * 40 * 40 * data.itemsize
+    enable_clustering(buffer_nbytes, mem_limit=False)
+    arr = da.from_array(data, chunks=(10, 10, 10))
+    dsk = collections_to_dsk([arr], optimize_graph=True)
+    buffer_keys = [key for key, task in dsk.items() if is_buffer_task(key, task)]
+    assert len(buffer_keys) == 4
+    assert all(len(get_views(dsk, key, [k for k in dsk if k not in buffer_keys])) == 16 for key in buffer_keys)
+
+    callback = MemoryLimitCallback(buffer_nbytes)
+    result = dask.threaded.get(dsk, arr.__dask_keys__(), callbacks=[callback._callback])  # proxies are outputs
+    assert np.array_equal(finalize(arr, result), data)
+    assert callback.max_bytes == 4 * buffer_nbytes
+    disable_clustering()
+
+
+def test_memory_limit_write_buffers(tmp_path, data):
+    """ A write buffer should count in the limit with its parts and the array assembled from them.
+    """
+    buffer_nbytes = 10 * 40 * 40 * data.itemsize  # one slice of blocks
+    enable_clustering(buffer_nbytes, mem_limit=False, clustered_writes=True)
+    with h5py.File(str(tmp_path / 'out.hdf5'), 'w') as out:
+        dset = out.create_dataset('/data', shape=data.shape, dtype=data.dtype)
+        stored = da.store(da.from_array(data, chunks=(10, 10, 10)) + 1, dset, compute=False)
+        dsk = collections_to_dsk([stored], optimize_graph=True)
+        write_keys = [key for key, task in dsk.items() if is_write_buffer_task(task)]
+        assert len(write_keys) == 4
+        assert all(get_write_nbytes(dsk[key]) == buffer_nbytes for key in write_keys)
+
+        callback = MemoryLimitCallback(ONE_GIG)
+        dask.threaded.get(dsk, stored.__dask_keys__(), callbacks=[callback._callback], num_workers=1)
+        assert np.array_equal(dset[()], data + 1)
+    assert callback.max_bytes >= 2 * buffer_nbytes
+    assert callback.live_bytes == 0 and not callback.writes
+    disable_clustering()
+
+
+def test_get_kwargs(data):
+    enable_clustering(10 * 40 * 40 * data.itemsize)
+    arr = da.from_array(data, chunks=(10, 10, 10)) + 1
+    assert np.array_equal(arr.compute(scheduler=get, pool=object(), cache=dict()), data + 1)
+    disable_clustering()
+
+
+def test_scheduler(data):
+    enable_clustering(10 * 40 * 40 * data.itemsize)
+    assert dask.config.get('scheduler', None) is None  # opt-in
+    arr = da.from_array(data, chunks=(10, 10, 10)) + 1
+    assert np.array_equal(arr.compute(scheduler=get), data + 1)
+
+    enable_clustering(10 * 40 * 40 * data.itemsize, set_scheduler=True)
+    assert dask.config.get('scheduler') is get
+    assert np.array_equal(arr.compute(), data + 1)
+
+    enable_clustering(10 * 40 * 40 * data.itemsize, mem_limit=False, set_scheduler=True)
+    assert dask.config.get('scheduler', None) is None
+    enable_clustering(10 * 40 * 40 * data.itemsize, set_scheduler=True)
+    disable_clustering()
+    assert dask.config.get('scheduler', None) is None
+
+    # a scheduler configured explicitly is not replaced
+    with dask.config.set(scheduler='sync'):
+        enable_clustering(10 * 40 * 40 * data.itemsize, set_scheduler=True)
+        assert dask.config.get('scheduler') == 'sync'
+        assert np.array_equal(arr.compute(), data + 1)
+        disable_clustering()
+        assert dask.config.get('scheduler') == 'sync'
+
+
+def test_get_io_threads(tmp_path, data):
+    file_path = str(tmp_path / 'data.hdf5')
+    with h5py.File(file_path, 'w') as f:
+        f.create_dataset('/data', data=data)
+
+    with h5py.File(file_path, 'r') as f:
+        enable_clustering(10 * 40 * 40 * data.itemsize)
+        for arr in [da.from_array(f['/data'], chunks=(10, 10, 10)), da.from_array(data, chunks=(10, 10, 10))]:
+            dsk = collections_to_dsk([arr + 1], optimize_graph=True)
+            buffer_keys = [key for key, task in dsk.items() if is_buffer_task(key, task)]
+            assert len(buffer_keys) == 4
+
+            set_io_threads(2)
+            assert get_io_threads(dsk, buffer_keys) == 2
+            set_io_threads(None)
+            assert get_io_threads(dsk, buffer_keys) is None
+            set_io_threads('auto')
+            if isinstance(dsk[dsk[buffer_keys[0]][1]], h5py.Dataset):
+                assert get_io_threads(dsk, buffer_keys) in [1, IO_THREADS_SSD]
+            else:  # in-memory array
+                assert get_io_threads(dsk, buffer_keys) is None
+    disable_clustering()
+
+
+def test_io_threads(tmp_path, data):
+    """ The buffers should be loaded by the I/O thread.
+    """
+    file_path = str(tmp_path / 'data.hdf5')
+    with h5py.File(file_path, 'w') as f:
+        f.create_dataset('/data', data=data)
+
+    workers = dict()
+    def posttask(key, result, dsk, state, worker_id):
+        workers[key] = worker_id
+
+    with h5py.File(file_path, 'r') as f:
+        arr = da.from_array(f['/data'], chunks=(10, 10, 10)) + 1
+        enable_clustering(10 * 40 * 40 * data.itemsize, io_threads=1)
+        with Callback(posttask=posttask):
+            assert np.array_equal(arr.compute(scheduler=get), data + 1)
+        assert EXECUTORS
+    disable_clustering()
+    assert not EXECUTORS  # thread pools shut down
+
+    io_workers = set(worker for key, worker in workers.items() if isinstance(key, tuple) and key[0].endswith('-merged'))
+    compute_workers = set(worker for key, worker in workers.items() if not (isinstance(key, tuple) and key[0].endswith('-merged')))
+    assert len(io_workers) == 1
+    assert not io_workers & compute_workers
+
+
+def test_io_router_callback():
+    compute_executor, io_executor = get_executor('compute', 1), get_executor('io', 1)
+    router = IORouterCallback(compute_executor, io_executor, {'load'})
+    names = list()
+    def run(key):
+        names.append(threading.current_thread().name)
+
+    router._pretask('load', None, None)
+    router.apply_async(run, args=('load',))
+    router._pretask('add', None, None)
+    router.apply_async(run, args=('add',))
+    router.apply_async(run, args=('load',))  # no pretask call: compute pool
+    shutdown_executors()
+    assert [name.split('_')[0] for name in names] == ['dask-io-io', 'dask-io-compute', 'dask-io-compute']
+
+
+def test_prefetch(tmp_path, data):
+    """ With a prefetch depth of 1, two buffers fit in memory and are loaded in storage order.
+    """
+    file_path = str(tmp_path / 'data.hdf5')
+    with h5py.File(file_path, 'w') as f:
+        f.create_dataset('/data', data=data)
+
+    loaded = list()
+    def posttask(key, result, dsk, state, worker_id):
+        if is_buffer_task(key, dsk[key]):
+            loaded.append(key)
+
+    with h5py.File(file_path, 'r') as f:
+        arr = da.from_array(f['/data'], chunks=(10, 10, 10)) + 1
+        enable_clustering(2 * 10 * 40 * 40 * data.itemsize, io_threads=1, prefetch_depth=1)
+        dsk = collections_to_dsk([arr], optimize_graph=True)
+        buffer_keys = [key for key, task in dsk.items() if is_buffer_task(key, task)]
+        assert len(buffer_keys) == 4
+
+        callback = MemoryLimitCallback(ONE_GIG, max_buffers=2)
+        result = dask.threaded.get(dsk, arr.__dask_keys__(), callbacks=[callback._callback])
+        assert np.array_equal(finalize(arr, result), data + 1)
+        assert callback.max_live_buffers == 2
+        assert callback.deferred_loads == 2
+
+        with Callback(posttask=posttask):
+            assert np.array_equal(arr.compute(scheduler=get), data + 1)
+        assert EXECUTORS
+    disable_clustering()
+    assert not EXECUTORS  # thread pools shut down
+    assert loaded == buffer_keys
@@ -0,0 +1,105 @@
+import h5py
+import pytest
+import numpy as np
+import dask.array as da
+
+from dask_io.optimizer.configure import enable_clustering, disable_clustering
+from dask_io.optimizer.find_proxies import get_used_proxies
+from dask_io.optimizer.stats import get_last_stats
+from dask_io.optimizer.sources import *  # package being tested
+
+from ..utils import ONE_GIG
+
+
+@pytest.fixture
+def data():
+    return np.random.random_sample((40, 30, 20))
+
+
+def test_get_layout(tmp_path, data):
+    file_path = str(tmp_path / 'data.hdf5')
+    with h5py.File(file_path, 'w') as f:
+        f.create_dataset('/contiguous', data=data)
+        f.create_dataset('/chunked', data=data, chunks=(10, 10, 10))
+        assert get_layout(f['/contiguous']) == {'chunks': None, 'order': 'C', 'contiguous': True}
+        assert get_layout(f['/chunked']) == {'chunks': (10, 10, 10), 'order': 'C', 'contiguous': False}
+        assert get_source_id(f['/chunked']) == ('hdf5', file_path, '/chunked')
+
+    file_path = str(tmp_path / 'data.npy')
+    np.save(file_path, np.asfortranarray(data))
+    layout = get_layout(np.load(file_path, mmap_mode='r'))
+    assert layout['order'] == 'F' and layout['contiguous']
+    assert layout['offset'] > 0
+
+    assert get_layout(data) is None
+    assert get_source_id(data) is None
+
+
+def test_register_source_adapter():
+    class ListAdapter(SourceAdapter):
+        name = 'list'
+        def match(self, obj):
+            return isinstance(obj, list)
+        def get_layout(self, obj):
+            return {'chunks': None, 'order': 'C', 'contiguous': True}
+
+    adapter = ListAdapter()
+    assert not is_source('data', [1, 2])
+    register_source_adapter(adapter)
+    try:
+        assert get_source_adapter([1, 2]) is adapter
+        assert is_source('data', [1, 2])
+    finally:
+        unregister_source_adapter(adapter)
+    assert is_source('array-original-1234', [1, 2])
+
+
+def compute(arr):
+    disable_clustering()
+    expected = arr.compute()
+    enable_clustering(ONE_GIG)
+    result = arr.compute()
+    assert np.array_equal(result, expected)
+    assert get_last_stats().to_dict()['counters']['buffers_created'] == 1
+
+
+def test_custom_name(tmp_path, data):
+    file_path = str(tmp_path / 'data.hdf5')
+    with h5py.File(file_path, 'w') as f:
+        f.create_dataset('/data', data=data)
+
+    with h5py.File(file_path, 'r') as f:
+        arr = da.from_array(f['/data'], chunks=(10, 10, 10), name='my-volume')
+        _, dicts = get_used_proxies(dict(arr.dask.dicts))
+        assert list(dicts['origarr_to_obj'].keys()) == ['my-volume']
+        assert len(dicts['proxy_to_slices']) == 24
+        compute(arr + 1)
+
+        arr = da.from_array(f['/data'], chunks=(10, 10, 10), lock=True)
+        compute(arr + 1)
+
+
+def test_memmap(tmp_path, data):
+    file_path = str(tmp_path / 'data.npy')
+    np.save(file_path, data)
+    arr = da.from_array(np.load(file_path, mmap_mode='r'), chunks=(10, 10, 10))
+    compute(arr + 1)
+
+    file_path = str(tmp_path / 'data.raw')
+    data.tofile(file_path)
+    raw = np.memmap(file_path, dtype=data.dtype, mode='r', shape=data.shape)
+    arr = da.from_array(raw, chunks=(10, 10, 10), name='raw-volume')
+    compute(arr + 1)
+
+
+def test_custom_name_layer_aware(tmp_path, data):
+    file_path = str(tmp_path / 'data.hdf5')
+    with h5py.File(file_path, 'w') as f:
+        f.create_dataset('/data', data=data)
+
+    with h5py.File(file_path, 'r') as f:
+        arr = da.from_array(f['/data'], chunks=(10, 10, 10), name='my-other-volume') + 1
+        enable_clustering(ONE_GIG, layer_aware=True)
+        result = arr.compute()
+        assert get_last_stats().to_dict()['counters']['buffers_created'] == 1
+    assert np.array_equal(result, data + 1)
@@ -0,0 +1,60 @@
+import pytest
+
+from dask_io.optimizer.configure import enable_clustering, set_stats_callback
+from dask_io.optimizer.cases.case_config import Split
+from dask_io.optimizer.stats import *  # package being tested
+
+from ..utils import create_test_array_nochunk, ONE_GIG
+
+pytest.test_array_path = None
+path = './small_array_nochunk.hdf5'
+
+
+@pytest.fixture(autouse=True)
+def create_test_array():
+    if not pytest.test_array_path:
+        create_test_array_nochunk(path, (100, 100, 100))
+        pytest.test_array_path = path
+
+
+def test_timer_without_optimization():
+    assert current_stats() == None
+    with timer('buffering'):
+        pass
+    incr('blocks_used')
+
+
+def test_optimization_stats():
+    stats = start_stats()
+    with timer('buffering'):
+        pass
+    incr('blocks_used', 3)
+    add_buffer([0, 1])
+    add_buffer([2, 3, 4, 5])
+    assert end_stats() is stats
+    assert current_stats() == None
+    assert get_last_stats() is stats
+
+    d = stats.to_dict()
+    assert 'buffering' in d['timings']
+    assert d['counters']['blocks_used'] == 3
+    assert d['counters']['buffers_created'] == 2
+    assert d['counters']['avg_blocks_per_buffer'] == 3
+    assert d['counters']['max_blocks_per_buffer'] == 4
+
+
+def test_stats_callback():
+    received = list()
+    enable_clustering(ONE_GIG)
+    set_stats_callback(received.append)
+
+    case = Split(pytest.test_array_path, (20, 20, 20))
+    case.sum(nb_chunks=None)
+    case.get().compute()
+
+    assert len(received) == 1
+    d = received[0].to_dict()
+    for phase in ['total', 'proxy_search', 'reachability', 'update_io_tasks']:
+        assert phase in d['timings']
+    assert d['counters']['proxies_found'] == 125
+    assert d['counters']['tasks_scanned'] > 125
@@ -1,4 +1,4 @@
-from dask_io.optimizer.utils.utils import add_to_dict_of_lists, flatten_iterable
+from dask_io.optimizer.utils.utils import add_to_dict_of_lists, flatten_iterable, numeric_to_3d_pos, numeric_to_nd_pos, _nd_to_numeric_pos, is_rotational
 
 def test_add_to_dict_of_lists():
     d = {'a': [1], 'c': [5, 6]}
@@ -11,4 +11,24 @@ def test_add_to_dict_of_lists():
 
 def test_flatten_iterable():
     l = [0, [1, 2, 3], 4, [5], [[6, 7]]]
-    assert flatten_iterable(l, list()) == list(range(8))
\ No newline at end of file
+    assert flatten_iterable(l, list()) == list(range(8))
+
+
+def test_nd_pos():
+    blocks_shape = (3, 4, 5)
+    for numeric_pos in range(3 * 4 * 5):
+        pos = numeric_to_nd_pos(numeric_pos, blocks_shape, 'F')
+        assert pos == numeric_to_3d_pos(numeric_pos, blocks_shape, 'F')
+        assert _nd_to_numeric_pos(pos, blocks_shape, 'F') == numeric_pos
+
+    blocks_shape = (2, 3, 4, 5)
+    assert numeric_to_nd_pos(0, blocks_shape, 'F') == (0, 0, 0, 0)
+    assert numeric_to_nd_pos(61, blocks_shape, 'F') == (1, 0, 0, 1)
+    assert _nd_to_numeric_pos((1, 2, 3, 4), blocks_shape, 'F') == 119
+
+
+def test_is_rotational(tmp_path):
+    file_path = tmp_path / 'data.raw'
+    file_path.write_bytes(b'0')
+    assert is_rotational(str(file_path)) in [True, False, None]
+    assert is_rotational(str(tmp_path / 'missing')) is None